@@ -2,13 +2,20 @@
 import email
 import boto3
 import json
+import math
 import os
+import sys
 import subprocess
+import time
 from botocore.client import Config
 from botocore.exceptions import ClientError
 
 import configparser
 
+import workers
+sys.path.append(workers.ANNTOOLS)
+import transfer
+
 # Read configuration file
 config = configparser.ConfigParser()
 config.read('ann_config.ini')
@@ -25,6 +32,13 @@ annotations_table_name = config.get('DYNAMODB', 'annotations_table', fallback=''
 
 # S3 configurations
 results_bucket = config.get('S3', 'results_bucket', fallback='')
+multipart_chunk_mb = config.getint('S3', 'multipart_chunk_mb', fallback=16)
+max_concurrency = config.getint('S3', 'max_concurrency', fallback=10)
+# the input is left to run.py, which streams it through the pipeline
+stream_transfers = config.getboolean('S3', 'stream_transfers', 
+    fallback=False)
+transfer_config = transfer.transferConfig(multipart_chunk_mb, 
+    max_concurrency)
 
 # User configurations
 username = config.get('USER', 'username', fallback='')
@@ -38,62 +52,290 @@ queue = sqs.get_queue_by_name(QueueName=queue_name)
 dynamo = boto3.resource('dynamodb')
 annotations_table = dynamo.Table(annotations_table_name)
 
-# poll the message in message queue
-# https://aws.amazon.com/cn/getting-started/hands-on/send-messages-distributed-applications/
-while True:
-    #read a message from the queue using long polling
-    messages = queue.receive_messages(WaitTimeSeconds=20)
-    for message in messages:
-        try:
-            # extract job parameters 
-            outer_data = json.loads(message.body)
-            data = json.loads(outer_data['Message'])
-        except Exception as e:
-            print(f"An error occurred while getting: {e}")
-        try:
-            job_id = data['job_id']
-            user_email= data['email']
-            input_file_name = data['input_file_name']
-            s3_inputs_bucket = data['s3_inputs_bucket']
-            s3_key_input_file = data['s3_key_input_file']
-        except Exception as e:
-            #error handling
-            error_message = f"An error occurred while grabbing data: {str(e)}"
-            print(error_message)
+# Annotator configurations
+# jobs running at once; no messages are received while all of them are busy
+max_jobs = config.getint('ANNOTATOR', 'max_jobs', fallback=4)
+# messages received per call (SQS allows at most 10)
+receive_batch = min(config.getint('ANNOTATOR', 'receive_batch', fallback=10), 
+    10)
+# long polling wait per receive, and the wait between checks on running 
+# jobs while the pool is full, in seconds
+wait_time = config.getint('ANNOTATOR', 'wait_time', fallback=20)
+reap_interval = config.getfloat('ANNOTATOR', 'reap_interval', fallback=1.0)
+# run jobs on max_jobs warm worker processes instead of a run.py per job
+warm_workers = config.getboolean('ANNOTATOR', 'warm_workers', fallback=False)
+# downloaded inputs up to small_job_kb (0: none) are held for batch_window
+# seconds and annotated together, up to batch_max_jobs in one pass
+small_job_kb = config.getint('ANNOTATOR', 'small_job_kb', fallback=0)
+batch_window = config.getfloat('ANNOTATOR', 'batch_window', fallback=2.0)
+batch_max_jobs = config.getint('ANNOTATOR', 'batch_max_jobs', fallback=10)
+# the messages of held jobs are kept in the queue, invisible for 
+# held_visibility seconds at a time, until their batch is started
+held_visibility = config.getint('ANNOTATOR', 'held_visibility', 
+    fallback=60)
+
+log_folder = "anntools/job_status"
+
+# running jobs: job_id -> (annotator process or WarmJob, its log file)
+jobs = {}
+
+# small jobs waiting to be annotated together: (job_id, run.py command,
+# run_job() args, SQS message), when the first of them was received, and
+# when their messages were last made invisible for held_visibility
+held = []
+held_since = None
+held_extended = None
+
+pool = None
+if warm_workers:
+    pool = workers.WarmWorkers(max_jobs)
+    pool.ready()
+
+
+"""Starts the annotation job of a message; True when the message can be 
+   deleted. A small job is held instead, and its message is left in the 
+   queue until its batch is started (see start_batch()).
+"""
+def start_job(message):
+    try:
+        # extract job parameters 
+        outer_data = json.loads(message.body)
+        data = json.loads(outer_data['Message'])
+    except Exception as e:
+        print(f"An error occurred while getting: {e}")
+        return False
+    try:
+        job_id = data['job_id']
+        user_email= data['email']
+        input_file_name = data['input_file_name']
+        s3_inputs_bucket = data['s3_inputs_bucket']
+        s3_key_input_file = data['s3_key_input_file']
+    except Exception as e:
+        #error handling
+        error_message = f"An error occurred while grabbing data: {str(e)}"
+        print(error_message)
+        return False
+    try:
+
+        # process file in S3(same as hw4)
+        os.makedirs(log_folder, exist_ok=True)
+        output_dir = os.path.join(log_folder, job_id)
+        os.makedirs(output_dir, exist_ok=True)
+        save_filepath = os.path.join(output_dir, input_file_name)
+        if not stream_transfers:
+            transfer.download(s3, s3_inputs_bucket, s3_key_input_file, 
+                save_filepath, transfer_config)
+    except Exception as e:
+        #error handling
+        error_message = f"An error occurred while downloading files: {str(e)}"
+        print(error_message)
+        return False
+    try:
+        ann_tools_cmd = ['python', 'anntools/run.py', save_filepath, job_id,s3_key_input_file,user_email]
+        job_args = (save_filepath, s3_key_input_file, user_email)
+        if stream_transfers:
+            ann_tools_cmd.append(s3_inputs_bucket)
+            job_args = job_args + (s3_inputs_bucket,)
+        if is_small(save_filepath):
+            hold(job_id, ann_tools_cmd, job_args, message)
+            return False
+        launch(job_id, ann_tools_cmd, job_args)
+    except Exception as e:
+        print(f"An error occurred while starting the job: {str(e)}")
+        return False
+    return mark_running(job_id)
+
+
+"""Updates the job status in the DynamoDB table; True when it was updated
+"""
+def mark_running(job_id):
+    try:
+        annotations_table.update_item(
+            Key={'job_id': job_id},
+            UpdateExpression="SET job_status = :js",
+            ConditionExpression="job_status = :ps",
+            ExpressionAttributeValues={
+                ':js': 'RUNNING',
+                ':ps': 'PENDING'
+            }
+        )
+        return True
+    except Exception as e:
+        error_message = f"An error occurred while uploading to database: {str(e)}"
+        print(error_message)
+        return False
+
+
+"""Holds a small job until its batch is started; its message stays in the
+   queue, invisible for held_visibility seconds, so that the job is 
+   received again if this annotator stops before the batch is started
+"""
+def hold(job_id, ann_tools_cmd, job_args, message):
+    global held_since, held_extended
+    message.change_visibility(VisibilityTimeout=held_visibility)
+    if (len(held) == 0):
+        held_since = time.time()
+        held_extended = held_since
+    held.append((job_id, ann_tools_cmd, job_args, message))
+
+
+"""True when the job's input is small enough to be annotated with others;
+   a streamed input is not local, so it never is
+"""
+def is_small(save_filepath):
+    return small_job_kb > 0 and not stream_transfers and \
+        os.path.getsize(save_filepath) <= small_job_kb * 1024
+
+
+"""Starts run.py with ann_tools_cmd, or function(*job_args) of run.py on 
+   a warm worker
+"""
+def launch(job_id, ann_tools_cmd, job_args, function='run_job'):
+    # the job's output goes to a log file: pipes nobody reads would block
+    # it once they fill up
+    log = open(os.path.join(log_folder, f"{job_id}.log"), 'w')
+    if (pool is not None):
+        job = pool.submit(job_args, log.name, function)
+    else:
+        job = subprocess.Popen(ann_tools_cmd, stdout=log, 
+            stderr=subprocess.STDOUT)
+    jobs[job_id] = (job, log)
+
+
+"""True when the small jobs held should be started: the batch is full, 
+   or its window is over
+"""
+def batch_due():
+    return len(held) > 0 and (len(held) >= batch_max_jobs or 
+        time.time() - held_since >= batch_window)
+
+
+"""Starts up to batch_max_jobs of the small jobs held as one run.py batch
+   (see run.run_batch()), which runs, and is reaped, as one job; a job 
+   held alone runs as usual. The messages of the jobs are deleted once the
+   batch is started; if it cannot be, they are left to be received again.
+"""
+def start_batch():
+    global held, held_since
+    (started, held) = (held[:batch_max_jobs], held[batch_max_jobs:])
+    held_since = time.time()
+    try:
+        if (len(started) == 1):
+            launch(*started[0][:3])
+        else:
+            job_args = [list(args) for (job_id, cmd, args, message) 
+                in started]
+            batch_id = f"batch~{started[0][0]}"
+            launch(batch_id, ['python', 'anntools/run.py', 'batch', 
+                json.dumps(job_args)], (job_args,), 'run_batch')
+            print(f"Batch {batch_id}: " + \
+                ', '.join([job_id for (job_id, cmd, args, message) 
+                    in started]))
+    except Exception as e:
+        print(f"An error occurred while starting a batch: {str(e)}")
+        return
+    delete_messages([message for (job_id, cmd, args, message) in started
+        if mark_running(job_id)])
+
+
+"""Keeps the messages of the jobs held invisible while they wait for 
+   their batch: they are extended half way through held_visibility
+"""
+def extend_held():
+    global held_extended
+    if (len(held) == 0 or 
+        time.time() - held_extended < held_visibility / 2):
+        return
+    held_extended = time.time()
+    for start in range(0, len(held), 10):
+        batch = held[start:start + 10]
         try:
+            response = queue.change_message_visibility_batch(Entries=[
+                {'Id': str(i), 'ReceiptHandle': message.receipt_handle,
+                    'VisibilityTimeout': held_visibility}
+                for (i, (job_id, cmd, args, message)) in enumerate(batch)])
+            for failed in response.get('Failed', []):
+                print("An error occurred while extending a message: " + \
+                    f"{failed}")
+        except ClientError as e:
+            print(f"An error occurred while extending messages: {str(e)}")
 
-            # process file in S3(same as hw4)
-            log_folder = "anntools/job_status"
-            os.makedirs(log_folder, exist_ok=True)
-            output_dir = os.path.join(log_folder, job_id)
-            os.makedirs(output_dir, exist_ok=True)
-            save_filepath = os.path.join(output_dir, input_file_name)
-            s3.download_file(s3_inputs_bucket, s3_key_input_file, save_filepath)
-        except Exception as e:
-            #error handling
-            error_message = f"An error occurred while downloading files: {str(e)}"
-            print(error_message)
+
+"""Waits on the jobs that have exited; the log of a job that succeeded is
+   removed. Returns how many exited.
+"""
+def reap_jobs():
+    finished = [job_id for (job_id, (job, log)) in jobs.items() 
+        if job.poll() is not None]
+    for job_id in finished:
+        (job, log) = jobs.pop(job_id)
+        log.close()
+        if (job.returncode == 0):
+            os.remove(log.name)
+        else:
+            print(f"Job {job_id} failed with exit code {job.returncode}, " + \
+                f"see {log.name}")
+    return len(finished)
+
+
+"""Deletes messages 10 (the most SQS takes) at a time
+"""
+def delete_messages(messages):
+    for start in range(0, len(messages), 10):
+        batch = messages[start:start + 10]
         try:
-            ann_tools_cmd = ['python', 'anntools/run.py', save_filepath, job_id,s3_key_input_file,user_email]
-            job = subprocess.Popen(ann_tools_cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            response = queue.delete_messages(Entries=[
+                {'Id': str(i), 'ReceiptHandle': message.receipt_handle}
+                for (i, message) in enumerate(batch)])
+            for failed in response.get('Failed', []):
+                print(f"An error occurred while deleting a message: {failed}")
+        except ClientError as e:
+            print(f"An error occurred while deleting messages: {str(e)}")
+
 
-            # update the job status in the DynamoDB table
-            annotations_table.update_item(
-                Key={'job_id': job_id},
-                UpdateExpression="SET job_status = :js",
-                ConditionExpression="job_status = :ps",
-                ExpressionAttributeValues={
-                    ':js': 'RUNNING',
-                    ':ps': 'PENDING'
-                }
-            )
+"""Approximate number of messages waiting in the queue
+"""
+def queued_messages():
+    try:
+        queue.reload()
+        return int(queue.attributes.get('ApproximateNumberOfMessages', 0))
+    except ClientError:
+        return -1
 
-            message.delete()
 
+def report():
+    print(f"Jobs in flight: {len(jobs)}/{max_jobs}, " + \
+        f"held: {len(held)}, queued: {queued_messages()}")
 
-            
-        except Exception as e:
-            error_message = f"An error occurred while uploading to database: {str(e)}"
-            print(error_message)
 
-    
\ No newline at end of file
+# poll the message in message queue
+# https://aws.amazon.com/cn/getting-started/hands-on/send-messages-distributed-applications/
+while True:
+    if (reap_jobs() > 0):
+        report()
+    extend_held()
+    # a batch of small jobs takes one slot of the pool
+    if (batch_due() and len(jobs) < max_jobs):
+        start_batch()
+        report()
+    free = max_jobs - len(jobs)
+    if (free <= 0):
+        # backpressure: leave the messages to other annotators (or to us, 
+        # once a job exits) rather than receive what cannot be started
+        time.sleep(reap_interval)
+        continue
+
+    #read up to a batch of messages from the queue using long polling, no
+    # longer than the small jobs held can wait
+    wait = wait_time
+    if (len(held) > 0):
+        wait = min(wait, max(0, int(math.ceil(min(
+            held_since + batch_window, 
+            held_extended + held_visibility / 2) - time.time()))))
+    messages = queue.receive_messages(
+        MaxNumberOfMessages=min(receive_batch, free), 
+        WaitTimeSeconds=wait)
+    if (len(messages) == 0):
+        continue
+    delete_messages([message for message in messages if start_job(message)])
+    report()
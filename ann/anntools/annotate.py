@@ -10,8 +10,20 @@
 ##
 __author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
 
+import copy
+import queue
+import bisect
+import threading
+import collections
+from concurrent.futures import ThreadPoolExecutor
+
 import file_utils as fu
 import utils as u
+import binning as bn
+import mergejoin as mj
+import vcftable as vt
+import bgzf
+import vcfmap
 
 indicesKnownGenes=[12, 1, 3] #12 for gene
 
@@ -43,7 +55,8 @@ def collapseRefSeq(line):
     fcount = 0
     collapsed = []
 
-    for f in fields:
+    # a bin column, if the table has been binned, comes after the others
+    for f in fields[:len(names)]:
         if (fcount > 4):
             if(len(str(f)) > 0 and str(f) !='0'):
                 collapsed.append(str(names[fcount]).strip() + '=' + str(f).strip())
@@ -80,6 +93,16 @@ def clean_mysql_chars(entry):
     return str(entry)
 
 
+"""Equality as the reference database's default collation compares text:
+   case-insensitive, trailing spaces ignored. Used when a snapshot index
+   answers a query instead of MySQL.
+"""
+def sqlEquals(value, text):
+    if (value is None):
+        return False
+    return str(value).rstrip(' ').upper() == str(text).rstrip(' ').upper()
+
+
 def getFormatSpecificIndices(format='vcf'):
     chr_ind = 0
     pos_ind = 1
@@ -107,1023 +130,1177 @@ def getComplementary(nuc):
         return compNuc
 
 
+"""Gene location counters reported in .count.log, in log order
+"""
+GENE_LOCATION_COUNTS = [
+    ('interGenic', 'In interGenic'),
+    ('cds', 'In CDS'),
+    ('utr3', 'In \'3 UTR'),
+    ('utr5', 'In \'5 UTR'),
+    ('intronic', 'In Intronic'),
+    ('non_coding_intronic', 'In Non_coding_intronic'),
+    ('exonic', 'In Exonic'),
+    ('non_coding_exonic', 'In Non_coding_exonic'),
+    ('promoter', 'In Putative Promoter Region')]
+
+"""positionType values (set by getBigRefGene) counted by getGenes
+"""
+POSITION_TYPE_COUNTS = {
+    'intron': 'intronic',
+    'non_coding_intron': 'non_coding_intronic',
+    'CDS': 'cds',
+    'non_coding_exon': 'non_coding_exonic',
+    'utr5': 'utr5',
+    'utr3': 'utr3'}
+
+
+"""Base class for the per-record annotators behind each stage.
+
+   lookup() does all the reference database work for one record and 
+   apply() adds the result to the record's fields and counters, so the 
+   same annotator can run as a standalone stage over a temp file or as 
+   one step of the fused pipeline in driver.py.
+
+   When a reference snapshot (snapshot.Snapshot) is given, tables it 
+   contains are read from the snapshot instead of the database, as are
+   the exact-match lookups on tables it has a hash index for. With a 
+   cache (cache.AnnotationCache), lookup results are taken from it when 
+   present and stored in it otherwise.
+"""
+class Annotator(object):
+    logmode = 'a'
+
+    def __init__(self, cursor, format='vcf', table=None, snapshot=None):
+        self.cursor = cursor
+        self.table = table
+        self.snapshot = snapshot
+        self.inds = getFormatSpecificIndices(format=format)
+        self.parsedLoci = (self.inds == vt.VCF_COLUMNS)
+        self.counts = {}
+        self.jobCounts = None
+        self.inflight = None
+        self.cache = None
+
+    def fromSnapshot(self, table=None):
+        if (table is None):
+            table = self.table
+        return self.snapshot is not None and self.snapshot.hasTable(table)
+
+    def fromIndex(self, table=None):
+        if (table is None):
+            table = self.table
+        return self.snapshot is not None and self.snapshot.hasIndex(table)
+
+    def isHeader(self, line):
+        return line.startswith('##') or line.startswith('CHROM') or \
+            line.startswith('#CHROM')
+
+    """(CHROM, POS, REF, ALT) of a record, stripped; taken from the parsed
+       batch when the record comes from one (see vcftable.py)
+    """
+    def locus(self, fields):
+        if (self.parsedLoci and fields.locus is not None):
+            return fields.locus
+        return tuple([fields[i].strip() if i < len(fields) else None 
+            for i in self.inds])
+
+    """POS of a record as an int
+    """
+    def position(self, fields):
+        return fields.position()
+
+    def lookup(self, fields):
+        raise NotImplementedError
+
+    def apply(self, fields, result):
+        raise NotImplementedError
+
+    def annotate(self, fields):
+        self.apply(fields, self.lookup(fields))
+
+    """Results for a list of records, in the same order; stages that can
+       resolve many records per query override this
+    """
+    def lookupBatch(self, records):
+        return [self.lookup(fields) for fields in records]
+
+    def annotateBatch(self, records):
+        self.applyBatch(records, self.results(records))
+
+    """lookupBatch() through the cache and the in-flight lookups, when 
+       the stage has them
+    """
+    def results(self, records):
+        if (self.cache is None):
+            return self.fetch(records)
+
+        keys = [self.cacheKey(fields) for fields in records]
+        found = self.cache.getMany(keys)
+        missing = [i for i in range(0, len(records)) if keys[i] not in found]
+        if (self.jobCounts is None):
+            self.countCache(self.counts, len(records), 
+                len(records) - len(missing))
+        else:
+            for i in range(0, len(records)):
+                self.countCache(self.jobCounts[records[i].job], 1, 
+                    1 if keys[i] in found else 0)
+
+        fetched = self.fetch([records[i] for i in missing])
+        self.cache.putMany([(keys[missing[k]], fetched[k]) 
+            for k in range(0, len(missing))])
+        for k in range(0, len(missing)):
+            found[keys[missing[k]]] = fetched[k]
+        return [found[key] for key in keys]
+
+    def fetch(self, records):
+        if (len(records) == 0):
+            return []
+        if (self.inflight is not None):
+            return self.inflight.lookupBatch(records)
+        return self.lookupBatch(records)
+
+    """Stage name in cache keys; subclasses add the settings that change
+       their lookups
+    """
+    def cacheName(self):
+        if (self.table is None):
+            return self.__class__.__name__
+        return self.__class__.__name__ + ':' + str(self.table)
+
+    def cacheKey(self, fields):
+        (chr, pos, ref, alt) = self.locus(fields)
+        return self.cache.key(self.cacheName(), chr, pos, ref, alt)
+
+    def countCache(self, counts, lookups, hits):
+        counts['cache_lookups'] = counts.get('cache_lookups', 0) + lookups
+        counts['cache_hits'] = counts.get('cache_hits', 0) + hits
+
+    def applyBatch(self, records, results):
+        for i in range(0, len(records)):
+            if (self.jobCounts is not None):
+                self.counts = self.jobCounts[records[i].job]
+            self.apply(records[i], results[i])
+
+    def writeLog(self, fh_log):
+        pass
+
+    def writeCacheLog(self, fh_log):
+        lookups = self.counts.get('cache_lookups', 0)
+        if (lookups > 0):
+            hits = self.counts['cache_hits']
+            ratio = (hits / float(lookups)) * 100
+            fh_log.write(f"Cache {self.cacheName()}: {str(hits)} of " + \
+                f"{str(lookups)} ({str(ratio)}%)\n")
+
+    """Adds the counters of the same annotator run over another part of 
+       the input
+    """
+    def mergeCounts(self, counts):
+        for key in counts:
+            self.counts[key] = self.counts.get(key, 0) + counts[key]
+
+    """Keeps separate counters for each of jobs jobs whose records are
+       annotated together (see runJobPipeline()), starting from zero;
+       self.counts is the counters of the job of the record being applied
+    """
+    def splitCounts(self, jobs):
+        self.jobCounts = [dict.fromkeys(self.counts, 0) 
+            for i in range(0, jobs)]
+
+
+"""Runs annotators over a VCF in a single pass and writes the result once.
+   With a single annotator this is exactly one of the staged steps. The
+   input may be gzip or BGZF; an outfile ending in .gz is written as BGZF.
+   Records are parsed once (vcftable.ParsedVcf) and handed to the 
+   annotators batch_size at a time, or to the scheduler 
+   (scheduler.StageGraph) when one is given. The input's lines and an
+   open writer for the result (closed at the end, or aborted when the
+   pipeline fails) can be given instead of the files, to stream them from
+   and to S3 (see transfer.py).
+"""
+def runPipeline(annotators, infile, outfile, sep='\t', batch_size=500, 
+    scheduler=None, lines=None, fh_out=None):
+    fh = None
+    if (lines is None):
+        (fh, lines) = openInput(infile)
+    if (fh_out is None):
+        fh_out = bgzf.openText(outfile, "w")
+    try:
+        for parsed in vt.readBatches(lines, annotators[0].isHeader, sep=sep,
+            batch_size=batch_size):
+            annotateRecords(annotators, parsed.records, scheduler)
+            parsed.write(fh_out)
+    except BaseException:
+        # a streamed result's upload is aborted, not completed
+        if (fh is not None):
+            fh.close()
+        bgzf.abortFile(fh_out)
+        raise
+    if (fh is not None):
+        fh.close()
+    fh_out.close()
+
+
+"""(open file, its lines as str) of a VCF: plain text is memory-mapped,
+   gzip and BGZF are decompressed
+"""
+def openInput(infile):
+    mapped = vcfmap.openMapped(infile)
+    if (mapped is not None):
+        return (mapped, mapped.textLines())
+    fh = bgzf.openText(infile)
+    return (fh, fh)
+
+
+"""runPipeline() over the inputs of several jobs in one pass: their lines
+   are read one job after the other and batched together, and each line
+   is written to the output of its job, outfiles[job]. Each annotator 
+   keeps the counters of every job apart in jobCounts.
+"""
+def runJobPipeline(annotators, infiles, outfiles, sep='\t', batch_size=500,
+    scheduler=None):
+    for annotator in annotators:
+        annotator.splitCounts(len(infiles))
+    inputs = [openInput(infile) for infile in infiles]
+    fhs_out = [bgzf.openText(outfile, "w") for outfile in outfiles]
+    try:
+        for parsed in vt.readJobBatches([lines for (fh, lines) in inputs],
+            annotators[0].isHeader, sep=sep, batch_size=batch_size):
+            annotateRecords(annotators, parsed.records, scheduler)
+            parsed.writeJobs(fhs_out)
+    except BaseException:
+        for (fh, lines) in inputs:
+            fh.close()
+        for fh_out in fhs_out:
+            bgzf.abortFile(fh_out)
+        raise
+    for (fh, lines) in inputs:
+        fh.close()
+    for fh_out in fhs_out:
+        fh_out.close()
+
+
+def annotateRecords(annotators, records, scheduler=None):
+    if (len(records) == 0):
+        return
+    if (scheduler is not None):
+        scheduler.annotateRecords(records)
+        return
+    annotators[0].annotateBatch(records)
+    for annotator in annotators[1:]:
+        for fields in records:
+            fields.restrip()
+        annotator.annotateBatch(records)
+
+
+"""Keeps up to depth lookups of one annotator in flight. Each of depth 
+   copies of the annotator has its own pooled connection and looks up a
+   contiguous share of every batch; the shares are put back together in 
+   record order, so the batch is the (bounded) reorder buffer.
+"""
+class InFlightLookups(object):
+    def __init__(self, annotator, depth):
+        self.conns = [u.db_connect() for i in range(0, depth)]
+        self.copies = queue.Queue()
+        for conn in self.conns:
+            clone = copy.copy(annotator)
+            clone.cursor = conn.cursor()
+            self.copies.put(clone)
+        self.depth = depth
+        self.pool = ThreadPoolExecutor(max_workers=depth)
+
+    def lookup(self, records):
+        clone = self.copies.get()
+        try:
+            return clone.lookupBatch(records)
+        finally:
+            self.copies.put(clone)
+
+    def lookupBatch(self, records):
+        size = -(-len(records) // self.depth)
+        futures = [self.pool.submit(self.lookup, records[start:start + size])
+            for start in range(0, len(records), size)]
+        results = []
+        for future in futures:
+            results.extend(future.result())
+        return results
+
+    def close(self):
+        self.pool.shutdown()
+        for conn in self.conns:
+            conn.close()
+
+
+"""Runs one annotator as a standalone stage: basefile + tmpextin is read,
+   basefile + tmpextout is written and the counters go to .count.log. With
+   depth > 1, depth lookups are kept in flight (see InFlightLookups); with
+   merge, an overlap stage looks records up by merge join (see 
+   mergejoin.py) instead.
+"""
+def runStage(annotator, basefile, tmpextin, tmpextout, sep='\t', 
+    batch_size=500, depth=1, cache=None, merge=False):
+    annotator.cache = cache
+    if merge:
+        annotator.merge = mj.MergeJoin(annotator)
+    elif (depth > 1):
+        annotator.inflight = InFlightLookups(annotator, depth)
+    runPipeline([annotator], basefile + tmpextin, basefile + tmpextout, 
+        sep=sep, batch_size=batch_size)
+    if merge:
+        annotator.merge.close()
+        annotator.merge = None
+    elif (depth > 1):
+        annotator.inflight.close()
+        annotator.inflight = None
+
+    fh_log = open(basefile + '.count.log', annotator.logmode)
+    annotator.writeLog(fh_log)
+    annotator.writeCacheLog(fh_log)
+    fh_log.close()
+
+
 """"Format must be pileup or vcf
     Types of variants in dbSNP135: DIV, SNV, MNV, MIXED
-""" 
-def getSnpsFromDbSnp(vcf, format='vcf', tmpextin='', tmpextout='.1',
-    varclass='SNV', sep='\t'):
-    
-    outfile = vcf + tmpextout
-    fh_out = open(outfile, "w")
-    logcountfile = vcf + '.count.log'
-    fh_log = open(logcountfile, 'w')
-    var_count = 0
 
-    inds = getFormatSpecificIndices(format=format)
-
-    fh = open(vcf)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        if not line.startswith("#"):
-            fields = line.split(sep)
-            chr = fields[inds[0]].strip()
-            if chr.startswith("chr"):
-                chr = chr.replace('chr', '')
-
-            pos = fields[inds[1]].strip()
-            ref = clean_mysql_chars(fields[inds[2]]).strip()
-            alt = clean_mysql_chars(fields[inds[3]]).strip()
-
-            compRef = getComplementary(ref)
-            compAlt = getComplementary(alt)
-
-            sql = 'select * from dbSNP where CHR="' + str(chr) + \
-                '" AND POS=' + str(pos) + ' AND ( REF="' + str(ref) + \
-                '" OR REF ="' + str(compRef) + '" )  AND INFO = "' + \
-                varclass + '" ;'
-            cursor.execute(sql)
-            rows = cursor.fetchall()
-
-            fields[2] = '.'
+    Variants are looked up batch_size at a time: each batch is one query 
+    joining dbSNP against the batch's (CHR, POS, REF) keys, and the rows 
+    are handed back to the variants in input order. batch_size=1 issues 
+    the original one-query-per-variant lookups. With a snapshot that 
+    indexes dbSNP, rows are fetched from the hash index by (CHR, POS) and 
+    REF / INFO are matched here instead.
+""" 
+class DbSnpAnnotator(Annotator):
+    logmode = 'w'
+
+    def __init__(self, cursor, format='vcf', varclass='SNV', batch_size=500,
+        snapshot=None):
+        Annotator.__init__(self, cursor, format=format, table='dbSNP', 
+            snapshot=snapshot)
+        self.varclass = varclass
+        self.batch_size = batch_size
+        self.statements = {}
+        self.counts = {'records': 0, 'in_dbsnp': 0}
+
+    def isHeader(self, line):
+        return line.startswith("#")
+
+    """CHR, POS, REF and complementary REF to match in dbSNP
+    """
+    def key(self, fields):
+        (chr, pos, ref, alt) = self.locus(fields)
+        chr = vt.bareChrom(chr)
+        compRef = getComplementary(ref)
+        return (chr, pos, ref, compRef)
+
+    def cacheName(self):
+        return Annotator.cacheName(self) + ':' + self.varclass
+
+    def lookup(self, fields):
+        if self.fromIndex():
+            return self.lookupIndex([fields])[0]
+
+        (chr, pos, ref, compRef) = self.key(fields)
+        self.cursor.execute('select * from dbSNP where CHR=%s ' + \
+            'AND POS=%s AND ( REF=%s OR REF =%s ) AND INFO = %s ;', 
+            (chr, int(pos), ref, compRef, self.varclass))
+        return self.cursor.fetchall()
+
+    def lookupBatch(self, records):
+        if self.fromIndex():
+            return self.lookupIndex(records)
+        if (self.batch_size <= 1):
+            return Annotator.lookupBatch(self, records)
+
+        results = []
+        for start in range(0, len(records), self.batch_size):
+            results.extend(self.lookupKeys(
+                records[start:start + self.batch_size]))
+        return results
+
+    """One round trip for a batch of records: the keys go in as a derived
+       table so the REF / complementary REF matching stays in SQL, exactly 
+       as in lookup(). Rows come back tagged with the record's index.
+    """
+    def lookupKeys(self, records):
+        params = []
+        for idx in range(0, len(records)):
+            (chr, pos, ref, compRef) = self.key(records[idx])
+            params.extend([idx, chr, int(pos), ref, compRef])
+        params.append(self.varclass)
+        self.cursor.execute(self.keysSql(len(records)), params)
+
+        results = [[] for fields in records]
+        for row in self.cursor.fetchall():
+            results[int(row[0])].append(row[1:len(row)])
+        return results
+
+    """Statement for lookupKeys() on n records; the text only depends on n,
+       so it is built once per batch size
+    """
+    def keysSql(self, n):
+        if n not in self.statements:
+            self.statements[n] = 'select k.idx, d.* from dbSNP d join ' + \
+                '(select ' + ' union all select '.join(['%s as idx, ' + \
+                '%s as chr, %s as pos, %s as ref, %s as compRef'] * n) + \
+                ') k on d.CHR = k.chr AND d.POS = k.pos AND ' + \
+                '( d.REF = k.ref OR d.REF = k.compRef ) AND d.INFO = %s ;'
+        return self.statements[n]
+
+    """Same rows as lookup() from the snapshot's hash index: all rows at
+       (CHR, POS), filtered on REF / complementary REF and INFO
+    """
+    def lookupIndex(self, records):
+        keys = [self.key(fields) for fields in records]
+        index = self.snapshot.index(self.table)
+        refInd = index.names.index('REF')
+        infoInd = index.names.index('INFO')
+
+        results = self.snapshot.exactBatch(self.table, 
+            [(chr, int(pos)) for (chr, pos, ref, compRef) in keys])
+        for i in range(0, len(keys)):
+            (chr, pos, ref, compRef) = keys[i]
+            results[i] = [row for row in results[i] 
+                if sqlEquals(row[infoInd], self.varclass) and 
+                (sqlEquals(row[refInd], ref) or 
+                    sqlEquals(row[refInd], compRef))]
+        return results
+
+    def apply(self, fields, rows):
+        self.counts['records'] = self.counts['records'] + 1
+
+        ## reset rsid to "." - in case there was annotation from old release of dbSNP
+        fields[2] = '.'
+        if (len(rows) > 0):
             rsids = []
             mafs = []
-            if (len(rows) > 0):
-                for row in rows:
-                    rsids.append(str(row[3]))
-                    if (str(row[7]) != '.'):
-                        mafs.append('GMAF=' + str(row[7]))
-
-                maf_str=''
-                if (len(mafs) > 0):
-                    maf_str = ';' + ';'.join([str(x) for x in mafs])
+            for row in rows:
+                rsids.append(str(row[3]))
+                if (str(row[7]) != '.'):
+                    mafs.append('GMAF=' + str(row[7]))
 
-                var_count = var_count + 1
-                if (str(fields[7]) == '.'):
-                    fields[7] = 'DB' + maf_str
-                else:
-                    fields[7] = fields[7] + ';DB;VC=' + varclass + maf_str
+            maf_str=''
+            if (len(mafs) > 0):
+                maf_str = ';' + ';'.join([str(x) for x in mafs])
 
-                fields[2] = str(';'.join(rsids))
-                l = '\t'.join([str(x) for x in fields])
-                fh_out.write(l + '\n')
+            self.counts['in_dbsnp'] = self.counts['in_dbsnp'] + 1
+            fields.info.setOrAppend('DB' + maf_str, 
+                'DB;VC=' + self.varclass + maf_str)
 
-            else:
-                ## reset rsid to "." - in case there was annotation from old release of dbSNP
-                fh_out.write('\t'.join([str(x) for x in fields]) + '\n')
+            fields[2] = str(';'.join(rsids))
 
-            linenum = linenum + 1
+    def writeLog(self, fh_log):
+        # line numbers historically started at 1, so the total is one more 
+        # than the number of records
+        linenum = self.counts['records'] + 1
+        var_count = self.counts['in_dbsnp']
+        ratioInDbSnp = (var_count / float(linenum)) * 100
+        fh_log.write("## Please notice that all Isoforms were counted\n")
+        fh_log.write("## Numbers may exceed number of variants in the annotated file\n")
+        fh_log.write(f"Total: {str(linenum)}\n")
+        fh_log.write(f"In dbSNP: {str(var_count)} ({str(ratioInDbSnp)}%)\n")
 
-        else:
-            fh_out.write(line + '\n')
 
-    ratioInDbSnp = (var_count / float(linenum)) * 100
-    fh_log.write("## Please notice that all Isoforms were counted\n")
-    fh_log.write("## Numbers may exceed number of variants in the annotated file\n")
-    fh_log.write(f"Total: {str(linenum)}\n")
-    fh_log.write(f"In dbSNP: {str(var_count)} ({str(ratioInDbSnp)}%)\n")
-    fh_log.close()
+def getSnpsFromDbSnp(vcf, format='vcf', tmpextin='', tmpextout='.1',
+    varclass='SNV', sep='\t', batch_size=500, snapshot=None, cache=None):
 
+    conn = u.db_connect()
+    annotator = DbSnpAnnotator(conn.cursor(), format=format, 
+        varclass=varclass, batch_size=batch_size, snapshot=snapshot)
+    runStage(annotator, vcf, tmpextin, tmpextout, sep=sep, 
+        batch_size=batch_size, cache=cache)
     conn.close()
-    fh.close()
-    fh_out.close()
 
 
 """NOTE: all isoforms are collapsed in one record
     1. chrom_pos_equal_base
     2. chrom_pos_equal_nobase
     3. chrom_pos_unequal
-"""
-def getBigRefGene(vcf, format='vcf', tmpextin='.1', tmpextout='.2', sep='\t'):
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-    fh_out = open(outfile, "w")
-    inds = getFormatSpecificIndices(format=format)
-    fh = open(vcf)
-
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    vcf_linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        if not line.startswith("#"):
-            fields = line.split(sep)
-            chr = fields[inds[0]].strip()
-            if chr.startswith("chr"):
-                chr = chr.replace('chr', '')
-
-            pos = fields[inds[1]].strip()
-            ref = clean_mysql_chars(fields[inds[2]]).strip()
-            alt = clean_mysql_chars(fields[inds[3]]).strip()
-
-            compRef = getComplementary(ref)
-            compAlt = getComplementary(alt)
-
-            sql1 = 'select * from chrom_pos_equal_base where CHR="' + \
-                str(chr) + '" AND start = ' + str(pos) + \
-                ' AND ((haplotypeReference="' + str(ref) + \
-                '" AND haplotypeAlternate ="' + str(alt) + \
-                '") OR (haplotypeReference="' + str(compRef) + \
-                '" AND haplotypeAlternate ="' + str(compAlt) + '"));'
-
-            sql2 = 'select * from chrom_pos_equal_nobase where CHR="' + \
-                str(chr) + '" AND start = ' + str(pos) + ';'
-
-            sql3 = 'select * from chrom_pos_unequal where CHR="' + \
-                str(chr) + '" AND start <= ' + str(pos) + ' AND ' + \
-                str(pos) + ' <= end ;'
-
-            keep_going = True
-            cursor.execute(sql1)
-            rows = cursor.fetchall()
 
+    The first two are exact (CHR, start) matches, answered by the snapshot's
+    hash index when it has one.
+"""
+class BigRefGeneAnnotator(Annotator):
+
+    def __init__(self, cursor, format='vcf', snapshot=None):
+        Annotator.__init__(self, cursor, format=format, snapshot=snapshot)
+
+    def isHeader(self, line):
+        return line.startswith("#")
+
+    def lookup(self, fields):
+        (chr, pos, ref, alt) = self.locus(fields)
+        chr = vt.bareChrom(chr)
+        pos = self.position(fields)
+
+        compRef = getComplementary(ref)
+        compAlt = getComplementary(alt)
+
+        sql1 = ('select * from chrom_pos_equal_base where CHR=%s ' + \
+            'AND start = %s AND ((haplotypeReference=%s AND ' + \
+            'haplotypeAlternate =%s) OR (haplotypeReference=%s AND ' + \
+            'haplotypeAlternate =%s));', 
+            [chr, pos, ref, alt, compRef, compAlt])
+
+        sql2 = ('select * from chrom_pos_equal_nobase where CHR=%s ' + \
+            'AND start = %s;', [chr, pos])
+
+        (binned, bins) = bn.binPredicate(self.cursor, 'chrom_pos_unequal', 
+            pos, pos)
+        sql3 = ('select * from chrom_pos_unequal where CHR=%s AND ' + \
+            binned + 'start <= %s AND %s <= end ;', [chr] + bins + [pos, pos])
+
+        for (table, sql) in [('chrom_pos_equal_base', sql1), 
+            ('chrom_pos_equal_nobase', sql2), ('chrom_pos_unequal', sql3)]:
+            if self.fromIndex(table):
+                rows = self.snapshot.exact(table, chr, pos)
+                if (table == 'chrom_pos_equal_base'):
+                    rows = self.sameAlleles(rows, 
+                        [(ref, alt), (compRef, compAlt)])
+            else:
+                self.cursor.execute(*sql)
+                rows = self.cursor.fetchall()
             if (len(rows) > 0):
-                keep_going = False
-                m = set([])
-                for row in rows:
-                    m.add(collapseRefSeq('\t'.join([str(x) for x in row[1:len(row)] ])))
-
-                fields[7] = fields[7] + ';' + ';'.join(m)
-                if (str(fields[7]).startswith(".;")):
-                    fields[7] = str(fields[7]).replace('.;', '', 1)
-
-                l = '\t'.join([str(x) for x in fields])
-                fh_out.write(l + '\n')
-
-            if (keep_going):
-                cursor.execute(sql2)
-                rows = cursor.fetchall()
-
-                if (len(rows) > 0):
-                    keep_going = False
-                    m = set([])
-                    for row in rows:
-                        m.add(collapseRefSeq('\t'.join([str(x) for x in row[1:len(row)]])))
-
-                    fields[7] = fields[7] + ';' + ';'.join(m)
-                    if (str(fields[7]).startswith(".;")):
-                        fields[7] = str(fields[7]).replace('.;', '', 1)
-                    
-                    l = '\t'.join([str(x) for x in fields])
-                    fh_out.write(l + '\n')
-
-            if (keep_going):
-                cursor.execute(sql3)
-                rows = cursor.fetchall()
-
-                if (len(rows) > 0):
-                    keep_going = False
-                    m = set([])
-                    for row in rows:
-                        m.add(collapseRefSeq('\t'.join([str(x) for x in row[1:len(row)]])))
-
-                    fields[7] = fields[7] + ';' + ';'.join(m)
-                    if (str(fields[7]).startswith(".;")):
-                        fields[7] = str(fields[7]).replace('.;', '', 1)
-
-                    l = '\t'.join([str(x) for x in fields])
-                    fh_out.write(l + '\n')
-
-            if (keep_going):
-                fh_out.write(line + '\n')
-
-            vcf_linenum = vcf_linenum + 1
-
-        else:
-            fh_out.write(line + '\n')
-
+                return rows
+        return []
+
+    """Rows whose (haplotypeReference, haplotypeAlternate) is one of alleles
+    """
+    def sameAlleles(self, rows, alleles):
+        index = self.snapshot.index('chrom_pos_equal_base')
+        refInd = index.names.index('haplotypeReference')
+        altInd = index.names.index('haplotypeAlternate')
+        return [row for row in rows if True in 
+            [sqlEquals(row[refInd], ref) and sqlEquals(row[altInd], alt) 
+                for (ref, alt) in alleles]]
+
+    def apply(self, fields, rows):
+        if (len(rows) > 0):
+            m = set([])
+            for row in rows:
+                m.add(collapseRefSeq('\t'.join([str(x) for x in row[1:len(row)]])))
+
+            fields.info.append(';'.join(m))
+            fields.info.dropMissing()
+
+
+def getBigRefGene(vcf, format='vcf', tmpextin='.1', tmpextout='.2', sep='\t',
+    snapshot=None, depth=1, cache=None):
+    conn = u.db_connect()
+    runStage(BigRefGeneAnnotator(conn.cursor(), format=format, 
+        snapshot=snapshot), vcf, tmpextin, tmpextout, sep=sep, 
+        depth=depth, cache=cache)
     conn.close()
-    fh.close()
-    fh_out.close()
 
 
-"""Get information about location in gene structures
+"""A refGene transcript parsed once: coordinates, exons as sorted int 
+   lists for bisect, and the CpG islands overlapping its promoter window
+   (filled in the first time a variant falls in that window)
 """
-def getGenes(vcf, format='vcf', table='refGene', promoter_offset=500, 
-    tmpextin='.2', tmpextout='.3', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-    fh_out = open(outfile, "w")
-
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-
-    interGenic_count = 0
-    cds_count = 0
-    utr3_count = 0
-    utr5_count = 0
-    intronic_count = 0
-    non_coding_intronic_count = 0
-    exonic_count = 0
-    non_coding_exonic_count = 0
-    promoter_count = 0
-
-    inds = getFormatSpecificIndices(format=format)
-    fh = open(vcf)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        if not line.startswith("#"):
-            fields = line.split(sep)
-            chr = fields[inds[0]].strip()
-
-            if not chr.startswith("chr"):
-                chr = "chr" + chr
-
-            pos = fields[inds[1]].strip()
-            ref = clean_mysql_chars(fields[inds[2]]).strip()
-            alt = clean_mysql_chars(fields[inds[3]]).strip()
-            info_field = clean_mysql_chars(fields[7]).strip()
-            this_gene_name = str(u.parse_field(info_field, 'name', ';', '='))
-
-            sql = 'select * from ' + table + ' where chrom="' + str(chr) + \
-                '" AND (txStart - ' + str(promoter_offset) +') <= ' + \
-                str(pos) + ' AND ' + str(pos) + ' <= (txEnd + ' + \
-                str(promoter_offset) +');'
-
-            cursor.execute(sql)
-            rows = cursor.fetchall()
-            info = []
-
-            if (len(rows) > 0):
-                cnt = 1
-                for row in rows:
-                    #count location
-                    positionType = str(u.parse_field(info_field, 
-                        'positionType', ';', '='))
-                    
-                    if (positionType == 'intron'):
-                        intronic_count = intronic_count + 1
-                    elif (positionType == 'non_coding_intron'):
-                        non_coding_intronic_count = non_coding_intronic_count + 1
-                    elif (positionType == 'CDS'):
-                        cds_count = cds_count + 1
-                    elif (positionType == 'non_coding_exon'):
-                        non_coding_exonic_count = non_coding_exonic_count + 1
-                    elif (positionType == 'utr5'):
-                        utr5_count = utr5_count + 1
-                    elif (positionType == 'utr3'):
-                        utr3_count = utr3_count + 1
-
-                    txtStart = int(row[4])
-                    txtEnd = int(row[5])
-                    cdsStart = int(row[6])
-                    cdsEnd = int(row[7])
-                    exonCount = int(row[8])
-                    exonStarts =str(row[9].decode("utf-8"))
-                    exonEnds = str(row[10].decode("utf-8"))
-                    geneSymbol = str(row[12])
-                    strand = str(row[3])
-
-                    promoter_plus = txtStart - int(promoter_offset)
-                    promoter_minus = txtEnd + int(promoter_offset)
-                    region = ""
-                    pos = int(pos)
-                    exons = []
-                    exonsSt = exonStarts.split(',')
-                    exonsEn = exonEnds.split(',')
-
-                    if (cdsStart == cdsEnd):
-                        for e in range(0, exonCount):
-                            if (u.isBetween(pos, int(exonsSt[e]), int(exonsEn[e]))):
-                                exnum = e + 1
-                                if (strand == '-'):
-                                    exnum = exonCount - e
-                                exons.append("non_coding_exon=" + "ex" + \
-                                    str(exnum) + '/' + str(exonCount))
-                        if (len(exons) > 0):
-                            region = ";".join(exons)
-                    elif (u.isBetween(pos, cdsStart, cdsEnd)):
-                        for e in range(0, exonCount):
-                            if u.isBetween(pos, int(exonsSt[e]), int(exonsEn[e])):
-                                exnum = e + 1
-                                if (strand == '-'):
-                                    exnum = exonCount - e
-                                exons.append("exon=" +  "ex" + \
-                                    str(exnum) + '/' + str(exonCount))
-                                exonic_count = exonic_count + 1
-                        if (len(exons) > 0):
-                            region = ";".join(exons)
-
-                    elif (u.isBetween(pos, promoter_plus, txtStart) and 
-                        (strand == "+")):
-                        sql = 'select chrom, chromStart, chromEnd, name from ' + \
-                            'cpgIslandExt where chrom="' + str(chr) + \
-                            '" AND (chromStart <= ' + str(pos) + \
-                            ' AND ' + str(pos) + ' <= chromEnd);'
-                        cursor.execute(sql)
-                        rows = cursor.fetchone()
-
-                        if (rows is not None):
-                            region = 'putativePromoterRegion=' + \
-                                "".join(str(rows[3]).split())
-                            promoter_count = promoter_count + 1
-
-                    elif (u.isBetween(pos, txtEnd, promoter_minus) and (strand == "-")):
-                        sql = 'select chrom, chromStart, chromEnd, name from ' + \
-                            'cpgIslandExt where chrom="' + str(chr) + \
-                            '" AND (chromStart <= ' + str(pos) + \
-                            ' AND ' + str(pos) + ' <= chromEnd);'
-                        cursor.execute(sql)
-
-                        rows = cursor.fetchone()
-                        if (rows is not None):
-                            region = 'putativePromoterRegion=' +  \
-                                "".join(str(rows[3]).split())
-                            promoter_count = promoter_count + 1
-
-                    else:
-                        region = ''
-
-                    if (region != ''):
-                        info.append(collapseGeneNames(row=row, 
-                            indices=indicesKnownGenes, region=region, cnt=cnt))
-
-                    cnt = cnt + 1
-
-                str_info = ";".join(info)
-                fields[7] = fields[7] + ';' + str_info
-                fh_out.write('\t'.join(fields) + '\n')
-
-            else:
-                fields[7] = fields[7] + ";positionType=interGenic"
-                fh_out.write('\t'.join(fields) + '\n')
-                interGenic_count = interGenic_count + 1
+class TranscriptModel(object):
+    __slots__ = ['txStart', 'txEnd', 'cdsStart', 'cdsEnd', 'exonCount', 
+        'strand', 'starts', 'ends', 'endsSorted', 'islands']
+
+    def __init__(self, row):
+        self.txStart = int(row[4])
+        self.txEnd = int(row[5])
+        self.cdsStart = int(row[6])
+        self.cdsEnd = int(row[7])
+        self.exonCount = int(row[8])
+        self.strand = str(row[3])
+        exonsSt = str(row[9].decode("utf-8")).split(',')
+        exonsEn = str(row[10].decode("utf-8")).split(',')
+        self.starts = [int(exonsSt[e]) for e in range(0, self.exonCount)]
+        self.ends = [int(exonsEn[e]) for e in range(0, self.exonCount)]
+        self.endsSorted = self.starts == sorted(self.starts) and \
+            self.ends == sorted(self.ends)
+        self.islands = {}
+
+    """Indices of the exons containing pos, in exon order
+    """
+    def exonsAt(self, pos):
+        if not self.endsSorted:
+            return [e for e in range(0, self.exonCount) 
+                if u.isBetween(pos, self.starts[e], self.ends[e])]
+
+        e = bisect.bisect_right(self.starts, pos) - 1
+        exons = []
+        while (e >= 0 and self.ends[e] >= pos):
+            exons.append(e)
+            e = e - 1
+        exons.reverse()
+        return exons
+
+
+"""Transcript models of this process, by refGene row, the least recently
+   used first; at most MAX_TRANSCRIPT_MODELS are kept. Their CpG islands
+   come from the reference of the current run, so driver.run() drops them
+   all first (see clearTranscriptModels). Lookups in flight share them.
+"""
+MAX_TRANSCRIPT_MODELS = 100000
+TRANSCRIPT_MODELS = collections.OrderedDict()
+TRANSCRIPT_MODELS_LOCK = threading.Lock()
+
+def transcriptModel(row):
+    with TRANSCRIPT_MODELS_LOCK:
+        model = TRANSCRIPT_MODELS.get(row)
+        if (model is not None):
+            TRANSCRIPT_MODELS.move_to_end(row)
+            return model
+    model = TranscriptModel(row)
+    with TRANSCRIPT_MODELS_LOCK:
+        TRANSCRIPT_MODELS[row] = model
+        if (len(TRANSCRIPT_MODELS) > MAX_TRANSCRIPT_MODELS):
+            TRANSCRIPT_MODELS.popitem(last=False)
+    return model
+
+
+"""Drops the transcript models of this process, and the CpG islands they
+   hold; a process that runs job after job may be given another reference
+   or snapshot by the next one
+"""
+def clearTranscriptModels():
+    with TRANSCRIPT_MODELS_LOCK:
+        TRANSCRIPT_MODELS.clear()
 
-            linenum = linenum + 1
 
+"""Get information about location in gene structures
+"""
+class GeneAnnotator(Annotator):
+    countPositionTypes = True
+
+    def __init__(self, cursor, format='vcf', table='refGene', 
+        promoter_offset=500, snapshot=None):
+        Annotator.__init__(self, cursor, format=format, table=table, 
+            snapshot=snapshot)
+        self.promoter_offset = promoter_offset
+        self.counts = dict([(k, 0) for (k, label) in GENE_LOCATION_COUNTS])
+
+    def cacheName(self):
+        return Annotator.cacheName(self) + ':' + str(self.promoter_offset)
+
+    def isHeader(self, line):
+        return line.startswith("#")
+
+    def lookup(self, fields):
+        (chr, pos, ref, alt) = self.locus(fields)
+        chr = vt.ucscChrom(chr)
+        if self.fromSnapshot():
+            rows = self.snapshot.overlapping(self.table, chr, int(pos), 
+                offset=int(self.promoter_offset))
         else:
-            fh_out.write(line + '\n')
-
-    print("Variants located:")
-    fh_log.write("Variants located:\n")
-
-    print(f"In interGenic {str(interGenic_count)}")
-    fh_log.write(f"In interGenic {str(interGenic_count)}\n")
-
-    print(f"In CDS {str(cds_count)}")
-    fh_log.write(f"In CDS {str(cds_count)}\n")
-
-    print(f"In \'3 UTR {str(utr3_count)}")
-    fh_log.write(f"In \'3 UTR {str(utr3_count)}\n")
-
-    print(f"In \'5 UTR {str(utr5_count)}")
-    fh_log.write(f"In \'5 UTR {str(utr5_count)}\n")
+            offset = int(self.promoter_offset)
+            (binned, bins) = bn.binPredicate(self.cursor, self.table, 
+                int(pos) - offset, int(pos) + offset)
+            self.cursor.execute('select * from ' + self.table + \
+                ' where chrom=%s AND ' + binned + '(txStart - %s) <= %s ' + \
+                'AND %s <= (txEnd + %s);', 
+                [chr] + bins + [offset, int(pos), int(pos), offset])
+            rows = self.cursor.fetchall()
+
+        # each hit is (row, region, location counters to bump)
+        hits = []
+        for row in rows:
+            region, located = self.locate(chr, int(pos), row)
+            hits.append((row, region, located))
+        return hits
+
+    """Name of the CpG island the promoter position falls in, or None. 
+       The islands overlapping the transcript's promoter window are 
+       fetched once and kept in its model; the first one (in table order) 
+       containing pos is the one the per-position query would return.
+    """
+    def cpgIsland(self, chr, pos, model):
+        if (model.strand == '+'):
+            window = (model.txStart - int(self.promoter_offset), model.txStart)
+        else:
+            window = (model.txEnd, model.txEnd + int(self.promoter_offset))
+
+        key = (chr, window)
+        if key not in model.islands:
+            model.islands[key] = self.cpgIslands(chr, window[0], window[1])
+
+        for (start, end, name) in model.islands[key]:
+            if u.isBetween(pos, start, end):
+                return "".join(str(name).split())
+        return None
+
+    """(start, end, name) of the CpG islands overlapping [start, end]
+    """
+    def cpgIslands(self, chr, start, end):
+        if self.fromSnapshot('cpgIslandExt'):
+            rows = self.snapshot.overlappingRange('cpgIslandExt', chr, start,
+                end, columns=['chrom', 'chromStart', 'chromEnd', 'name'])
+        else:
+            (binned, bins) = bn.binPredicate(self.cursor, 'cpgIslandExt', 
+                start, end)
+            self.cursor.execute('select chrom, chromStart, chromEnd, ' + \
+                'name from cpgIslandExt where chrom=%s AND ' + binned + \
+                '(chromStart <= %s AND %s <= chromEnd);', 
+                [chr] + bins + [end, start])
+            rows = self.cursor.fetchall()
+        return [(int(row[1]), int(row[2]), row[3]) for row in rows]
+
+    def locate(self, chr, pos, row):
+        model = transcriptModel(row)
+        txtStart = model.txStart
+        txtEnd = model.txEnd
+        cdsStart = model.cdsStart
+        cdsEnd = model.cdsEnd
+        exonCount = model.exonCount
+        strand = model.strand
+
+        promoter_plus = txtStart - int(self.promoter_offset)
+        promoter_minus = txtEnd + int(self.promoter_offset)
+        region = ""
+        located = []
+        exons = []
+
+        if (cdsStart == cdsEnd):
+            for e in model.exonsAt(pos):
+                exnum = e + 1
+                if (strand == '-'):
+                    exnum = exonCount - e
+                exons.append("non_coding_exon=" + "ex" + \
+                    str(exnum) + '/' + str(exonCount))
+            if (len(exons) > 0):
+                region = ";".join(exons)
+
+        elif (u.isBetween(pos, cdsStart, cdsEnd)):
+            for e in model.exonsAt(pos):
+                exnum = e + 1
+                if (strand == '-'):
+                    exnum = exonCount - e
+                exons.append("exon=" +  "ex" + \
+                    str(exnum) + '/' + str(exonCount))
+                located.append('exonic')
+            if (len(exons) > 0):
+                region = ";".join(exons)
+
+        elif ((u.isBetween(pos, promoter_plus, txtStart) and (strand == "+")) or
+            (u.isBetween(pos, txtEnd, promoter_minus) and (strand == "-"))):
+            cpg = self.cpgIsland(chr, pos, model)
+            if (cpg is not None):
+                region = 'putativePromoterRegion=' + cpg
+                located.append('promoter')
+
+        return region, located
+
+    def apply(self, fields, hits):
+        if (len(hits) > 0):
+            if self.countPositionTypes:
+                #count location, once for every isoform
+                info_field = clean_mysql_chars(fields.info.value()).strip()
+                positionType = str(u.parse_field(info_field, 
+                    'positionType', ';', '='))
+                if positionType in POSITION_TYPE_COUNTS:
+                    key = POSITION_TYPE_COUNTS[positionType]
+                    self.counts[key] = self.counts[key] + len(hits)
 
-    print(f"In Intronic {str(intronic_count)}")
-    fh_log.write(f"In Intronic {str(intronic_count)}\n")
+            info = []
+            cnt = 1
+            for (row, region, located) in hits:
+                for key in located:
+                    self.counts[key] = self.counts[key] + 1
+                if (region != ''):
+                    info.append(collapseGeneNames(row=row, 
+                        indices=indicesKnownGenes, region=region, cnt=cnt))
+                cnt = cnt + 1
+
+            str_info = ";".join(info)
+            fields.info.append(str_info)
 
-    print(f"In Non_coding_intronic {str(non_coding_intronic_count)}")
-    fh_log.write(f"In Non_coding_intronic {str(non_coding_intronic_count)}\n")
+        else:
+            fields.info.append("positionType=interGenic")
+            self.counts['interGenic'] = self.counts['interGenic'] + 1
 
-    print(f"In Exonic {str(exonic_count)}")
-    fh_log.write(f"In Exonic {str(exonic_count)}\n")
+    def writeLog(self, fh_log):
+        print("Variants located:")
+        fh_log.write("Variants located:\n")
+        for (key, label) in GENE_LOCATION_COUNTS:
+            print(f"{label} {str(self.counts[key])}")
+            fh_log.write(f"{label} {str(self.counts[key])}\n")
 
-    print(f"In Non_coding_exonic {str(non_coding_exonic_count)}")
-    fh_log.write(f"In Non_coding_exonic {str(non_coding_exonic_count)}\n")
 
-    print(f"In Putative Promoter Region {str(promoter_count)}")
-    fh_log.write(f"In Putative Promoter Region {str(promoter_count)}\n")
+def getGenes(vcf, format='vcf', table='refGene', promoter_offset=500, 
+    tmpextin='.2', tmpextout='.3', sep='\t', depth=1, cache=None):
 
-    fh_out.close()
-    fh_log.close()
-    fh.close()
+    conn = u.db_connect()
+    runStage(GeneAnnotator(conn.cursor(), format=format, table=table, 
+        promoter_offset=promoter_offset), vcf, tmpextin, tmpextout, sep=sep, 
+        depth=depth, cache=cache)
     conn.close()
 
 
 """Method used in INDELS, where bigRefGeneTable is not applicable
 """
-def getExonsEtAl(vcf, format='vcf', table='refGene', promoter_offset=500, 
-    tmpextin='.2', tmpextout='.3', sep='\t'):
-
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-    fh_out = open(outfile, "w")
-
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-
-    interGenic_count = 0
-    cds_count = 0
-    utr3_count = 0
-    utr5_count = 0
-    intronic_count = 0
-    non_coding_intronic_count = 0
-    exonic_count = 0
-    non_coding_exonic_count = 0
-    promoter_count = 0
-
-    inds = getFormatSpecificIndices(format=format)
-    fh = open(vcf)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        if not line.startswith("#"):
-            fields = line.split(sep)
-            chr = fields[inds[0]].strip()
-            
-            if not chr.startswith("chr"):
-                chr = "chr" + chr
-            
-            pos = fields[inds[1]].strip()
-            ref = clean_mysql_chars(fields[inds[2]]).strip()
-            alt = clean_mysql_chars(fields[inds[3]]).strip()
-            info_field = clean_mysql_chars(fields[7]).strip()
-            this_gene_name = str(u.parse_field(info_field, 'name', ';', '='))
-
-            sql = 'select * from ' + table + ' where chrom="' + str(chr) + \
-                '"   AND (txStart - ' + str(promoter_offset) + ') <= ' + \
-                str(pos) + ' AND ' + str(pos) + ' <= (txEnd + ' + \
-                str(promoter_offset) +');'
-            cursor.execute(sql)
-            rows = cursor.fetchall()
-            info = []
-            if (len(rows) > 0):
-                cnt = 1
-                for row in rows:
-                    txtStart = int(row[4])
-                    txtEnd = int(row[5])
-                    cdsStart = int(row[6])
-                    cdsEnd = int(row[7])
-                    exonCount = int(row[8])
-                    exonStarts =str(row[9].decode('utf-8'))
-                    exonEnds = str(row[10].decode('utf-8'))
-                    geneSymbol = str(row[12])
-                    strand = str(row[3])
-
-                    promoter_plus = txtStart - int(promoter_offset)
-                    promoter_minus = txtEnd + int(promoter_offset)
-                    region = ""
-                    pos = int(pos)
-                    exons = []
-                    exonsSt = exonStarts.split(',')
-                    exonsEn = exonEnds.split(',')
-
-                    if (cdsStart == cdsEnd):
-                        for e in range(0, exonCount):
-                            if (u.isBetween(pos, int(exonsSt[e]), int(exonsEn[e]))):
-                                exnum = e + 1
-                                if (strand == '-'):
-                                    exnum =  exonCount - e
-                                exons.append("non_coding_exon=" + "ex" + \
-                                    str(exnum) + '/' + str(exonCount))
-                                non_coding_exonic_count = non_coding_exonic_count + 1
-                        if (len(exons) > 0):
-                            region='positionType=non_coding_exon;' + ";".join(exons)
-                        else:
-                            non_coding_intronic_count = non_coding_intronic_count + 1
-                            region = 'positionType=non_coding_intron'
-
-                    elif (u.isBetween(pos, cdsStart, cdsEnd) and (cdsStart < cdsEnd)):
-                        cds_count = cds_count + 1
-                        for e in range(0, exonCount):
-                            if (u.isBetween(pos, int(exonsSt[e]), int(exonsEn[e]))):
-                                exnum = e + 1
-                                if (strand == '-'):
-                                    exnum =  exonCount - e
-                                exons.append("exon=" + "ex" + \
-                                    str(exnum) + '/' + str(exonCount))
-                                exonic_count=exonic_count+1
-                        if (len(exons) > 0):
-                            region = 'positionType=CDS;' + ";".join(exons)
-                        else:
-                            intronic_count = intronic_count + 1
-                            region = 'positionType=CDS;' + 'intron'
-
-                    elif (u.isBetween(pos, txtStart, cdsStart) and \
-                        (cdsStart < cdsEnd) and (strand == "+")):
-                        utr5_count = utr5_count + 1
-                        region = 'positionType=utr5'
-
-                    elif (u.isBetween(pos, cdsEnd, txtEnd) and \
-                        (cdsStart < cdsEnd) (strand == "+")):
-                        utr3_count = utr3_count + 1
-                        region = 'positionType=utr3'
-
-                    elif (u.isBetween(pos, cdsEnd, txtEnd) and 
-                        (cdsStart < cdsEnd) (strand == "-")):
-                        utr5_count = utr5_count + 1
-                        region = 'positionType=utr5'
-
-                    elif (u.isBetween(pos, txtStart, cdsStart) and \
-                        (cdsStart < cdsEnd) and (strand == "-")):
-                        utr3_count = utr3_count + 1
-                        region = 'positionType=utr3'
-
-                    elif (u.isBetween(pos, promoter_plus, txtStart) and \
-                        (strand == "+")):
-                        sql = 'select chrom, chromStart, chromEnd, name ' + \
-                            'from cpgIslandExt where chrom="' + str(chr) +  \
-                            '" AND (chromStart <= ' + str(pos) + ' AND ' + \
-                            str(pos) + ' <= chromEnd);'
-                        cursor.execute(sql)
-                        rows = cursor.fetchone()
-
-                        if (rows is not None):
-                            region = 'putativePromoterRegion=' + \
-                                "".join(str(rows[3]).split())
-                            promoter_count = promoter_count + 1
-
-                    elif (u.isBetween(pos, txtEnd, promoter_minus) and \
-                        (strand == "-")):
-                        sql = 'select chrom, chromStart, chromEnd, name ' + \
-                            'from cpgIslandExt where chrom="' + str(chr) + \
-                            '" AND (chromStart <= ' + str(pos) + ' AND ' + \
-                            str(pos) + ' <= chromEnd);'
-                        cursor.execute(sql)
-                        rows = cursor.fetchone()
-
-                        if (rows is not None):
-                            region = 'putativePromoterRegion=' + \
-                            "".join(str(rows[3]).split())
-                            promoter_count = promoter_count + 1
-
-                    else:
-                        region = ''
-
-                    if (region != ''):
-                        info.append(collapseGeneNames(
-                            row=row, indices=indicesKnownGenes, 
-                            region=region, cnt=cnt))
-
-                    cnt = cnt + 1
-
-                str_info = ";".join(info)
-                fields[7] = fields[7] + ';' + str_info
-                fh_out.write('\t'.join(fields) + '\n')
-
+class ExonsEtAlAnnotator(GeneAnnotator):
+    countPositionTypes = False
+
+    def locate(self, chr, pos, row):
+        model = transcriptModel(row)
+        txtStart = model.txStart
+        txtEnd = model.txEnd
+        cdsStart = model.cdsStart
+        cdsEnd = model.cdsEnd
+        exonCount = model.exonCount
+        strand = model.strand
+
+        promoter_plus = txtStart - int(self.promoter_offset)
+        promoter_minus = txtEnd + int(self.promoter_offset)
+        region = ""
+        located = []
+        exons = []
+
+        if (cdsStart == cdsEnd):
+            for e in model.exonsAt(pos):
+                exnum = e + 1
+                if (strand == '-'):
+                    exnum =  exonCount - e
+                exons.append("non_coding_exon=" + "ex" + \
+                    str(exnum) + '/' + str(exonCount))
+                located.append('non_coding_exonic')
+            if (len(exons) > 0):
+                region='positionType=non_coding_exon;' + ";".join(exons)
+            else:
+                located.append('non_coding_intronic')
+                region = 'positionType=non_coding_intron'
+
+        elif (u.isBetween(pos, cdsStart, cdsEnd) and (cdsStart < cdsEnd)):
+            located.append('cds')
+            for e in model.exonsAt(pos):
+                exnum = e + 1
+                if (strand == '-'):
+                    exnum =  exonCount - e
+                exons.append("exon=" + "ex" + \
+                    str(exnum) + '/' + str(exonCount))
+                located.append('exonic')
+            if (len(exons) > 0):
+                region = 'positionType=CDS;' + ";".join(exons)
             else:
-                fields[7] = fields[7] + ";positionType=interGenic"
-                fh_out.write('\t'.join(fields) + '\n')
-                interGenic_count = interGenic_count + 1
+                located.append('intronic')
+                region = 'positionType=CDS;' + 'intron'
 
-            linenum = linenum + 1
+        elif (u.isBetween(pos, txtStart, cdsStart) and \
+            (cdsStart < cdsEnd) and (strand == "+")):
+            located.append('utr5')
+            region = 'positionType=utr5'
 
-        else:
-            fh_out.write(line + '\n')
+        elif (u.isBetween(pos, cdsEnd, txtEnd) and \
+            (cdsStart < cdsEnd) and (strand == "+")):
+            located.append('utr3')
+            region = 'positionType=utr3'
+
+        elif (u.isBetween(pos, cdsEnd, txtEnd) and 
+            (cdsStart < cdsEnd) and (strand == "-")):
+            located.append('utr5')
+            region = 'positionType=utr5'
 
-    print("Variants located:")
-    fh_log.write("Variants located:\n")
+        elif (u.isBetween(pos, txtStart, cdsStart) and \
+            (cdsStart < cdsEnd) and (strand == "-")):
+            located.append('utr3')
+            region = 'positionType=utr3'
 
-    print(f"In interGenic {str(interGenic_count)}")
-    fh_log.write(f"In interGenic {str(interGenic_count)}\n")
+        elif ((u.isBetween(pos, promoter_plus, txtStart) and (strand == "+")) or
+            (u.isBetween(pos, txtEnd, promoter_minus) and (strand == "-"))):
+            cpg = self.cpgIsland(chr, pos, model)
+            if (cpg is not None):
+                region = 'putativePromoterRegion=' + cpg
+                located.append('promoter')
 
-    print(f"In CDS {str(cds_count)}")
-    fh_log.write(f"In CDS {str(cds_count)}\n")
+        return region, located
 
-    print(f"In \'3 UTR {str(utr3_count)}")
-    fh_log.write(f"In \'3 UTR {str(utr3_count)}\n")
 
-    print(f"In \'5 UTR {str(utr5_count)}")
-    fh_log.write(f"In \'5 UTR {str(utr5_count)}\n")
+def getExonsEtAl(vcf, format='vcf', table='refGene', promoter_offset=500, 
+    tmpextin='.2', tmpextout='.3', sep='\t', depth=1, cache=None):
+
+    conn = u.db_connect()
+    runStage(ExonsEtAlAnnotator(conn.cursor(), format=format, table=table,
+        promoter_offset=promoter_offset), vcf, tmpextin, tmpextout, sep=sep, 
+        depth=depth, cache=cache)
+    conn.close()
 
-    print(f"In Intronic {str(intronic_count)}")
-    fh_log.write(f"In Intronic "+str(intronic_count) +'\n')
 
-    print(f"In Non_coding_intronic {str(non_coding_intronic_count)}")
-    fh_log.write(f"In Non_coding_intronic {str(non_coding_intronic_count)}\n")
+"""Base class for the addOverlapWith* annotators; counts hits per table.
 
-    print(f"In Exonic {str(exonic_count)}")
-    fh_log.write(f"In Exonic {str(exonic_count)}\n")
+   Subclasses describe their query through target() and sql(), which 
+   returns the statement and its parameters; lookup() 
+   then returns all matching rows, or only the first one (or None) when 
+   fetchone is set, as the cursor would.
+"""
+class OverlapAnnotator(Annotator):
+    fetchone = False
+    columns = None      # columns selected by sql(), None for all
+    chromName = 'chrom'
+    startName = 'chromStart'
+    endName = 'chromEnd'
+
+    def __init__(self, cursor, format='vcf', table=None, snapshot=None):
+        Annotator.__init__(self, cursor, format=format, table=table, 
+            snapshot=snapshot)
+        self.label = table
+        self.merge = None
+        self.counts = {'var_count': 0, 'line_count': 0}
+
+    """(table, chrom, pos) to look up for a record, or None to skip it
+    """
+    def target(self, fields):
+        (chr, pos, ref, alt) = self.locus(fields)
+        return (self.table, vt.ucscChrom(chr), pos)
+
+    def sql(self, table, chrom, pos):
+        (binned, bins) = self.binned(table, pos)
+        return ('select * from ' + table + ' where chrom=%s AND ' + binned + 
+            '(' + self.startName + ' <= %s AND %s <= ' + self.endName + 
+            ');', [chrom] + bins + [int(pos), int(pos)])
+
+    """bin predicate for a query on pos, see binning.binPredicate
+    """
+    def binned(self, table, pos):
+        return bn.binPredicate(self.cursor, table, pos, pos)
+
+    def lookup(self, fields):
+        target = self.target(fields)
+        if (target is None):
+            return None if self.fetchone else []
+
+        (table, chrom, pos) = target
+        if self.fromSnapshot(table):
+            rows = self.snapshot.overlapping(table, chrom, int(pos), 
+                columns=self.columns)
+            if self.fetchone:
+                return rows[0] if len(rows) > 0 else None
+            return rows
+
+        self.cursor.execute(*self.sql(table, chrom, pos))
+        if self.fetchone:
+            return self.cursor.fetchone()
+        return self.cursor.fetchall()
+
+    """With a snapshot, records are grouped by table and chromosome and 
+       each group is answered by one vectorized overlap (see overlap.py)
+    """
+    def lookupBatch(self, records):
+        if (self.merge is not None and self.merge.handles(records)):
+            return self.merge.lookupBatch(records)
+        if (self.snapshot is None):
+            return Annotator.lookupBatch(self, records)
+
+        results = [None] * len(records)
+        groups = {}
+        for i in range(0, len(records)):
+            target = self.target(records[i])
+            if (target is None or not self.fromSnapshot(target[0])):
+                results[i] = self.lookup(records[i])
+            else:
+                (table, chrom, pos) = target
+                group = groups.setdefault((table, chrom), ([], []))
+                group[0].append(i)
+                group[1].append(self.position(records[i]))
 
-    print(f"In Non_coding_exonic {str(non_coding_exonic_count)}")
-    fh_log.write(f"In Non_coding_exonic {str(non_coding_exonic_count)}\n")
+        for (table, chrom) in groups:
+            (indices, positions) = groups[(table, chrom)]
+            hits = self.snapshot.overlappingBatch(table, chrom, positions, 
+                columns=self.columns, fetchone=self.fetchone)
+            for k in range(0, len(indices)):
+                results[indices[k]] = hits[k]
+        return results
 
-    print(f"In Putative Promoter Region {str(promoter_count)}")
-    fh_log.write(f"In Putative Promoter Region {str(promoter_count)}\n")
+    def count(self, rows):
+        self.counts['line_count'] = self.counts['line_count'] + 1
+        self.counts['var_count'] = self.counts['var_count'] + rows
 
-    fh_out.close()
-    fh_log.close()
-    fh.close()
-    conn.close()
+    def writeLog(self, fh_log):
+        fh_log.write(f"In {str(self.label)}: " + \
+            f"{str(self.counts['var_count'])} in " + \
+            f"{str(self.counts['line_count'])} variants\n")
 
 
 """Overlap with tfbsConsSites
 """
-def addOverlapWithTfbsConsSites(vcf, format='vcf', table='tfbsConsSites', 
-    tmpextin='.2', tmpextout='.3', sep='\t'):
-
+class TfbsConsSitesAnnotator(OverlapAnnotator):
     allowed_chrom=['1','2','3','4','5','6','7','8','9','10','11','12','13',
         '14','15','16','17','18','19','20','21','22','X','Y']
 
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
+    columns = ['chrom', 'chromStart', 'chromEnd', 'name']
+    chromName = None
+
+    """One table per chromosome, queried without a chrom condition
+    """
+    def target(self, fields):
+        # For some reason this table has no "chr" preceeding number
+        (chr, pos, ref, alt) = self.locus(fields)
+        chrIndex = vt.ucscChrom(chr).replace('chr', '')
+        if (chrIndex not in self.allowed_chrom):
+            return None
+        return ('tfbsConsSites' + chrIndex, None, pos)
+
+    def sql(self, table, chrom, pos):
+        (binned, bins) = self.binned(table, pos)
+        return ('select chrom, chromStart, chromEnd, name from ' + table + 
+            ' where ' + binned + 'chromStart <= %s AND %s <= chromEnd;', 
+            bins + [int(pos), int(pos)])
+
+    def apply(self, fields, rows):
+        if (len(rows) > 0):
+            self.count(len(rows))
+            records = []
+            for row in rows:
+                t = str(row[3]) + '.' + str(row[0]) + '.' + \
+                    str(row[1]) + '.' + str(row[2])
+                t = t.strip()
+                records.append('tfbsRegion' + '=' + t)
+
+            fields.info.add(';'.join(records))
 
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
 
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
+def addOverlapWithTfbsConsSites(vcf, format='vcf', table='tfbsConsSites', 
+    tmpextin='.2', tmpextout='.3', sep='\t', snapshot=None, depth=1, 
+    cache=None, merge=False):
 
-    inds = getFormatSpecificIndices(format=format)
     conn = u.db_connect()
-    cursor = conn.cursor()
-
-    linenum = 1
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if (line.startswith("##")):
-            fh_out.write(line + '\n')
-
-        #header line
-        elif (line.startswith('#CHROM') or line.startswith('CHROM')):
-            fh_out.write(line + '\n')
-
-        else:
-            fields = line.split(sep)
-            chr = fields[inds[0]].strip()
-            # For some reason this table has no "chr" preceeding number
-            if not chr.startswith("chr"):
-                chr = "chr" + chr
-
-            pos=fields[inds[1]].strip()
-            isOverlap = False
-            chrIndex=chr.replace('chr', '')
-
-            if (chrIndex in allowed_chrom):
-                isOverlap = False
-                sql = 'select chrom, chromStart, chromEnd, name ' + \
-                    'from tfbsConsSites' + chrIndex + \
-                    ' where  chromStart <= ' + str(pos) + ' AND ' + \
-                    str(pos) + ' <= chromEnd;'
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-                records = []
-
-                if (len(rows) > 0):
-                    records_count = 1
-                    line_count = line_count + 1
-
-                    for row in rows:
-                        var_count = var_count + 1
-                        t = str(row[3]) + '.' + str(row[0]) + '.' + \
-                            str(row[1]) + '.' + str(row[2])
-                        t = t.strip()
-                        records.append('tfbsRegion' + '=' + t)
-                        records_count = records_count + 1
-
-                    if str(fields[7]).endswith(';'):
-                        fields[7] = fields[7] + ';'.join(records)
-                    else:
-                        fields[7] = fields[7] + ';' + ';'.join(records)
-
-                    fh_out.write('\t'.join(fields) + '\n')
-
-                else: # chrom is not on the list
-                    fh_out.write(line + '\n')
-
-            else: # chrom is not on the list
-                fh_out.write(line + '\n')
-
-        linenum = linenum + 1
-
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
-
+    runStage(TfbsConsSitesAnnotator(conn.cursor(), format=format, 
+        table=table, snapshot=snapshot), vcf, tmpextin, tmpextout, 
+        sep=sep, depth=depth, cache=cache, merge=merge)
     conn.close()
-    fh.close()
-    fh_out.close()
 
 
 """Overlap with GadAll table
 """
-def addOverlapWithGadAll(vcf, format='vcf', table='gadAll', tmpextin='', 
-    tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
+class GadAllAnnotator(OverlapAnnotator):
+    chromName = 'chromosome'
+
+    def target(self, fields):
+        (chr, pos, ref, alt) = self.locus(fields)
+        # For some reason this table has no "chr" preceeding number
+        return (self.table, vt.bareChrom(chr), pos)
+
+    def sql(self, table, chrom, pos):
+        (binned, bins) = self.binned(table, pos)
+        return ('select * from ' + table + ' where chromosome=%s AND ' + 
+            binned + '(chromStart <= %s AND %s <= chromEnd);', 
+            [chrom] + bins + [int(pos), int(pos)])
+
+    def apply(self, fields, rows):
+        if (len(rows) > 0):
+            self.count(len(rows))
+            records = []
+            r_tmp = []
+            for row in rows:
+                if not fu.isOnTheList(r_tmp, str(row[3])):
+                    r_tmp.append(str(row[3]))
+                    records.append(str(self.table) + '=' + str(row[3]))
+            fields.info.add(';'.join(records))
+
+            # annotated lines have always been written with '\t ' between 
+            # columns; later stages (and users) see the extra space
+            fields.padColumns()
 
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
 
-    logcountfile = basefile+'.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
+def addOverlapWithGadAll(vcf, format='vcf', table='gadAll', tmpextin='', 
+    tmpextout='.1', sep='\t', snapshot=None, depth=1, cache=None, 
+    merge=False):
 
-    inds = getFormatSpecificIndices(format=format)
     conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                # For some reason this table has no "chr" preceeding number
-                if chr.startswith("chr"):
-                    chr = str(chr).replace("chr", "")
-
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-
-                sql = 'select * from ' + table + ' where chromosome="' + \
-                    str(chr) + '" AND (chromStart <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= chromEnd);'
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-                records = []
-
-                if (len(rows) > 0):
-                    records_count = 1
-                    line_count = line_count + 1
-                    r_tmp = []
-                    for row in rows:
-                        var_count = var_count + 1
-                        if not fu.isOnTheList(r_tmp, str(row[3])):
-                            r_tmp.append(str(row[3]) )
-                            records.append(str(table) + '=' + str(row[3]))
-                            records_count = records_count + 1
-                    if str(fields[7]).endswith(';'):
-                        fields[7] = fields[7] + ';'.join(records)
-                    else:
-                        fields[7] = fields[7] + ';' + ';'.join(records)
-                    fh_out.write('\t '.join(fields) + '\n')
-                else:
-                    fh_out.write(line + '\n')
-
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
-
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
-
+    runStage(GadAllAnnotator(conn.cursor(), format=format, table=table, 
+        snapshot=snapshot), vcf, tmpextin, tmpextout, sep=sep, 
+        depth=depth, cache=cache, merge=merge)
     conn.close()
-    fh.close()
-    fh_out.close()
 
 
 """ Overlap with gwasCatalog table """
-def addOverlapWithGwasCatalog(vcf, format='vcf', table='gwasCatalog', \
-    tmpextin='', tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
+class GwasCatalogAnnotator(OverlapAnnotator):
+    startName = 'chromEnd'      # matched on chromEnd alone
 
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
+    def sql(self, table, chrom, pos):
+        (binned, bins) = self.binned(table, pos)
+        return ('select * from ' + table + ' where chrom=%s AND ' + binned + 
+            'chromEnd = %s;', [chrom] + bins + [int(pos)])
 
-    logcountfile = basefile+'.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
+    def apply(self, fields, rows):
+        if (len(rows) > 0):
+            self.count(len(rows))
+            records = []
+            for row in rows:
+                records.append(str(self.table) + '=' + str('pubMedID') + \
+                    '=' + str(row[5]) + ',trait=' + str(row[10]))
+            fields.info.add(';'.join(records))
 
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-                
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-
-                sql = 'select * from ' + table + ' where chrom="' + \
-                    str(chr) + '" AND chromEnd = ' + str(pos) + ';'
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-                records = []
-
-                if (len(rows) > 0):
-                    line_count = line_count + 1
-                    records_count = 1
-                    for row in rows:
-                        var_count = var_count + 1
-                        records.append(str(table) + '=' + str('pubMedID') + \
-                            '=' + str(row[5]) + ',trait=' + str(row[10]))
-                        records_count = records_count + 1
-                    if str(fields[7]).endswith(';'):
-                        fields[7] = fields[7] + ';'.join(records)
-                    else:
-                        fields[7] = fields[7] + ';' + ';'.join(records)
-                    fh_out.write('\t'.join(fields) + '\n')
-                else:
-                    fh_out.write(line + '\n')
-
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
 
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
+def addOverlapWithGwasCatalog(vcf, format='vcf', table='gwasCatalog', \
+    tmpextin='', tmpextout='.1', sep='\t', snapshot=None, depth=1, cache=None, 
+    merge=False):
 
+    conn = u.db_connect()
+    runStage(GwasCatalogAnnotator(conn.cursor(), format=format, 
+        table=table, snapshot=snapshot), vcf, tmpextin, tmpextout, 
+        sep=sep, depth=depth, cache=cache, merge=merge)
     conn.close()
-    fh.close()
-    fh_out.close()
 
 
 """Overlap with HUGO Gene Nomenclature Committee (HGNC) table
 """
-def addOverlapWitHUGOGeneNomenclature(vcf, format='vcf', table='hugo', 
-    tmpextin='', tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
+class HugoGeneNomenclatureAnnotator(OverlapAnnotator):
 
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
+    def apply(self, fields, rows):
+        if (len(rows) > 0):
+            self.count(len(rows))
+            records = []
+            r_tmp = []
+            for row in rows:
+                t = str(str(row[5]) + ',' + str(row[6])).strip()
+                if not fu.isOnTheList(r_tmp, t):
+                    r_tmp.append(t)
+                    records.append('HGNC_GeneAnnotation' + '=' + t)
 
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
+            records_str = ','.join(records).replace(';', ',')
 
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-
-                pos=fields[inds[1]].strip()
-                isOverlap = False
-
-                sql = 'select * from ' + table + ' where chrom="' + \
-                    str(chr) + '" AND (chromStart <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= chromEnd);'
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-                records = []
-
-                if (len(rows) > 0):
-                    line_count = line_count + 1
-                    records_count = 1
-                    r_tmp = []
-                    for row in rows:
-                        var_count = var_count + 1
-                        t = str(str(row[5]) + ',' + str(row[6])).strip()
-                        if not fu.isOnTheList(r_tmp, t):
-                            r_tmp.append(t)
-                            records.append('HGNC_GeneAnnotation' + '=' + t)
-                        records_count = records_count + 1
-
-                    records_str = ','.join(records).replace(';', ',')
-
-                    if str(fields[7]).endswith(';'):
-                        fields[7] = fields[7] +records_str
-                    else:
-                        fields[7] = fields[7] + ';' + records_str
-                    fh_out.write('\t'.join(fields) + '\n')
-                else:
-                    fh_out.write(line + '\n')
-
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
+            fields.info.add(records_str)
 
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
 
+def addOverlapWitHUGOGeneNomenclature(vcf, format='vcf', table='hugo', 
+    tmpextin='', tmpextout='.1', sep='\t', snapshot=None, depth=1, cache=None, 
+    merge=False):
+
+    conn = u.db_connect()
+    runStage(HugoGeneNomenclatureAnnotator(conn.cursor(), format=format, 
+        table=table, snapshot=snapshot), vcf, tmpextin, tmpextout, 
+        sep=sep, depth=depth, cache=cache, merge=merge)
     conn.close()
-    fh.close()
-    fh_out.close()
 
 
 """Overlap with segdup regions genomicSuperDups
 """
-def addOverlapWithGenomicSuperDups(vcf, format='vcf', 
-    table='genomicSuperDups', tmpextin='', tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
+class GenomicSuperDupsAnnotator(OverlapAnnotator):
 
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
+    fetchone = True
 
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
+    def apply(self, fields, row):
+        if row is not None:
+            self.count(1)
+            isOverlap = True
+            otherChrom = row[7]
+            otherStart = row[8]
+            otherEnd = row[9]
+            fields.info.append(str(self.table) + '=' + str(isOverlap) + 
+                ';' + 'otherChrom=' + str(otherChrom) + ';otherStart=' + 
+                str(otherStart) + ';otherEnd=' + str(otherEnd))
 
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-                otherChrom = ''
-                otherStart = ''
-                otherEnd = ''
-                l = str(isOverlap)
-
-                sql = 'select * from ' + table + ' where chrom="'+ str(chr) + \
-                    '" AND (chromStart <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= chromEnd);'
-                cursor.execute(sql)
-                rows = cursor.fetchone()
-
-                if rows is not None:
-                    line_count = line_count + 1
-                    var_count = var_count + 1
-                    isOverlap = True
-                    otherChrom = rows[7]
-                    otherStart = rows[8]
-                    otherEnd = rows[9]
-                    fields[7] = fields[7] + ';' + str(table) + '=' + \
-                        str(isOverlap) + ';' + 'otherChrom=' + \
-                        str(otherChrom) + ';otherStart=' + \
-                        str(otherStart) + ';otherEnd=' + str(otherEnd)
-
-                fh_out.write('\t'.join(fields) + '\n')
-
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
 
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
+def addOverlapWithGenomicSuperDups(vcf, format='vcf', 
+    table='genomicSuperDups', tmpextin='', tmpextout='.1', sep='\t', 
+    snapshot=None, depth=1, cache=None, merge=False):
 
+    conn = u.db_connect()
+    runStage(GenomicSuperDupsAnnotator(conn.cursor(), format=format, 
+        table=table, snapshot=snapshot), vcf, tmpextin, tmpextout, 
+        sep=sep, depth=depth, cache=cache, merge=merge)
     conn.close()
-    fh.close()
-    fh_out.close()
 
 
 """Searches Genes Databases and returns Genes/Cytobands 
    with which SNP or INDEL overlaps
 """
-def addOverlapWithRefGene(vcf, format='vcf', table='refGene', 
-    tmpextin='', tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
+class RefGeneOverlapAnnotator(OverlapAnnotator):
     colindex = 1
     colindex2 = 12
     name = 'name'
@@ -1131,273 +1308,122 @@ def addOverlapWithRefGene(vcf, format='vcf', table='refGene',
     startName = 'txStart'
     endName = 'txEnd'
 
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-                
-                sql = 'select * from ' + table + ' where chrom="' + \
-                    str(chr) + '" AND (' + startName + ' <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= ' + endName +');'
-                overlapsWith = []
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-
-                if (len(rows) > 0):
-                    line_count = line_count + 1
-                    for row in rows:
-                        var_count = var_count + 1
-                        overlapsWith.append(name2 + '=' + \
-                            str(row[colindex2]) + ';' + name + '=' + \
-                            str(row[colindex]))
-
-                    genes = ';'.join([str(x) for x in overlapsWith])
-                    if str(fields[7]).endswith(";"):
-                        fields[7] = fields[7] + str(genes)
-                    else:
-                        fields[7] = fields[7] + ';' + str(genes)
-                fh_out.write('\t'.join(fields) + '\n')
-
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
+    def apply(self, fields, rows):
+        if (len(rows) > 0):
+            self.count(len(rows))
+            overlapsWith = []
+            for row in rows:
+                overlapsWith.append(self.name2 + '=' + \
+                    str(row[self.colindex2]) + ';' + self.name + '=' + \
+                    str(row[self.colindex]))
 
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
+            genes = ';'.join([str(x) for x in overlapsWith])
+            fields.info.add(str(genes))
+
+
+def addOverlapWithRefGene(vcf, format='vcf', table='refGene', 
+    tmpextin='', tmpextout='.1', sep='\t', snapshot=None, depth=1, cache=None, 
+    merge=False):
 
+    conn = u.db_connect()
+    runStage(RefGeneOverlapAnnotator(conn.cursor(), format=format, 
+        table=table, snapshot=snapshot), vcf, tmpextin, tmpextout, 
+        sep=sep, depth=depth, cache=cache, merge=merge)
     conn.close()
-    fh.close()
-    fh_out.close()
 
 
 """Method to find overlap with Cytoband table
 """
-def addOverlapWithCytoband(vcf, format='vcf', table='cytoBand', 
-    tmpextin='', tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
-
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
-    colindex = 12
-    startName = 'txStart'
-    endName = 'txEnd'
+class CytobandAnnotator(OverlapAnnotator):
 
-    if (table == 'cytoBand'):
-        colindex = 3
-        startName = 'chromStart'
-        endName = 'chromEnd'
+    def __init__(self, cursor, format='vcf', table='cytoBand', snapshot=None):
+        OverlapAnnotator.__init__(self, cursor, format=format, table=table, 
+            snapshot=snapshot)
+        self.colindex = 12
+        self.startName = 'txStart'
+        self.endName = 'txEnd'
 
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-                
-                sql = 'select * from ' + table + ' where chrom="' + \
-                    str(chr) + '" AND (' + startName + ' <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= ' + endName + ');'
-                overlapsWith = []
-                cursor.execute(sql)
-                rows = cursor.fetchall()
-
-                if (len(rows) > 0):
-                    line_count = line_count + 1
-                    for row in rows:
-                        var_count = var_count + 1
-                        overlapsWith.append(str(row[colindex]))
-                    overlapsWith = u.dedup(overlapsWith)
-                    cytoband = ';'.join([str(x) for x in overlapsWith])
-
-                    if str(fields[7]).endswith(";"):
-                        fields[7] = fields[7] + str(table) + '=' + str(cytoband)
-                    else:
-                        fields[7] = fields[7] + ';' + str(table) + '=' + str(cytoband)
-                fh_out.write('\t'.join(fields) + '\n')
-
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
+        if (table == 'cytoBand'):
+            self.colindex = 3
+            self.startName = 'chromStart'
+            self.endName = 'chromEnd'
 
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
+    def apply(self, fields, rows):
+        if (len(rows) > 0):
+            self.count(len(rows))
+            overlapsWith = []
+            for row in rows:
+                overlapsWith.append(str(row[self.colindex]))
+            overlapsWith = u.dedup(overlapsWith)
+            cytoband = ';'.join([str(x) for x in overlapsWith])
+
+            fields.info.add(str(self.table) + '=' + str(cytoband))
 
+
+def addOverlapWithCytoband(vcf, format='vcf', table='cytoBand', 
+    tmpextin='', tmpextout='.1', sep='\t', snapshot=None, depth=1, cache=None, 
+    merge=False):
+
+    conn = u.db_connect()
+    runStage(CytobandAnnotator(conn.cursor(), format=format, table=table, 
+        snapshot=snapshot), vcf, tmpextin, tmpextout, sep=sep, 
+        depth=depth, cache=cache, merge=merge)
     conn.close()
-    fh.close()
-    fh_out.close()
 
 
 """Method to find overlap with CNV tables
 """
-def addOverlapWithCnvDatabase(vcf, format='vcf', table='dgv_Cnv', 
-    tmpextin='', tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
+class CnvDatabaseAnnotator(OverlapAnnotator):
 
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
+    fetchone = True
 
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
+    def apply(self, fields, row):
+        if row is not None:
+            self.count(1)
+            isOverlap = True
+            fields.info.add(str(self.table) + '=' + str(isOverlap))
 
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-
-                pos = fields[inds[1]].strip()
-                isOverlap = False
-                sql = 'select * from ' + table + ' where chrom="' + \
-                    str(chr) + '" AND (chromStart <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= chromEnd);'
-                cursor.execute(sql)
-                rows = cursor.fetchone()
-
-                if rows is not None:
-                    line_count = line_count + 1
-                    var_count = var_count + 1
-                    isOverlap = True
-                    if str(fields[7]).endswith(";"):
-                        fields[7] = fields[7] + str(table) + '=' + \
-                        str(isOverlap)
-                    else:
-                        fields[7] = fields[7] + ';' + str(table) + \
-                        '='+str(isOverlap)
-                fh_out.write('\t'.join(fields) + '\n')
-
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
 
-    fh_log.write(f"In {str(table)}: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
+def addOverlapWithCnvDatabase(vcf, format='vcf', table='dgv_Cnv', 
+    tmpextin='', tmpextout='.1', sep='\t', snapshot=None, depth=1, cache=None, 
+    merge=False):
 
+    conn = u.db_connect()
+    runStage(CnvDatabaseAnnotator(conn.cursor(), format=format, table=table, 
+        snapshot=snapshot), vcf, tmpextin, tmpextout, sep=sep, 
+        depth=depth, cache=cache, merge=merge)
     conn.close()
-    fh.close()
-    fh_out.close()
 
 
 """Method to find overlap with targetScanS tables
 """
-def addOverlapWithMiRNA(vcf, format='vcf', table='targetScanS', 
-    tmpextin='', tmpextout='.1', sep='\t'):
-    
-    basefile = vcf
-    vcf = basefile + tmpextin
-    outfile = basefile + tmpextout
+class MiRNAAnnotator(OverlapAnnotator):
 
-    fh_out = open(outfile, "w")
-    fh = open(vcf)
+    def __init__(self, cursor, format='vcf', table='targetScanS', 
+        snapshot=None):
+        OverlapAnnotator.__init__(self, cursor, format=format, table=table, 
+            snapshot=snapshot)
+        self.label = 'miRNAsites'
 
-    logcountfile = basefile + '.count.log'
-    fh_log = open(logcountfile, 'a')
-    var_count = 0
-    line_count = 0
+    fetchone = True
 
-    inds = getFormatSpecificIndices(format=format)
-    conn = u.db_connect()
-    cursor = conn.cursor()
-    linenum = 1
-
-    for line in fh:
-        line = line.strip()
-        ## not comments
-        if not line.startswith("##"):
-            #header line
-            if (line.startswith('CHROM') or line.startswith('#CHROM')):
-                fh_out.write(line + '\n')
-            else:
-                fields = line.split(sep)
-                chr = fields[inds[0]].strip()
-                if not chr.startswith("chr"):
-                    chr = "chr" + chr
-
-                pos = fields[inds[1]].strip()
-                sql = 'select * from ' + table + ' where chrom="' + \
-                    str(chr) + '" AND (chromStart <= ' + str(pos) + \
-                    ' AND ' + str(pos) + ' <= chromEnd);'
-                cursor.execute(sql)
-                rows = cursor.fetchone()
-
-                if rows is not None:
-                    line_count = line_count + 1
-                    var_count = var_count + 1
-                    t = str(rows[4]) + ',' +  str(rows[1]) + '_' + \
-                        str(rows[2]) + '_' + str(rows[3])
-                    t = 'miRNAsites=' + t.strip()
-                    if str(fields[7]).endswith(";"):
-                        fields[7] = fields[7] + t
-                    else:
-                        fields[7] = fields[7] + ';' + t
-                fh_out.write('\t'.join(fields) + '\n')
-
-            linenum = linenum + 1
-        else:
-            fh_out.write(line + '\n')
+    def apply(self, fields, row):
+        if row is not None:
+            self.count(1)
+            t = str(row[4]) + ',' +  str(row[1]) + '_' + \
+                str(row[2]) + '_' + str(row[3])
+            t = 'miRNAsites=' + t.strip()
+            fields.info.add(t)
 
-    fh_log.write(f"In miRNAsites: {str(var_count)} in " + \
-        f"{str(line_count)} variants\n")
-    fh_log.close()
 
+def addOverlapWithMiRNA(vcf, format='vcf', table='targetScanS', 
+    tmpextin='', tmpextout='.1', sep='\t', snapshot=None, depth=1, cache=None, 
+    merge=False):
+
+    conn = u.db_connect()
+    runStage(MiRNAAnnotator(conn.cursor(), format=format, table=table, 
+        snapshot=snapshot), vcf, tmpextin, tmpextout, sep=sep, 
+        depth=depth, cache=cache, merge=merge)
     conn.close()
-    fh.close()
-    fh_out.close()
 
-### EOF
\ No newline at end of file
+### EOF
@@ -0,0 +1,301 @@
+# backends.py
+#
+# Reference database backends. The annotators only need DB-API connections
+# whose cursors run their SQL (execute, fetchone, fetchall, description);
+# a backend is where the connection pool in utils.py gets them from.
+# Statements are written with pymysql's %s placeholders; SQLite cursors
+# take them as ? and keep each statement prepared in the connection's
+# statement cache.
+#
+#   MySqlBackend   RDS, credentials from Secrets Manager (the default)
+#   SqliteBackend  a local SQLite file, e.g. one made by 'load' below
+#   MemoryBackend  an in-memory SQLite copy of a SQLite file or of table
+#                  dumps, loaded once per process
+#
+# Table dumps are the UCSC / mysqldump --tab layout: <table>.sql holds the
+# CREATE TABLE statement, <table>.txt (or .txt.gz) the rows, tab separated,
+# with \N for NULL.
+#
+# Usage: python backends.py load <sqlite_file> <dump_dir> [table ...]
+#
+##
+
+import os
+import re
+import sys
+import gzip
+import sqlite3
+import itertools
+import functools
+import pymysql.cursors
+
+import utils as u
+
+BACKENDS = ['mysql', 'sqlite', 'memory']
+
+"""Rows per executemany() when loading dumps
+"""
+LOAD_CHUNK = 10000
+
+
+class Backend(object):
+    name = None
+
+    """New connection to the reference database; the pool pings it with
+       ping(reconnect=False) and ends transactions with rollback()
+    """
+    def connect(self):
+        raise NotImplementedError
+
+    def describe(self):
+        return self.name
+
+
+class MySqlBackend(Backend):
+    name = 'mysql'
+
+    def connect(self):
+        return u.new_connection()
+
+
+"""sqlite3 spelling of a statement with %s placeholders
+"""
+@functools.lru_cache(maxsize=1024)
+def qmark(sql):
+    return sql.replace('%s', '?')
+
+
+class SqliteCursor(object):
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+    def execute(self, sql, params=()):
+        return self.cursor.execute(qmark(sql), params)
+
+    def executemany(self, sql, params):
+        return self.cursor.executemany(qmark(sql), params)
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+
+"""sqlite3 connection with the ping() the pool expects, and cursors that 
+   take %s placeholders
+"""
+class SqliteConnection(object):
+    def __init__(self, conn):
+        self.conn = conn
+
+    def cursor(self):
+        return SqliteCursor(self.conn.cursor())
+
+    def streamingCursor(self):
+        return self.cursor()
+
+    def ping(self, reconnect=False):
+        self.conn.execute('select 1').fetchall()
+
+    def __getattr__(self, name):
+        return getattr(self.conn, name)
+
+
+class SqliteBackend(Backend):
+    name = 'sqlite'
+
+    def __init__(self, path):
+        if not os.path.isfile(path):
+            raise ValueError(f"No SQLite reference database at {path}")
+        self.path = path
+
+    def connect(self):
+        return SqliteConnection(sqlite3.connect(
+            'file:' + os.path.abspath(self.path) + '?mode=ro', uri=True,
+            check_same_thread=False))
+
+    def describe(self):
+        return f"sqlite {self.path}"
+
+
+"""Shared-cache in-memory SQLite database, filled from source (a SQLite
+   file or a dump directory) the first time a process connects. One
+   connection is held open to keep the database alive.
+"""
+class MemoryBackend(Backend):
+    name = 'memory'
+
+    def __init__(self, source):
+        if not os.path.exists(source):
+            raise ValueError(f"No reference database or dumps at {source}")
+        self.source = source
+        self.keeper = None
+        self.pid = None
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state['keeper'] = None
+        state['pid'] = None
+        return state
+
+    def uri(self):
+        return f"file:anntools{os.getpid()}?mode=memory&cache=shared"
+
+    def connect(self):
+        if (self.keeper is None or self.pid != os.getpid()):
+            self.keeper = sqlite3.connect(self.uri(), uri=True,
+                check_same_thread=False)
+            if os.path.isdir(self.source):
+                loadDumps(self.keeper, self.source)
+            else:
+                source = sqlite3.connect(self.source)
+                source.backup(self.keeper)
+                source.close()
+            self.pid = os.getpid()
+
+        return SqliteConnection(sqlite3.connect(self.uri(), uri=True,
+            check_same_thread=False))
+
+    def describe(self):
+        return f"memory (from {self.source})"
+
+
+"""Cursor that reads rows from the server as they are fetched instead of
+   buffering the whole result: pymysql's SSCursor, or a plain cursor on
+   SQLite, which already steps through results lazily
+"""
+def streamingCursor(conn):
+    if hasattr(conn, 'streamingCursor'):
+        return conn.streamingCursor()
+    return conn.cursor(pymysql.cursors.SSCursor)
+
+
+"""Backend by name; path is the SQLite file (sqlite), or the SQLite file
+   or dump directory to load (memory)
+"""
+def openBackend(name='mysql', path=None):
+    if (name == 'mysql' or not name):
+        return MySqlBackend()
+    elif (name == 'sqlite'):
+        return SqliteBackend(path)
+    elif (name == 'memory'):
+        return MemoryBackend(path)
+    raise ValueError(f"Unknown reference backend {name}: " + \
+        f"expected one of {', '.join(BACKENDS)}")
+
+
+"""SQLite column type for a MySQL one. Blobs stay bytes (refGene exon
+   lists are decoded by the annotators); decimals stay text so they print
+   as pymysql's Decimal does.
+"""
+def sqliteType(mysqlType):
+    mysqlType = mysqlType.lower()
+    if mysqlType.endswith('int'):
+        return 'integer'
+    elif mysqlType in ['float', 'double', 'real']:
+        return 'real'
+    elif (mysqlType.endswith('blob') or mysqlType.endswith('binary')):
+        return 'blob'
+    return 'text'
+
+
+"""(columns [(name, sqlite type)], indexes [(name, columns)]) of the
+   CREATE TABLE statement in a dump's .sql file
+"""
+def parseCreateTable(sql):
+    match = re.search(r'create\s+table\s+[`"]?\w+[`"]?\s*\((.*)\)', sql,
+        re.IGNORECASE | re.DOTALL)
+    if (match is None):
+        raise ValueError("No CREATE TABLE statement")
+
+    columns = []
+    indexes = []
+    for line in match.group(1).split('\n'):
+        line = line.strip().rstrip(',')
+        key = re.match(r'(primary\s+|unique\s+)?key\s*[`"]?(\w*)[`"]?\s*' + \
+            r'\((.*)\)', line, re.IGNORECASE)
+        column = re.match(r'[`"](\w+)[`"]\s+(\w+)', line)
+        if (key is not None):
+            names = re.findall(r'[`"](\w+)[`"]', key.group(3))
+            indexes.append((key.group(2) or '_'.join(names), names))
+        elif (column is not None):
+            columns.append((column.group(1), sqliteType(column.group(2))))
+    return (columns, indexes)
+
+
+"""Value of a dump field as stored in a column of type kind
+"""
+def dumpValue(field, kind):
+    if (field == '\\N'):
+        return None
+    if '\\' in field:
+        field = re.sub(r'\\(.)', lambda m: {'t': '\t', 'n': '\n',
+            '0': '\0', 'r': '\r'}.get(m.group(1), m.group(1)), field)
+
+    if (kind == 'integer'):
+        return int(field)
+    elif (kind == 'real'):
+        return float(field)
+    elif (kind == 'blob'):
+        return field.encode('utf-8')
+    return field
+
+
+"""Creates and fills table from its .sql and .txt[.gz] dump files in
+   dump_dir; returns the number of rows loaded
+"""
+def loadTable(conn, dump_dir, table):
+    fh = open(os.path.join(dump_dir, table + '.sql'))
+    (columns, indexes) = parseCreateTable(fh.read())
+    fh.close()
+
+    conn.execute('drop table if exists "' + table + '"')
+    conn.execute('create table "' + table + '" (' + ', '.join(
+        ['"' + name + '" ' + kind for (name, kind) in columns]) + ')')
+
+    path = os.path.join(dump_dir, table + '.txt')
+    fh = open(path) if os.path.exists(path) else \
+        gzip.open(path + '.gz', 'rt')
+    kinds = [kind for (name, kind) in columns]
+    insert = 'insert into "' + table + '" values (' + \
+        ','.join(['?'] * len(columns)) + ')'
+
+    rows = 0
+    lines = (line.rstrip('\n').split('\t') for line in fh)
+    while True:
+        chunk = [[dumpValue(fields[i], kinds[i]) for i in range(len(kinds))]
+            for fields in itertools.islice(lines, LOAD_CHUNK)]
+        if (len(chunk) == 0):
+            break
+        conn.executemany(insert, chunk)
+        rows = rows + len(chunk)
+    fh.close()
+
+    for (name, names) in indexes:
+        conn.execute('create index "' + table + '_' + name + '" on "' + \
+            table + '" (' + ', '.join(['"' + n + '"' for n in names]) + ')')
+    conn.commit()
+    return rows
+
+
+"""Loads every table dumped in dump_dir (or only tables) into conn
+"""
+def loadDumps(conn, dump_dir, tables=None):
+    if not tables:
+        tables = sorted([f[:-len('.sql')] for f in os.listdir(dump_dir)
+            if f.endswith('.sql')])
+    for table in tables:
+        rows = loadTable(conn, dump_dir, table)
+        print(f"{table}: {rows} rows")
+    conn.execute('analyze')
+    conn.commit()
+
+
+if __name__ == '__main__':
+    if (len(sys.argv) > 3 and sys.argv[1] == 'load'):
+        conn = sqlite3.connect(sys.argv[2])
+        loadDumps(conn, sys.argv[3], sys.argv[4:])
+        conn.close()
+    else:
+        print("Usage: python backends.py load <sqlite_file> <dump_dir> " + \
+            "[table ...]")
+
+### EOF
@@ -0,0 +1,479 @@
+# benchmark.py
+#
+# Micro-benchmarks for AnnTools stages. They run against the reference
+# database returned by utils.db_connect(), so results reflect real RDS
+# round-trip latency, unless ann_config.ini in the current directory sets
+# another reference_backend (see backends.py).
+#
+# Usage: python benchmark.py dbsnp <vcf> [batch_size]
+#        python benchmark.py overlap <vcf> <snapshot_dir>
+#        python benchmark.py index-build [keys]
+#        python benchmark.py index-lookup <vcf> <snapshot_dir>
+#        python benchmark.py bins <vcf>
+#        python benchmark.py statements <vcf>
+#        python benchmark.py parse <vcf> [batch_size]
+#        python benchmark.py read <vcf>
+#
+##
+
+import sys
+import time
+import filecmp
+import resource
+import configparser
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import file_utils as fu
+import annotate as ann
+import snapshot as snap
+import hashindex as hi
+import binning as bn
+import backends as be
+import vcftable as vt
+import vcfmap
+import pileup2vcf
+import utils as u
+
+
+"""Cursor wrapper that counts round trips to the database
+"""
+class CountingCursor(object):
+    def __init__(self, cursor):
+        self.cursor = cursor
+        self.queries = 0
+
+    def execute(self, *args):
+        self.queries = self.queries + 1
+        return self.cursor.execute(*args)
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+
+"""Counting cursor that writes the parameters into the statement text, 
+   as the stages did before they used bound parameters, so every variant
+   sends (and the server parses) a different statement
+"""
+class LiteralCursor(CountingCursor):
+    def execute(self, sql, params=None):
+        if params:
+            sql = sql.replace('%s', '{}').format(*[literal(p) 
+                for p in params])
+        return CountingCursor.execute(self, sql)
+
+
+def literal(value):
+    if isinstance(value, int):
+        return str(value)
+    return "'" + str(value).replace("'", "''") + "'"
+
+
+"""Per-variant vs batched dbSNP lookups: round trips, time and whether
+   the two outputs are byte-for-byte identical
+"""
+def benchDbSnp(vcf, batch_size=500):
+    conn = u.db_connect()
+    outfiles = []
+
+    for size in [1, batch_size]:
+        cursor = CountingCursor(conn.cursor())
+        annotator = ann.DbSnpAnnotator(cursor, batch_size=size)
+        outfile = vcf + '.bench.' + str(size)
+        start = time.time()
+        ann.runPipeline([annotator], vcf, outfile, batch_size=size)
+        secs = time.time() - start
+        print(f"dbSNP batch_size={size}: {cursor.queries} queries, " + \
+            f"{secs:.2f} seconds")
+        outfiles.append(outfile)
+
+    print(f"Output identical: {filecmp.cmp(outfiles[0], outfiles[1], shallow=False)}")
+    for outfile in outfiles:
+        fu.delete(outfile)
+    conn.close()
+
+
+"""VCF positions by chromosome ('chr' prefixed)
+"""
+def vcfPositions(vcf):
+    positions = {}
+    fh = open(vcf)
+    for line in fh:
+        if line.startswith('#'):
+            continue
+        fields = line.split('\t')
+        chrom = fields[0].strip()
+        if not chrom.startswith('chr'):
+            chrom = 'chr' + chrom
+        positions.setdefault(chrom, []).append(int(fields[1]))
+    fh.close()
+    return positions
+
+
+"""Per-position bisect vs vectorized overlap of every VCF position against
+   every snapshot table; checks that both return the same rows
+"""
+def benchOverlap(vcf, snapshot_dir):
+    reference = snap.Snapshot(snapshot_dir)
+    positions = vcfPositions(vcf)
+
+    for table in sorted(reference.manifest['tables']):
+        if (reference.manifest['tables'][table]['chrom'] == 'chromosome'):
+            chroms = [(c.replace('chr', ''), c) for c in positions]
+        else:
+            chroms = [(c, c) for c in positions]
+
+        start = time.time()
+        single = [[reference.overlapping(table, c, pos) 
+            for pos in positions[vc]] for (c, vc) in chroms]
+        secsSingle = time.time() - start
+
+        start = time.time()
+        batch = [reference.overlappingBatch(table, c, positions[vc]) 
+            for (c, vc) in chroms]
+        secsBatch = time.time() - start
+
+        print(f"{table}: bisect {secsSingle:.3f} seconds, " + \
+            f"vectorized {secsBatch:.3f} seconds, identical {single == batch}")
+
+
+"""Hash index build and probe rate for n random (chromosome, position) keys
+"""
+def benchIndexBuild(n=1000000):
+    rng = np.random.default_rng(0)
+    keys = np.unique(hi.packKeys(rng.integers(0, 25, n), 
+        rng.integers(0, 250000000, n)))
+    counts = np.ones(len(keys), dtype=np.int64)
+
+    start = time.time()
+    index = hi.buildTable(keys, np.arange(len(keys)), counts)
+    secs = time.time() - start
+    print(f"Build: {len(keys)} keys, {1 << index.bits} slots, " + \
+        f"{secs:.2f} seconds")
+
+    start = time.time()
+    for key in keys[:100000].tolist():
+        index.find(key)
+    secs = time.time() - start
+    print(f"find(): {min(len(keys), 100000) / secs:.0f} lookups/second")
+
+    start = time.time()
+    (firsts, rowCounts) = index.findBatch(keys)
+    secs = time.time() - start
+    print(f"findBatch(): {len(keys) / secs:.0f} lookups/second, " + \
+        f"all found {bool((rowCounts == 1).all())}")
+
+
+"""dbSNP and bigRefGene stages from the database vs from the snapshot's
+   hash index: queries, time and whether the outputs are identical
+"""
+def benchIndexLookup(vcf, snapshot_dir):
+    conn = u.db_connect()
+    reference = snap.Snapshot(snapshot_dir)
+
+    stages = [('dbSNP', lambda cursor, snapshot: 
+            ann.DbSnpAnnotator(cursor, snapshot=snapshot)),
+        ('bigRefGene', lambda cursor, snapshot:
+            ann.BigRefGeneAnnotator(cursor, snapshot=snapshot))]
+    for (name, make) in stages:
+        outfiles = []
+        for (label, snapshot) in [('database', None), ('index', reference)]:
+            cursor = CountingCursor(conn.cursor())
+            outfile = vcf + '.bench.' + label
+            start = time.time()
+            ann.runPipeline([make(cursor, snapshot)], vcf, outfile)
+            secs = time.time() - start
+            print(f"{name} from {label}: {cursor.queries} queries, " + \
+                f"{secs:.2f} seconds")
+            outfiles.append(outfile)
+
+        print(f"Output identical: {filecmp.cmp(outfiles[0], outfiles[1], shallow=False)}")
+        for outfile in outfiles:
+            fu.delete(outfile)
+    conn.close()
+
+
+"""Latency of the overlap query of every VCF position against each binned
+   interval table, without and with the bin predicate; checks that both
+   return the same rows. Run 'python binning.py migrate' first.
+"""
+def benchBins(vcf):
+    conn = u.db_connect()
+    cursor = conn.cursor()
+    positions = vcfPositions(vcf)
+
+    for table in sorted(bn.BIN_TABLES):
+        (chromName, startName, endName) = bn.BIN_TABLES[table]
+        try:
+            binned = bn.hasBin(cursor, table)
+        except Exception:
+            conn.rollback()
+            continue
+        if not binned:
+            print(f"{table}: no bin column")
+            continue
+
+        secs = {}
+        rows = {}
+        for label in ['range', 'bin']:
+            start = time.time()
+            rows[label] = []
+            queries = 0
+            for vcfChrom in positions:
+                if (chromName is None):
+                    # one table per chromosome, tfbsConsSites<N>
+                    if (table != 'tfbsConsSites' + vcfChrom.replace('chr', 
+                        '')):
+                        continue
+                    (where, params) = ('', [])
+                else:
+                    chrom = vcfChrom.replace('chr', '') if \
+                        (chromName == 'chromosome') else vcfChrom
+                    (where, params) = (chromName + '=%s AND ', [chrom])
+
+                for pos in positions[vcfChrom]:
+                    (binned, bins) = bn.binPredicate(cursor, table, pos, 
+                        pos) if (label == 'bin') else ('', [])
+                    cursor.execute('select * from ' + table + ' where ' + 
+                        where + binned + startName + ' <= %s AND %s <= ' + 
+                        endName, params + bins + [pos, pos])
+                    rows[label].append(sorted(cursor.fetchall()))
+                    queries = queries + 1
+            secs[label] = time.time() - start
+
+        perQuery = [secs[label] * 1000 / max(queries, 1) 
+            for label in ['range', 'bin']]
+        print(f"{table}: {queries} queries, range only " + \
+            f"{perQuery[0]:.3f} ms, with bin {perQuery[1]:.3f} ms per " + \
+            f"query, identical {rows['range'] == rows['bin']}")
+    conn.close()
+
+
+"""Queries per second of the stages with bound parameters and with the
+   parameters written into each statement; checks that both give the same
+   output
+"""
+def benchStatements(vcf):
+    conn = u.db_connect()
+    stages = [('dbSNP', lambda cursor: 
+            ann.DbSnpAnnotator(cursor, batch_size=1)),
+        ('bigRefGene', lambda cursor: ann.BigRefGeneAnnotator(cursor)),
+        ('genes', lambda cursor: ann.GeneAnnotator(cursor, table='refGene',
+            promoter_offset=500)),
+        ('cytoBand', lambda cursor: 
+            ann.CytobandAnnotator(cursor, table='cytoBand')),
+        ('gadAll', lambda cursor: 
+            ann.GadAllAnnotator(cursor, table='gadAll'))]
+
+    for (name, make) in stages:
+        outfiles = []
+        rates = []
+        for (label, wrap) in [('literal', LiteralCursor), 
+            ('bound', CountingCursor)]:
+            cursor = wrap(conn.cursor())
+            outfile = vcf + '.bench.' + label
+            # the transcript models would spare the second run its CpG 
+            # island queries
+            ann.clearTranscriptModels()
+            start = time.time()
+            ann.runPipeline([make(cursor)], vcf, outfile, batch_size=1)
+            secs = time.time() - start
+            rates.append(cursor.queries / max(secs, 1e-9))
+            outfiles.append(outfile)
+
+        print(f"{name}: literal {rates[0]:.0f} queries/s, bound " + \
+            f"{rates[1]:.0f} queries/s ({rates[1] / rates[0]:.2f}x), " + \
+            f"identical {filecmp.cmp(outfiles[0], outfiles[1], shallow=False)}")
+        for outfile in outfiles:
+            fu.delete(outfile)
+    conn.close()
+
+
+"""Number of stages that read every record's CHROM, POS, REF and ALT
+"""
+PARSE_STAGES = 14
+
+
+"""Every stage splitting each line and stripping the lookup columns of 
+   each record again, as the staged pipeline does; returns the records
+"""
+def parseSplit(vcf, batch_size):
+    records = 0
+    for stage in range(0, PARSE_STAGES):
+        fh = open(vcf)
+        batch = []
+        for line in fh:
+            line = line.strip()
+            if line.startswith('#'):
+                continue
+            fields = line.split('\t')
+            chr = fields[0].strip()
+            if not chr.startswith("chr"):
+                chr = "chr" + chr
+            locus = (chr, int(fields[1].strip()), fields[3].strip(), 
+                fields[4].strip())
+            batch.append(fields)
+            if (batch_size > 0 and len(batch) >= batch_size):
+                batch = []
+            records = records + 1
+        fh.close()
+    return records // PARSE_STAGES
+
+
+"""One parse into ParsedVcf batches, whose columns every stage reads
+"""
+def parseOnce(vcf, batch_size):
+    records = 0
+    fh = open(vcf)
+    batches = []
+    for parsed in vt.readBatches(fh, lambda line: line.startswith('#'),
+        batch_size=batch_size if batch_size > 0 else sys.maxsize):
+        for stage in range(0, PARSE_STAGES):
+            for fields in parsed.records:
+                (chr, pos, ref, alt) = fields.locus
+                locus = (vt.ucscChrom(chr), fields.position(), ref, alt)
+        if (batch_size <= 0):
+            batches.append(parsed)
+        records = records + len(parsed.records)
+    fh.close()
+    return records
+
+
+"""(records, seconds, peak RSS in MB) of parse(vcf, batch_size), run in a
+   fresh process so that peaks are not shared between runs
+"""
+def measureParse(parse, vcf, batch_size):
+    start = time.time()
+    records = parse(vcf, batch_size)
+    secs = time.time() - start
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+    return (records, secs, peak)
+
+
+"""Parse time and peak RSS of splitting every line in every stage vs 
+   parsing once into shared columns; batch_size 0 holds the whole file
+"""
+def benchParse(vcf, batch_size=500):
+    for (name, parse) in [('split per stage', parseSplit), 
+        ('parsed once', parseOnce)]:
+        pool = ProcessPoolExecutor(max_workers=1)
+        (records, secs, peak) = pool.submit(measureParse, parse, vcf, 
+            batch_size).result()
+        pool.shutdown()
+        print(f"{name}: {records} records in {secs:.3f} seconds " + \
+            f"({records / secs:.0f} records/s), peak RSS {peak:.1f} MB")
+
+
+"""Lines of vcf read as text, as the stages read them
+"""
+def readText(vcf):
+    lines = 0
+    fh = open(vcf)
+    for line in fh:
+        line = line.strip()
+        lines = lines + 1
+    fh.close()
+    return lines
+
+
+def readMapped(vcf):
+    lines = 0
+    mapped = vcfmap.MappedVcf(vcf)
+    for line in mapped.textLines():
+        line = line.strip()
+        lines = lines + 1
+    mapped.close()
+    return lines
+
+
+"""Lines of vcf filtered as pileup2vcf.filter_vcf() did, on text
+"""
+def filterText(vcf):
+    lines = 0
+    kept = 0
+    fh = open(vcf)
+    for line in fh:
+        line = line.strip()
+        lines = lines + 1
+        if not line.startswith('#'):
+            fields = line.split('\t')
+            if (len(fields) >= 8 and fields[3] != fields[4] and 
+                fu.find_first_index(pileup2vcf.ACCEPTED_CHR, 
+                fields[0].strip()) > -1):
+                kept = kept + 1
+    fh.close()
+    return lines
+
+
+"""Lines of vcf filtered on the mapped bytes, as filter_vcf() does now
+"""
+def filterMapped(vcf):
+    mapped = vcfmap.MappedVcf(vcf)
+    lines = len(mapped.header().splitlines())
+    kept = 0
+    for line in mapped.lines():
+        line = line.strip()
+        lines = lines + 1
+        if not line.startswith(b'#'):
+            fields = line.split(b'\t', 8)
+            if (len(fields) >= 8 and fields[3] != fields[4] and 
+                fields[0].strip() in pileup2vcf.ACCEPTED_CHR_BYTES):
+                kept = kept + 1
+    mapped.close()
+    return lines
+
+
+"""Lines per second of "for line in fh" text reading vs the mapped reader,
+   reading every line and filtering as filter_vcf() does
+"""
+def benchRead(vcf):
+    for (name, read) in [('text lines', readText), 
+        ('mapped text lines', readMapped), ('text filter', filterText), 
+        ('mapped bytes filter', filterMapped)]:
+        start = time.time()
+        lines = read(vcf)
+        secs = time.time() - start
+        print(f"{name}: {lines} lines in {secs:.3f} seconds " + \
+            f"({lines / secs:.0f} lines/s)")
+
+
+if __name__ == '__main__':
+    config = configparser.ConfigParser()
+    config.read('ann_config.ini')
+    backend = be.openBackend(
+        config.get('ANNTOOLS', 'reference_backend', fallback='mysql'),
+        config.get('ANNTOOLS', 'reference_path', fallback=''))
+    if (backend.name != 'mysql'):
+        u.use_backend(backend)
+
+    if (len(sys.argv) > 2 and sys.argv[1] == 'dbsnp'):
+        batch_size = int(sys.argv[3]) if len(sys.argv) > 3 else 500
+        benchDbSnp(sys.argv[2], batch_size=batch_size)
+    elif (len(sys.argv) > 3 and sys.argv[1] == 'overlap'):
+        benchOverlap(sys.argv[2], sys.argv[3])
+    elif (len(sys.argv) > 1 and sys.argv[1] == 'index-build'):
+        n = int(sys.argv[2]) if len(sys.argv) > 2 else 1000000
+        benchIndexBuild(n)
+    elif (len(sys.argv) > 3 and sys.argv[1] == 'index-lookup'):
+        benchIndexLookup(sys.argv[2], sys.argv[3])
+    elif (len(sys.argv) > 2 and sys.argv[1] == 'bins'):
+        benchBins(sys.argv[2])
+    elif (len(sys.argv) > 2 and sys.argv[1] == 'statements'):
+        benchStatements(sys.argv[2])
+    elif (len(sys.argv) > 2 and sys.argv[1] == 'parse'):
+        batch_size = int(sys.argv[3]) if len(sys.argv) > 3 else 500
+        benchParse(sys.argv[2], batch_size=batch_size)
+    elif (len(sys.argv) > 2 and sys.argv[1] == 'read'):
+        benchRead(sys.argv[2])
+    else:
+        print("Usage: python benchmark.py dbsnp <vcf> [batch_size]")
+        print("       python benchmark.py overlap <vcf> <snapshot_dir>")
+        print("       python benchmark.py index-build [keys]")
+        print("       python benchmark.py index-lookup <vcf> <snapshot_dir>")
+        print("       python benchmark.py bins <vcf>")
+        print("       python benchmark.py statements <vcf>")
+        print("       python benchmark.py parse <vcf> [batch_size]")
+        print("       python benchmark.py read <vcf>")
+
+### EOF
@@ -0,0 +1,197 @@
+# bgzf.py
+#
+# gzip / BGZF VCF files.
+#
+# BGZF (the blocked gzip of bgzip, tabix and htslib) is a series of gzip
+# members of at most 64kb of text each, with the compressed size of the
+# member in a "BC" extra field, ending with an empty member. Any gzip
+# reader decompresses it as one stream; tools that know the format can
+# seek to a block without reading the ones before it.
+#
+# BgzfWriter compresses its blocks in a background thread: zlib releases
+# the GIL, so compression overlaps with annotation, and a bounded queue
+# keeps a slow disk from holding more than QUEUE_BLOCKS blocks in memory.
+# openText() opens a VCF for reading whether it is plain, gzip or BGZF,
+# and for writing as BGZF when the file name ends in .gz.
+#
+##
+
+import os
+import gzip
+import zlib
+import queue
+import struct
+import threading
+
+GZIP_MAGIC = b'\x1f\x8b'
+
+"""Text per block; bgzip's limit, which leaves room for incompressible
+   data in a block of at most 64kb
+"""
+BLOCK_SIZE = 0xff00
+
+"""Compression level of bgzip
+"""
+LEVEL = 6
+
+"""Blocks waiting to be compressed at most
+"""
+QUEUE_BLOCKS = 64
+
+"""Bytes copied at a time by concatenate()
+"""
+COPY_CHUNK = 1 << 20
+
+"""Empty block that marks the end of a BGZF file
+"""
+EOF_BLOCK = bytes.fromhex('1f8b08040000000000ff0600424302001b0003000000' +
+    '000000000000')
+
+
+"""One BGZF block holding data
+"""
+def compressBlock(data, level=LEVEL):
+    deflate = zlib.compressobj(level, zlib.DEFLATED, -15)
+    cdata = deflate.compress(data) + deflate.flush()
+    header = struct.pack('<4BI2BH2BHH', 0x1f, 0x8b, 8, 4, 0, 0, 0xff, 6,
+        ord('B'), ord('C'), 2, 18 + len(cdata) + 8 - 1)
+    return header + cdata + struct.pack('<2I', zlib.crc32(data), len(data))
+
+
+def isGzip(path):
+    fh = open(path, 'rb')
+    magic = fh.read(2)
+    fh.close()
+    return magic == GZIP_MAGIC
+
+
+"""Writes text to a BGZF file; blocks are compressed and written by a
+   background thread. The blocks go to fh (a binary file object, closed
+   with the writer) when one is given. When the writer fails, or is 
+   aborted, fh is aborted rather than closed (see abortFile()).
+"""
+class BgzfWriter(object):
+    def __init__(self, path, level=LEVEL, fh=None):
+        self.path = path
+        self.level = level
+        self.fh = fh if (fh is not None) else open(path, 'wb')
+        self.pending = []
+        self.size = 0
+        self.rest = b''
+        self.error = None
+        self.blocks = queue.Queue(maxsize=QUEUE_BLOCKS)
+        self.thread = threading.Thread(target=self.compress, daemon=True)
+        self.thread.start()
+
+    def write(self, text):
+        self.pending.append(text)
+        self.size = self.size + len(text)
+        if (self.size >= BLOCK_SIZE):
+            self.emit(False)
+
+    """Queues every full block of the text written so far, or all of it
+    """
+    def emit(self, final):
+        data = self.rest + ''.join(self.pending).encode('utf-8')
+        self.pending = []
+        self.size = 0
+        end = len(data) if final else len(data) - len(data) % BLOCK_SIZE
+        for start in range(0, end, BLOCK_SIZE):
+            self.put(data[start:min(start + BLOCK_SIZE, end)])
+        self.rest = data[end:]
+
+    def put(self, block):
+        if (self.error is not None):
+            raise self.error
+        self.blocks.put(block)
+
+    def compress(self):
+        while True:
+            block = self.blocks.get()
+            if (block is None):
+                return
+            if (self.error is None):
+                try:
+                    self.fh.write(compressBlock(block, self.level))
+                except Exception as e:
+                    self.error = e
+
+    """Lets the compression thread write what is queued and exit
+    """
+    def stop(self):
+        if self.thread.is_alive():
+            self.blocks.put(None)
+            self.thread.join()
+
+    def close(self):
+        try:
+            self.emit(True)
+        except Exception:
+            self.abort()
+            raise
+        self.stop()
+        if (self.error is not None):
+            # no end marker: a truncated result must not be completed
+            abortFile(self.fh)
+            raise self.error
+        self.fh.write(EOF_BLOCK)
+        self.fh.close()
+
+    """Stops the writer without completing the file
+    """
+    def abort(self):
+        self.stop()
+        abortFile(self.fh)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+"""Gives up on a file being written: aborts it when it can be (a 
+   BgzfWriter, a transfer.MultipartUpload), closes it otherwise
+"""
+def abortFile(fh):
+    if hasattr(fh, 'abort'):
+        fh.abort()
+    else:
+        fh.close()
+
+
+"""Joins BGZF files into one at path: the blocks of each file but its end
+   marker, then one end marker
+"""
+def concatenate(paths, path):
+    fh_out = open(path, 'wb')
+    for part in paths:
+        fh = open(part, 'rb')
+        size = os.fstat(fh.fileno()).st_size
+        if (size >= len(EOF_BLOCK)):
+            fh.seek(size - len(EOF_BLOCK))
+            if (fh.read() == EOF_BLOCK):
+                size = size - len(EOF_BLOCK)
+            fh.seek(0)
+        while (size > 0):
+            data = fh.read(min(size, COPY_CHUNK))
+            fh_out.write(data)
+            size = size - len(data)
+        fh.close()
+    fh_out.write(EOF_BLOCK)
+    fh_out.close()
+
+
+"""Text file object for a VCF: read as plain text or gzip (BGZF included)
+   by its content, written as BGZF when path ends in .gz
+"""
+def openText(path, mode='r'):
+    if (mode == 'w'):
+        if path.endswith('.gz'):
+            return BgzfWriter(path)
+        return open(path, 'w')
+    if isGzip(path):
+        return gzip.open(path, 'rt')
+    return open(path)
+
+### EOF
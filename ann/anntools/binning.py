@@ -0,0 +1,195 @@
+# binning.py
+#
+# UCSC genome binning for interval queries on the reference database.
+#
+# Every interval is stored with the number of the smallest bin that holds
+# it, in a hierarchy of 128kb, 1Mb, 8Mb, 64Mb and 512Mb bins (see Kent et
+# al., "The Human Genome Browser at UCSC", 2002). The rows that can overlap
+# a range are then in one of the few bins overlapping that range, so an
+# index on (chrom, bin) narrows a range predicate that a B-tree on start
+# alone cannot.
+#
+# Usage: python binning.py migrate [recompute]
+#
+# adds a bin column (filled from each row's start and end) and a
+# (chrom, bin) index to every interval table of the reference database;
+# with 'recompute', bins already present are computed again.
+#
+##
+
+import sys
+
+import utils as u
+
+BIN_OFFSETS = [512 + 64 + 8 + 1, 64 + 8 + 1, 8 + 1, 1, 0]
+FIRST_SHIFT = 17
+NEXT_SHIFT = 3
+
+"""Positions past this need the extended bin scheme, which we do not use
+"""
+MAX_POSITION = 1 << 29
+
+"""Interval tables: (chrom column, start column, end column). A chrom
+   column of None means the table holds a single chromosome.
+"""
+BIN_TABLES = {
+    'refGene': ('chrom', 'txStart', 'txEnd'),
+    'chrom_pos_unequal': ('CHR', 'start', 'end'),
+    'cpgIslandExt': ('chrom', 'chromStart', 'chromEnd'),
+    'cytoBand': ('chrom', 'chromStart', 'chromEnd'),
+    'gadAll': ('chromosome', 'chromStart', 'chromEnd'),
+    'gwasCatalog': ('chrom', 'chromStart', 'chromEnd'),
+    'targetScanS': ('chrom', 'chromStart', 'chromEnd'),
+    'hugo': ('chrom', 'chromStart', 'chromEnd'),
+    'dgv_Cnv': ('chrom', 'chromStart', 'chromEnd'),
+    'abParts_IG_T_CelReceptors': ('chrom', 'chromStart', 'chromEnd'),
+    'mcCarroll_Cnv': ('chrom', 'chromStart', 'chromEnd'),
+    'conrad_Cnv': ('chrom', 'chromStart', 'chromEnd'),
+    'genomicSuperDups': ('chrom', 'chromStart', 'chromEnd')}
+
+for chrIndex in [str(c) for c in range(1, 23)] + ['X', 'Y']:
+    BIN_TABLES['tfbsConsSites' + chrIndex] = \
+        (None, 'chromStart', 'chromEnd')
+
+"""Whether each table queried so far has a bin column, by table name
+"""
+BINNED = {}
+
+
+"""Bin of the interval [start, end), as UCSC computes it
+"""
+def binFromRange(start, end):
+    startBin = start >> FIRST_SHIFT
+    endBin = (end - 1) >> FIRST_SHIFT
+    for offset in BIN_OFFSETS:
+        if (startBin == endBin):
+            return offset + startBin
+        startBin = startBin >> NEXT_SHIFT
+        endBin = endBin >> NEXT_SHIFT
+    return 0
+
+
+"""Bins of every interval that can overlap [start, end)
+"""
+def overlappingBins(start, end):
+    startBin = start >> FIRST_SHIFT
+    endBin = (end - 1) >> FIRST_SHIFT
+    bins = []
+    for offset in BIN_OFFSETS:
+        bins.extend(range(offset + startBin, offset + endBin + 1))
+        startBin = startBin >> NEXT_SHIFT
+        endBin = endBin >> NEXT_SHIFT
+    return bins
+
+
+"""Bins of the rows that can satisfy start <= last AND first <= end. The
+   range is widened by one position on each side, so the bins are right
+   whether the table's end is inclusive or exclusive. None when the range
+   is out of the standard scheme.
+"""
+def binsFor(first, last):
+    first = max(int(first) - 1, 0)
+    last = int(last) + 1
+    if (last >= MAX_POSITION or first > last):
+        return None
+    return overlappingBins(first, last)
+
+
+"""('bin in (%s, ...) AND ', bins) to put in front of a range predicate
+   on table and bind before its parameters, or ('', []) when the table has
+   no bin column (not migrated yet)
+"""
+def binPredicate(cursor, table, first, last):
+    if not hasBin(cursor, table):
+        return ('', [])
+    bins = binsFor(first, last)
+    if (bins is None):
+        return ('', [])
+    return ('bin in (' + ','.join(['%s'] * len(bins)) + ') AND ', bins)
+
+
+def hasBin(cursor, table):
+    if table not in BINNED:
+        BINNED[table] = 'bin' in columnNames(cursor, table)
+    return BINNED[table]
+
+
+def columnNames(cursor, table):
+    cursor.execute('select * from ' + table + ' limit 0')
+    names = [d[0] for d in cursor.description]
+    cursor.fetchall()
+    return names
+
+
+"""SQL expression computing binFromRange(start, end) of a row
+"""
+def binExpression(start, end):
+    cases = []
+    shift = FIRST_SHIFT
+    for offset in BIN_OFFSETS:
+        cases.append(f"when ({start} >> {shift}) = (({end} - 1) >> " + \
+            f"{shift}) then {offset} + ({start} >> {shift})")
+        shift = shift + NEXT_SHIFT
+    return 'case ' + ' '.join(cases) + ' else 0 end'
+
+
+"""Adds and fills the bin column and the (chrom, bin) index of every
+   interval table in the database. The column is appended after the
+   existing ones, so 'select *' rows keep their column positions. Works on
+   MySQL and SQLite connections; returns the tables migrated.
+"""
+def migrate(conn, tables=BIN_TABLES, recompute=False):
+    cursor = conn.cursor()
+    migrated = []
+    for table in sorted(tables):
+        (chrom, start, end) = tables[table]
+        try:
+            names = columnNames(cursor, table)
+        except Exception as e:
+            print(f"Skipping {table}: {e}")
+            conn.rollback()
+            continue
+
+        if 'bin' not in names:
+            cursor.execute('alter table ' + table +
+                ' add column bin integer not null default 0')
+            recomputeBins = True
+        else:
+            recomputeBins = recompute
+
+        if recomputeBins:
+            cursor.execute('update ' + table + ' set bin = ' +
+                binExpression(start, end))
+
+        columns = 'bin' if (chrom is None) else (chrom + ', bin')
+        try:
+            cursor.execute('create index ' + table + '_bin on ' + table +
+                ' (' + columns + ')')
+        except Exception as e:
+            print(f"Index on {table} not created: {e}")
+
+        # fresh statistics, or the planner may keep using a (chrom, start)
+        # index; MySQL and SQLite spell this differently
+        try:
+            cursor.execute('analyze table ' + table)
+            cursor.fetchall()
+        except Exception:
+            cursor.execute('analyze ' + table)
+        conn.commit()
+        BINNED[table] = True
+        migrated.append(table)
+        print(f"{table}: bin column " + \
+            ("filled" if recomputeBins else "kept") + ", index on " + columns)
+    return migrated
+
+
+if __name__ == '__main__':
+    if (len(sys.argv) > 1 and sys.argv[1] == 'migrate'):
+        conn = u.new_connection()
+        migrate(conn, recompute=(len(sys.argv) > 2 and
+            sys.argv[2] == 'recompute'))
+        conn.close()
+    else:
+        print("Usage: python binning.py migrate [recompute]")
+
+### EOF
@@ -0,0 +1,130 @@
+# cache.py
+#
+# Persistent cross-job cache of annotation lookups, in a local SQLite file.
+#
+# Entries are keyed by (reference version, stage, chrom, pos, ref, alt) and
+# hold the stage's lookup result for that variant; the stage then applies
+# it to the record exactly as it would a database result, so output and
+# counters do not depend on whether the cache was hit. The file is kept
+# under max_bytes by evicting the least recently used entries.
+#
+# The SQLite connection is opened on first use in each process, so a cache
+# can be handed to worker processes.
+#
+##
+
+import os
+import time
+import pickle
+import sqlite3
+import threading
+
+"""Fraction of max_bytes kept after an eviction
+"""
+EVICT_TO = 0.9
+
+"""Keys per SQL statement, below SQLite's bound parameter limit
+"""
+CHUNK = 500
+
+
+class AnnotationCache(object):
+    def __init__(self, path, version, max_bytes=1 << 30):
+        self.path = path
+        self.version = str(version)
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.conn = None
+        self.pid = None
+        self.written = 0
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        del state['lock']
+        state['conn'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    """The connection of this process; call with the lock held
+    """
+    def connection(self):
+        if (self.conn is None or self.pid != os.getpid()):
+            self.conn = sqlite3.connect(self.path, timeout=60,
+                check_same_thread=False)
+            self.conn.execute('pragma journal_mode=wal')
+            self.conn.execute('create table if not exists cache (' + \
+                'key text primary key, value blob, size integer, used real)')
+            self.conn.execute('create index if not exists cache_used ' + \
+                'on cache (used)')
+            self.conn.commit()
+            self.pid = os.getpid()
+        return self.conn
+
+    def key(self, stage, chrom, pos, ref, alt):
+        return '\t'.join([self.version, stage, chrom, pos, ref, alt])
+
+    """Cached results for a list of keys: a dict key -> result of the keys
+       found, which are marked as used
+    """
+    def getMany(self, keys):
+        found = {}
+        with self.lock:
+            conn = self.connection()
+            for start in range(0, len(keys), CHUNK):
+                chunk = keys[start:start + CHUNK]
+                rows = conn.execute('select key, value from cache ' + \
+                    'where key in (' + ','.join(['?'] * len(chunk)) + ')',
+                    chunk).fetchall()
+                for (key, value) in rows:
+                    found[key] = pickle.loads(value)
+
+            if (len(found) > 0):
+                now = time.time()
+                conn.executemany('update cache set used = ? ' + \
+                    'where key = ?', [(now, key) for key in found])
+                conn.commit()
+        return found
+
+    def putMany(self, items):
+        now = time.time()
+        rows = []
+        for (key, result) in items:
+            value = pickle.dumps(result, protocol=pickle.HIGHEST_PROTOCOL)
+            rows.append((key, value, len(key) + len(value), now))
+
+        with self.lock:
+            conn = self.connection()
+            conn.executemany('insert or replace into cache ' + \
+                '(key, value, size, used) values (?, ?, ?, ?)', rows)
+            conn.commit()
+            self.written = self.written + sum([row[2] for row in rows])
+            if (self.written > self.max_bytes * (1 - EVICT_TO)):
+                self.evict()
+                self.written = 0
+
+    """Drops the least recently used entries until the cache is back
+       under EVICT_TO of max_bytes
+    """
+    def evict(self):
+        conn = self.connection()
+        (total, count) = conn.execute(
+            'select coalesce(sum(size), 0), count(*) from cache').fetchone()
+        if (total <= self.max_bytes):
+            return
+
+        excess = total - self.max_bytes * EVICT_TO
+        n = int(excess * count / total) + 1
+        conn.execute('delete from cache where key in (select key ' + \
+            'from cache order by used limit ?)', (n,))
+        conn.commit()
+
+    def close(self):
+        with self.lock:
+            if (self.conn is not None and self.pid == os.getpid()):
+                self.conn.close()
+            self.conn = None
+
+### EOF
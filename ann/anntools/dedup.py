@@ -0,0 +1,131 @@
+# dedup.py
+#
+# Reuse of the results of identical jobs.
+#
+# A job is identified by a content hash: the SHA-256 of its input (of the
+# decompressed text, so a .vcf and a .vcf.gz of the same records match),
+# of the reference version its results were annotated against, and of
+# the options that change the result files. When a job completes, a small
+# JSON record under that key, in the results bucket, points to its result
+# objects. A later job with the same key copies those objects to its own
+# keys inside S3 (no download, no annotation) and completes as if it had
+# run; see run.py.
+#
+# Result objects can be gone by the time a record is found (results of
+# free users are archived to Glacier and deleted from S3): such a record
+# is deleted and the job is a miss. A missing record or object is a 404,
+# or a 403 without s3:ListBucket; both are misses.
+#
+# Hits and misses are printed, and counted in CloudWatch (DedupHits and
+# DedupMisses) when a namespace is configured.
+#
+##
+
+import gzip
+import json
+import hashlib
+
+from botocore.exceptions import ClientError
+
+import bgzf
+
+"""Bytes hashed at a time
+"""
+HASH_CHUNK = 1 << 20
+
+"""Prefix of the dedup records in the results bucket
+"""
+RECORD_PREFIX = 'dedup'
+
+"""Error codes S3 gives for a key that does not exist
+"""
+MISSING_CODES = ['404', 'NoSuchKey', '403', 'AccessDenied']
+
+
+def inputDigest(path):
+    digest = hashlib.sha256()
+    fh = gzip.open(path, 'rb') if bgzf.isGzip(path) else open(path, 'rb')
+    while True:
+        data = fh.read(HASH_CHUNK)
+        if (len(data) == 0):
+            break
+        digest.update(data)
+    fh.close()
+    return digest.hexdigest()
+
+
+"""Dedup key of a job's input, for results annotated against reference
+   version with options (a dict of the settings that change the result
+   files)
+"""
+def jobKey(path, version, options):
+    digest = hashlib.sha256()
+    digest.update(inputDigest(path).encode('utf-8'))
+    digest.update(b'\0' + version.encode('utf-8') + b'\0')
+    digest.update(json.dumps(options, sort_keys=True).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def isMissing(error):
+    return str(error.response.get('Error', {}).get('Code')) in MISSING_CODES
+
+
+def recordKey(prefix, key):
+    return f"{prefix}/{RECORD_PREFIX}/{key}.json"
+
+
+"""Result objects of the completed job recorded under key, a dict of
+   names to S3 keys; None when there is none
+"""
+def findResults(s3, bucket, prefix, key):
+    try:
+        response = s3.get_object(Bucket=bucket, Key=recordKey(prefix, key))
+    except ClientError as e:
+        if not isMissing(e):
+            raise
+        return None
+    return json.loads(response['Body'].read())
+
+
+def recordResults(s3, bucket, prefix, key, results):
+    s3.put_object(Bucket=bucket, Key=recordKey(prefix, key),
+        Body=json.dumps(results, sort_keys=True).encode('utf-8'),
+        ContentType='application/json')
+
+
+def forgetResults(s3, bucket, prefix, key):
+    s3.delete_object(Bucket=bucket, Key=recordKey(prefix, key))
+
+
+"""Copies the recorded result objects to the keys in targets (same names)
+   inside S3; objects without a target are left alone. False when one of
+   the objects no longer exists.
+"""
+def copyResults(s3, bucket, results, targets, config):
+    for name in results:
+        if (results[name] and targets.get(name)):
+            try:
+                s3.copy({'Bucket': bucket, 'Key': results[name]}, bucket,
+                    targets[name], Config=config)
+            except ClientError as e:
+                if not isMissing(e):
+                    raise
+                return False
+    return True
+
+
+"""Prints a hit or a miss and counts it in CloudWatch, with cloudwatch
+   (a client) and namespace
+"""
+def countJob(key, hit, cloudwatch=None, namespace=None):
+    print(f"Dedup {'hit' if hit else 'miss'} for {key}")
+    if (cloudwatch is None or not namespace):
+        return
+    try:
+        cloudwatch.put_metric_data(Namespace=namespace, MetricData=[{
+            'MetricName': 'DedupHits' if hit else 'DedupMisses',
+            'Value': 1, 'Unit': 'Count'}])
+    except Exception as e:
+        print(f"An error occurred while counting dedup metrics: {e}")
+
+### EOF
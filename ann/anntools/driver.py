@@ -12,110 +12,539 @@ __author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
 
 import sys
 import os
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+
 import file_utils as fu
 import annotate as ann
+import snapshot as snap
+import scheduler as sched
+import cache as ch
+import backends as be
+import mergejoin as mj
+import bgzf
+import utils as u
+
+def run(infile, format, mode='staged', batch_size=500, snapshot_dir=None,
+    workers=1, connections=1, depth=1, cache_path=None, cache_max_mb=1024,
+    reference_version=None, backend='mysql', reference_path=None,
+    overlap_join='point', compress_intermediates=False, 
+    compress_output=False, stream=None):
+
+    backend = openReference(backend, reference_path)
+    cache = openCache(cache_path, cache_max_mb, reference_version, 
+        snapshot_dir)
+    merge = (overlap_join == 'merge')
+    ann.clearTranscriptModels()
 
-def run(infile, format):
+    if (mode == 'fused' and workers > 1):
+        runParallel(infile, format, workers=workers, batch_size=batch_size,
+            snapshot_dir=snapshot_dir, connections=connections, cache=cache,
+            backend=backend, merge=merge, compress=compress_output)
+        return
+    elif (mode == 'fused'):
+        runFused(infile, format, batch_size=batch_size, 
+            snapshot_dir=snapshot_dir, connections=connections, cache=cache,
+            merge=merge, compress=compress_output, stream=stream)
+        return
 
     print("Running . . .")
+    basefile = baseName(infile)
+    exts = stageExtensions(infile, STAGES, compress_intermediates, 
+        compress_output)
 
-    ann.getSnpsFromDbSnp(vcf=infile, format='vcf', tmpextin='', 
-        tmpextout='.1')
+    reference = None
+    if snapshot_dir:
+        reference = snap.Snapshot(snapshot_dir)
+        print(f"Using reference snapshot {reference.version}")
+
+    ann.getSnpsFromDbSnp(vcf=basefile, format='vcf', tmpextin=exts[0], 
+        tmpextout=exts[1], batch_size=batch_size, snapshot=reference, 
+        cache=cache)
     print("dbSNP - done.")
     tmpextin = 1
     tmpextout = 2
 
-    ann.getBigRefGene(vcf=infile, format='vcf', tmpextin='.' + str(tmpextin),
-        tmpextout='.' + str(tmpextout))
+    ann.getBigRefGene(vcf=basefile, format='vcf', tmpextin=exts[tmpextin],
+        tmpextout=exts[tmpextout], snapshot=reference, 
+        depth=depth, cache=cache)
     print("BigRefGene - done.")
     tmpextin = tmpextin + 1
     tmpextout = tmpextout + 1
 
-    ann.getGenes(vcf=infile, format='vcf', table='refGene', 
-        promoter_offset=500, tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
+    ann.getGenes(vcf=basefile, format='vcf', table='refGene', 
+        promoter_offset=500, tmpextin=exts[tmpextin], 
+        tmpextout=exts[tmpextout], depth=depth, cache=cache)
     print("BigRefGene - done.")
     tmpextin = tmpextin + 1
     tmpextout = tmpextout + 1
 
-    ann.addOverlapWithCytoband(vcf=infile, format='vcf', table='cytoBand', 
-        tmpextin='.' + str(tmpextin), tmpextout='.' + str(tmpextout))
+    ann.addOverlapWithCytoband(vcf=basefile, format='vcf', table='cytoBand', 
+        tmpextin=exts[tmpextin], tmpextout=exts[tmpextout], 
+        snapshot=reference, depth=depth, cache=cache, merge=merge)
     print("Cytoband - done.")
     tmpextin = tmpextin + 1
     tmpextout = tmpextout + 1
 
-    ann.addOverlapWithGadAll(vcf=infile, format='vcf', table='gadAll', 
-        tmpextin='.' + str(tmpextin), tmpextout='.' + str(tmpextout))
+    ann.addOverlapWithGadAll(vcf=basefile, format='vcf', table='gadAll', 
+        tmpextin=exts[tmpextin], tmpextout=exts[tmpextout], 
+        snapshot=reference, depth=depth, cache=cache, merge=merge)
     print("gadAll - done.")
     tmpextin = tmpextin + 1
     tmpextout = tmpextout + 1
 
-    ann.addOverlapWithGwasCatalog(vcf=infile, format='vcf', 
-        table='gwasCatalog', tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
+    ann.addOverlapWithGwasCatalog(vcf=basefile, format='vcf', 
+        table='gwasCatalog', tmpextin=exts[tmpextin], 
+        tmpextout=exts[tmpextout], snapshot=reference, 
+        depth=depth, cache=cache, merge=merge)
     print("GwasCatalog - done.")
     tmpextin = tmpextin + 1
     tmpextout = tmpextout + 1
 
-    ann.addOverlapWithMiRNA(vcf=infile, format='vcf', table='targetScanS', 
-        tmpextin='.' + str(tmpextin), tmpextout='.' + str(tmpextout))
+    ann.addOverlapWithMiRNA(vcf=basefile, format='vcf', table='targetScanS', 
+        tmpextin=exts[tmpextin], tmpextout=exts[tmpextout], 
+        snapshot=reference, depth=depth, cache=cache, merge=merge)
     print("miRNA - done.")
     tmpextin = tmpextin + 1
     tmpextout = tmpextout + 1
 
-    ann.addOverlapWitHUGOGeneNomenclature(vcf=infile, format='vcf', 
-        table='hugo', tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
+    ann.addOverlapWitHUGOGeneNomenclature(vcf=basefile, format='vcf', 
+        table='hugo', tmpextin=exts[tmpextin], 
+        tmpextout=exts[tmpextout], snapshot=reference, 
+        depth=depth, cache=cache, merge=merge)
     print("HUGO Gene Nomenclature Committee - done.")
     tmpextin = tmpextin + 1
     tmpextout = tmpextout + 1
 
-    ann.addOverlapWithCnvDatabase(vcf=infile, format='vcf', table='dgv_Cnv', 
-        tmpextin='.' + str(tmpextin), tmpextout='.' + str(tmpextout))
+    ann.addOverlapWithCnvDatabase(vcf=basefile, format='vcf', table='dgv_Cnv', 
+        tmpextin=exts[tmpextin], tmpextout=exts[tmpextout], 
+        snapshot=reference, depth=depth, cache=cache, merge=merge)
     print("dgv_Cnv - done.")
     tmpextin = tmpextin + 1
     tmpextout = tmpextout + 1
 
-    ann.addOverlapWithCnvDatabase(vcf=infile, format='vcf', 
-        table='abParts_IG_T_CelReceptors', tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
+    ann.addOverlapWithCnvDatabase(vcf=basefile, format='vcf', 
+        table='abParts_IG_T_CelReceptors', tmpextin=exts[tmpextin], 
+        tmpextout=exts[tmpextout], snapshot=reference, 
+        depth=depth, cache=cache, merge=merge)
     print("abParts_IG_T_CelReceptors - done.")
     tmpextin = tmpextin + 1
     tmpextout = tmpextout + 1
 
-    ann.addOverlapWithCnvDatabase(vcf=infile, format='vcf', 
-        table='mcCarroll_Cnv', tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
+    ann.addOverlapWithCnvDatabase(vcf=basefile, format='vcf', 
+        table='mcCarroll_Cnv', tmpextin=exts[tmpextin], 
+        tmpextout=exts[tmpextout], snapshot=reference, 
+        depth=depth, cache=cache, merge=merge)
     print("mcCarroll_Cnv - done.")
     tmpextin = tmpextin + 1
     tmpextout = tmpextout + 1
 
-    ann.addOverlapWithCnvDatabase(vcf=infile, format='vcf', 
-        table='conrad_Cnv', tmpextin='.' + str(tmpextin), 
-        tmpextout='.' + str(tmpextout))
+    ann.addOverlapWithCnvDatabase(vcf=basefile, format='vcf', 
+        table='conrad_Cnv', tmpextin=exts[tmpextin], 
+        tmpextout=exts[tmpextout], snapshot=reference, 
+        depth=depth, cache=cache, merge=merge)
     print("conrad_Cnv - done.")
     tmpextin = tmpextin + 1
     tmpextout = tmpextout + 1
 
-    ann.addOverlapWithGenomicSuperDups(vcf=infile, format='vcf', 
-        table='genomicSuperDups', tmpextin='.' + str(tmpextin),
-        tmpextout='.' + str(tmpextout))
+    ann.addOverlapWithGenomicSuperDups(vcf=basefile, format='vcf', 
+        table='genomicSuperDups', tmpextin=exts[tmpextin],
+        tmpextout=exts[tmpextout], snapshot=reference, 
+        depth=depth, cache=cache, merge=merge)
     print("genomicSuperDups - done.")
     tmpextin = tmpextin + 1
     tmpextout = tmpextout + 1
 
-    ann.addOverlapWithTfbsConsSites(vcf=infile, table='tfbsConsSites',
-        tmpextin='.' + str(tmpextin), tmpextout='.' + str(tmpextout))
+    ann.addOverlapWithTfbsConsSites(vcf=basefile, table='tfbsConsSites',
+        tmpextin=exts[tmpextin], tmpextout=exts[tmpextout], 
+        snapshot=reference, depth=depth, cache=cache, merge=merge)
     print("addOverlapWithTfbsConsSites - done.")
     tmpextin = tmpextin + 1
     tmpextout = tmpextout + 1
 
     ## Cleanup
     for i in range(1, tmpextin):
-        fu.delete(infile + '.' + str(i))
+        fu.delete(basefile + exts[i])
+
+    os.rename(basefile + exts[tmpextin], annotatedName(infile, 
+        compress_output))
+    print(f"Connection pool: {u.pool.summary()}")
+
+
+"""Number of stages of the staged pipeline
+"""
+STAGES = 14
+
+
+"""Input file name without .gz; results and logs are named after it
+"""
+def baseName(infile):
+    if infile.endswith('.gz'):
+        return infile[:-len('.gz')]
+    return infile
+
+
+def annotatedName(infile, compress=False):
+    finalout = (baseName(infile) + '.annot').replace('.vcf.annot', 
+        '.annot.vcf')
+    return finalout + '.gz' if compress else finalout
+
+
+def countLogName(infile):
+    return baseName(infile) + '.count.log'
+
+
+"""File name extensions, after baseName(infile), of the input and of the 
+   output of each of the staged pipeline's stages; compressed files (the
+   input, if it is, and the outputs as asked) end in .gz
+"""
+def stageExtensions(infile, stages, compress_intermediates=False, 
+    compress_output=False):
+    exts = ['.gz' if infile.endswith('.gz') else '']
+    for i in range(1, stages + 1):
+        compress = compress_output if (i == stages) else \
+            compress_intermediates
+        exts.append('.' + str(i) + ('.gz' if compress else ''))
+    return exts
+
+
+"""Opens the reference database backend (see backends.py) and makes the
+   pooled connections use it
+"""
+def openReference(backend='mysql', reference_path=None):
+    backend = be.openBackend(backend, reference_path)
+    if (backend.name != 'mysql'):
+        u.use_backend(backend)
+        print(f"Using reference database {backend.describe()}")
+    return backend
+
+
+"""Version of the reference the results are annotated against: 
+   reference_version, or the version of the snapshot; None when neither
+   is known
+"""
+def referenceVersion(reference_version=None, snapshot_dir=None):
+    if not reference_version and snapshot_dir:
+        reference_version = snap.Snapshot(snapshot_dir).version
+    return reference_version or None
+
+
+"""Persistent lookup cache (see cache.py), or None when cache_path is not
+   set. Entries are tied to reference_version, or to the snapshot version
+   when reference_version is not given.
+"""
+def openCache(cache_path, cache_max_mb=1024, reference_version=None, 
+    snapshot_dir=None):
+    if not cache_path:
+        return None
+
+    reference_version = referenceVersion(reference_version, snapshot_dir)
+    if not reference_version:
+        print("No reference_version or snapshot_dir: lookup cache disabled")
+        return None
+
+    print(f"Using lookup cache {cache_path} for reference {reference_version}")
+    return ch.AnnotationCache(cache_path, reference_version, 
+        max_bytes=cache_max_mb * 1024 * 1024)
+
+
+"""The annotators of run(), in stage order, for the fused pipeline
+"""
+def fusedAnnotators(cursor, format='vcf', batch_size=500, reference=None):
+    return [
+        ann.DbSnpAnnotator(cursor, format=format, batch_size=batch_size, 
+            snapshot=reference),
+        ann.BigRefGeneAnnotator(cursor, format=format, snapshot=reference),
+        ann.GeneAnnotator(cursor, format=format, table='refGene', 
+            promoter_offset=500, snapshot=reference),
+        ann.CytobandAnnotator(cursor, format=format, table='cytoBand', 
+            snapshot=reference),
+        ann.GadAllAnnotator(cursor, format=format, table='gadAll', 
+            snapshot=reference),
+        ann.GwasCatalogAnnotator(cursor, format=format, table='gwasCatalog', 
+            snapshot=reference),
+        ann.MiRNAAnnotator(cursor, format=format, table='targetScanS', 
+            snapshot=reference),
+        ann.HugoGeneNomenclatureAnnotator(cursor, format=format, 
+            table='hugo', snapshot=reference),
+        ann.CnvDatabaseAnnotator(cursor, format=format, table='dgv_Cnv', 
+            snapshot=reference),
+        ann.CnvDatabaseAnnotator(cursor, format=format, 
+            table='abParts_IG_T_CelReceptors', snapshot=reference),
+        ann.CnvDatabaseAnnotator(cursor, format=format, 
+            table='mcCarroll_Cnv', snapshot=reference),
+        ann.CnvDatabaseAnnotator(cursor, format=format, table='conrad_Cnv', 
+            snapshot=reference),
+        ann.GenomicSuperDupsAnnotator(cursor, format=format, 
+            table='genomicSuperDups', snapshot=reference),
+        ann.TfbsConsSitesAnnotator(cursor, table='tfbsConsSites', 
+            snapshot=reference)]
+
+
+"""Dependencies between the fused stages, by position in fusedAnnotators():
+   (name, stages whose output the stage reads). bigRefGene drops the "."
+   INFO that dbSNP leaves, getGenes counts bigRefGene's positionType; the 
+   overlap stages after getGenes only append to INFO.
+"""
+STAGE_GRAPH = [
+    ('dbSNP', []),
+    ('bigRefGene', ['dbSNP']),
+    ('genes', ['bigRefGene']),
+    ('cytoBand', ['genes']),
+    ('gadAll', ['genes']),
+    ('gwasCatalog', ['genes']),
+    ('miRNA', ['genes']),
+    ('hugo', ['genes']),
+    ('dgv_Cnv', ['genes']),
+    ('abParts_IG_T_CelReceptors', ['genes']),
+    ('mcCarroll_Cnv', ['genes']),
+    ('conrad_Cnv', ['genes']),
+    ('genomicSuperDups', ['genes']),
+    ('tfbsConsSites', ['genes'])]
+
+
+"""Runs the fused pipeline from infile to outfile and returns the 
+   annotators. With more than one connection, the stages run as the 
+   STAGE_GRAPH dependency graph, independent stages concurrently. With 
+   merge, the overlap stages look records up by merge join.
+"""
+def annotateFile(infile, outfile, format='vcf', batch_size=500, 
+    reference=None, connections=1, cache=None, merge=False, stream=None):
+
+    (lines, fh_out) = stream if (stream is not None) else (None, None)
+    try:
+        (annotators, scheduler, conns) = openAnnotators(format, batch_size,
+            reference, connections, cache, merge)
+    except BaseException:
+        # the streamed result is open already (see transfer.openResult())
+        if (fh_out is not None):
+            bgzf.abortFile(fh_out)
+        raise
+    try:
+        ann.runPipeline(annotators, infile, outfile, batch_size=batch_size, 
+            scheduler=scheduler, lines=lines, fh_out=fh_out)
+    finally:
+        closeAnnotators(annotators, scheduler, conns)
+    return annotators
+
+
+"""The fused annotators, on their own database connections, and the 
+   scheduler that runs them when there is more than one connection; see
+   annotateFile()
+"""
+def openAnnotators(format='vcf', batch_size=500, reference=None, 
+    connections=1, cache=None, merge=False):
+
+    conns = [u.db_connect() for i in range(0, max(connections, 1))]
+    cursors = [conn.cursor() for conn in conns]
+    annotators = fusedAnnotators(cursors[0], format=format, 
+        batch_size=batch_size, reference=reference)
+    for annotator in annotators:
+        annotator.cache = cache
+        if (merge and isinstance(annotator, ann.OverlapAnnotator)):
+            annotator.merge = mj.MergeJoin(annotator)
+
+    scheduler = None
+    if (len(conns) > 1):
+        scheduler = sched.StageGraph([(STAGE_GRAPH[i][0], annotators[i], 
+            STAGE_GRAPH[i][1]) for i in range(0, len(annotators))], cursors)
+    return (annotators, scheduler, conns)
+
+
+def closeAnnotators(annotators, scheduler, conns):
+    if (scheduler is not None):
+        scheduler.close()
+    for annotator in annotators:
+        if (isinstance(annotator, ann.OverlapAnnotator) and 
+            annotator.merge is not None):
+            annotator.merge.close()
+            annotator.merge = None
+    for conn in conns:
+        conn.close()
+
+
+def writeCountLog(infile, annotators):
+    fh_log = open(countLogName(infile), 'w')
+    for annotator in annotators:
+        annotator.writeLog(fh_log)
+        annotator.writeCacheLog(fh_log)
+    fh_log.close()
+
+
+"""Same stages as run(), in the same order, but every record is parsed 
+   once, passed through all annotators in memory and written once to 
+   .annot.vcf; no intermediate .N files are created.
+
+   With snapshot_dir set, the tables found in that reference snapshot 
+   (see snapshot.py) are read from it rather than from the database. With
+   compress, the result is written as BGZF (.annot.vcf.gz). With stream,
+   a (lines, writer) pair, the input is read from lines and the result 
+   written to writer, which keeps the local copy (see transfer.py).
+"""
+def runFused(infile, format='vcf', batch_size=500, snapshot_dir=None,
+    connections=1, cache=None, merge=False, compress=False, stream=None):
+
+    print("Running (fused) . . .")
+
+    reference = None
+    if snapshot_dir:
+        reference = snap.Snapshot(snapshot_dir)
+        print(f"Using reference snapshot {reference.version}")
+
+    finalout = annotatedName(infile, compress)
+    annotators = annotateFile(infile, finalout, format=format, 
+        batch_size=batch_size, reference=reference, connections=connections,
+        cache=cache, merge=merge, stream=stream)
+
+    writeCountLog(infile, annotators)
+    print("Fused annotation - done.")
+    print(f"Connection pool: {u.pool.summary()}")
+
+
+"""Annotates the inputs of several (small) jobs in one fused pass: the
+   connections, snapshot and annotators are set up once, and batches of
+   records are looked up together whichever job they belong to. Each job
+   still gets its own .annot.vcf and .count.log, the same as runFused()
+   gives it alone. Takes the options of run(); the jobs always run in
+   this process, whatever mode and workers ask for.
+"""
+def runJobs(infiles, format='vcf', batch_size=500, snapshot_dir=None,
+    connections=1, cache_path=None, cache_max_mb=1024, 
+    reference_version=None, backend='mysql', reference_path=None,
+    overlap_join='point', compress_output=False):
+
+    openReference(backend, reference_path)
+    cache = openCache(cache_path, cache_max_mb, reference_version, 
+        snapshot_dir)
+    ann.clearTranscriptModels()
+    print(f"Running (fused, {len(infiles)} jobs) . . .")
+
+    reference = None
+    if snapshot_dir:
+        reference = snap.Snapshot(snapshot_dir)
+        print(f"Using reference snapshot {reference.version}")
+
+    (annotators, scheduler, conns) = openAnnotators(format, batch_size,
+        reference, connections, cache, overlap_join == 'merge')
+    try:
+        ann.runJobPipeline(annotators, infiles, 
+            [annotatedName(infile, compress_output) for infile in infiles],
+            batch_size=batch_size, scheduler=scheduler)
+    finally:
+        # run_batch() runs in a warm worker that outlives a failed batch
+        closeAnnotators(annotators, scheduler, conns)
+
+    for i in range(0, len(infiles)):
+        for annotator in annotators:
+            annotator.counts = annotator.jobCounts[i]
+        writeCountLog(infiles[i], annotators)
+    print("Fused annotation - done.")
+    print(f"Connection pool: {u.pool.summary()}")
+
+
+"""Fused pipeline over one chunk of the input, in a worker process with
+   its own database connection and snapshot; returns the counters of
+   every annotator
+"""
+def annotateChunk(chunkfile, format='vcf', batch_size=500, snapshot_dir=None,
+    connections=1, cache=None, backend=None, merge=False, compress=False):
+    if (backend is not None and backend.name != 'mysql'):
+        u.use_backend(backend)
+
+    reference = None
+    if snapshot_dir:
+        reference = snap.Snapshot(snapshot_dir)
+
+    annotators = annotateFile(chunkfile, chunkOutput(chunkfile, compress),
+        format=format,
+        batch_size=batch_size, reference=reference, connections=connections,
+        cache=cache, merge=merge)
+    return [annotator.counts for annotator in annotators]
+
+
+def chunkOutput(chunkfile, compress=False):
+    return chunkfile + ('.annot.gz' if compress else '.annot')
+
+
+"""Splits infile into at most n files with about the same number of 
+   records each (and never fewer than batch_size records), header lines
+   staying where they are; returns the chunk file names in input order
+"""
+def splitInput(infile, n, batch_size=500):
+    fh = bgzf.openText(infile)
+    records = 0
+    for line in fh:
+        if not line.startswith('#'):
+            records = records + 1
+    fh.close()
+
+    n = max(1, min(n, -(-records // max(batch_size, 1))))
+    size = -(-records // n)
+
+    chunks = []
+    fh_out = None
+    count = 0
+    fh = bgzf.openText(infile)
+    for line in fh:
+        if (fh_out is None):
+            chunks.append(infile + '.part' + str(len(chunks)))
+            fh_out = open(chunks[-1], 'w')
+        fh_out.write(line)
+        if not line.startswith('#'):
+            count = count + 1
+            if (count % size == 0):
+                fh_out.close()
+                fh_out = None
+    fh.close()
+    if (fh_out is not None):
+        fh_out.close()
+    return chunks
+
+
+"""runFused() over balanced chunks of the input in a pool of worker 
+   processes. The chunk outputs are concatenated back in input order and 
+   the counters of each annotator are summed, so .annot.vcf and 
+   .count.log are the same as with a single process. With compress, each
+   worker writes its chunk as BGZF and the blocks are joined.
+"""
+def runParallel(infile, format='vcf', workers=4, batch_size=500, 
+    snapshot_dir=None, connections=1, cache=None, backend=None, merge=False,
+    compress=False):
+
+    chunks = splitInput(infile, workers, batch_size)
+    print(f"Running (fused, {len(chunks)} workers) . . .")
+
+    try:
+        # the pool waits for every chunk before it is shut down, so no 
+        # worker is left writing a chunk output once they are deleted
+        with ProcessPoolExecutor(max_workers=len(chunks)) as pool:
+            futures = [pool.submit(annotateChunk, chunk, format, batch_size, 
+                snapshot_dir, connections, cache, backend, merge, compress) 
+                for chunk in chunks]
+            counts = [future.result() for future in futures]
+
+        outputs = [chunkOutput(chunk, compress) for chunk in chunks]
+        if compress:
+            bgzf.concatenate(outputs, annotatedName(infile, compress))
+        else:
+            fh_out = open(annotatedName(infile), 'w')
+            for output in outputs:
+                fh = open(output)
+                shutil.copyfileobj(fh, fh_out)
+                fh.close()
+            fh_out.close()
+    finally:
+        # also when a chunk failed: a warm worker runs job after job
+        for chunk in chunks:
+            fu.delete(chunk)
+            fu.delete(chunkOutput(chunk, compress))
+
+    annotators = fusedAnnotators(None, format=format, batch_size=batch_size)
+    for chunkCounts in counts:
+        for i in range(0, len(annotators)):
+            annotators[i].mergeCounts(chunkCounts[i])
 
-    os.rename(infile + '.' + str(tmpextin), infile + '.annot')
-    finalout=(infile + '.annot').replace('.vcf.annot', '.annot.vcf')
-    os.rename(infile + '.annot', finalout)
+    writeCountLog(infile, annotators)
+    print("Parallel annotation - done.")
 
-### EOF
\ No newline at end of file
+### EOF
@@ -0,0 +1,136 @@
+# hashindex.py
+#
+# Exact-key hash index for point lookups on (chromosome, position).
+#
+# Keys pack a chromosome code and a position into one 64-bit integer. The
+# table uses open addressing with linear probing and is stored as three
+# flat int64 arrays (key, first payload row, number of rows), so it can be
+# written to disk as is and mmapped by every annotator process; a lookup
+# costs a hash and, at a load factor of at most 1/2, one or two probes.
+#
+##
+
+import numpy as np
+
+EMPTY = 0
+POS_BITS = 40
+POS_MASK = (1 << POS_BITS) - 1
+MULTIPLIER = 0x9E3779B97F4A7C15     # 2^64 / golden ratio
+MASK64 = (1 << 64) - 1
+
+
+"""Chromosome codes start at 1 in the key so that no key is EMPTY
+"""
+def packKey(code, pos):
+    if (pos < 0 or pos > POS_MASK):
+        raise ValueError(f"Position {pos} does not fit in a packed key")
+    return ((code + 1) << POS_BITS) | pos
+
+
+def packKeys(codes, positions):
+    codes = np.asarray(codes, dtype=np.int64)
+    positions = np.asarray(positions, dtype=np.int64)
+    return ((codes + 1) << POS_BITS) | positions
+
+
+"""Number of hash bits for n keys: at least two slots per key
+"""
+def tableBits(n):
+    return max(1, (2 * n - 1).bit_length())
+
+
+def homeSlot(key, bits):
+    return ((key * MULTIPLIER) & MASK64) >> (64 - bits)
+
+
+def homeSlots(keys, bits):
+    keys = np.asarray(keys, dtype=np.int64).astype(np.uint64)
+    return (keys * np.uint64(MULTIPLIER) >> np.uint64(64 - bits)).astype(
+        np.int64)
+
+
+"""Builds the slot arrays for unique keys. Keys are inserted in rounds:
+   every pending key tries the next slot of its probe sequence, the first
+   key (in input order) claiming a free slot gets it and the others move
+   on, which keeps the linear probing invariant that no empty slot lies
+   between a key's home slot and the slot that holds it.
+"""
+def buildTable(keys, firsts, counts):
+    keys = np.asarray(keys, dtype=np.int64)
+    bits = tableBits(len(keys))
+    mask = (1 << bits) - 1
+
+    slotKeys = np.zeros(1 << bits, dtype=np.int64)
+    slotFirsts = np.zeros(1 << bits, dtype=np.int64)
+    slotCounts = np.zeros(1 << bits, dtype=np.int64)
+
+    home = homeSlots(keys, bits)
+    pending = np.arange(len(keys), dtype=np.int64)
+    probe = 0
+    while (len(pending) > 0):
+        slots = (home[pending] + probe) & mask
+        free = slotKeys[slots] == EMPTY
+        (claimed, first) = np.unique(slots[free], return_index=True)
+        winners = pending[free][first]
+
+        slotKeys[claimed] = keys[winners]
+        slotFirsts[claimed] = np.asarray(firsts, dtype=np.int64)[winners]
+        slotCounts[claimed] = np.asarray(counts, dtype=np.int64)[winners]
+
+        placed = np.zeros(len(keys), dtype=bool)
+        placed[winners] = True
+        pending = pending[~placed[pending]]
+        probe = probe + 1
+
+    return HashTable(slotKeys, slotFirsts, slotCounts, bits)
+
+
+"""Read side of the index. The slot arrays may be NumPy arrays or int64
+   memoryviews over mmapped files.
+"""
+class HashTable(object):
+    def __init__(self, keys, firsts, counts, bits):
+        self.keys = keys
+        self.firsts = firsts
+        self.counts = counts
+        self.bits = bits
+        self.mask = (1 << bits) - 1
+
+    """(first row, number of rows) for a key, (0, 0) when absent
+    """
+    def find(self, key):
+        slot = homeSlot(key, self.bits)
+        while True:
+            k = self.keys[slot]
+            if (k == key):
+                return (int(self.firsts[slot]), int(self.counts[slot]))
+            elif (k == EMPTY):
+                return (0, 0)
+            slot = (slot + 1) & self.mask
+
+    """find() for an array of keys, probing all of them in lockstep;
+       returns the arrays of first rows and row counts
+    """
+    def findBatch(self, keys):
+        slotKeys = np.frombuffer(self.keys, dtype=np.int64)
+        keys = np.asarray(keys, dtype=np.int64)
+        firsts = np.zeros(len(keys), dtype=np.int64)
+        counts = np.zeros(len(keys), dtype=np.int64)
+
+        pending = np.arange(len(keys), dtype=np.int64)
+        slots = homeSlots(keys, self.bits)
+        while (len(pending) > 0):
+            found = slotKeys[slots] == keys[pending]
+            hits = pending[found]
+            firsts[hits] = np.frombuffer(self.firsts, dtype=np.int64)[
+                slots[found]]
+            counts[hits] = np.frombuffer(self.counts, dtype=np.int64)[
+                slots[found]]
+
+            probing = ~found & (slotKeys[slots] != EMPTY)
+            pending = pending[probing]
+            slots = (slots[probing] + 1) & self.mask
+
+        return (firsts, counts)
+
+### EOF
@@ -0,0 +1,186 @@
+# mergejoin.py
+#
+# Merge-join lookups for the addOverlapWith* stages.
+#
+# When the input is sorted by position within each chromosome, each table
+# is read once per chromosome, ordered by start, through an unbuffered
+# (server-side) cursor and swept against the records: rows whose start has
+# been reached go on a heap keyed by end and are dropped once a record lies
+# past their end, so the heap holds exactly the rows overlapping the
+# current position. One sequential scan per chromosome replaces a query
+# per record.
+#
+# A record out of order (before the previous position, or on a chromosome
+# already swept) switches the stage back to point queries for the rest of
+# the run. Rows overlapping a record come back in start order rather than
+# in whatever order the point query would have returned them.
+#
+# When the records of several jobs are annotated together (see
+# driver.runJobs()), each job's records are swept on their own: the sweep
+# starts over, merge join on, at the first record of every job.
+#
+##
+
+import heapq
+
+import backends as be
+import utils as u
+
+"""Rows fetched from the stream at a time
+"""
+STREAM_CHUNK = 1000
+
+
+def streamRows(cursor, size=STREAM_CHUNK):
+    while True:
+        rows = cursor.fetchmany(size)
+        if (len(rows) == 0):
+            return
+        for row in rows:
+            yield row
+
+
+"""Answers an OverlapAnnotator's lookups by merge join; uses a pooled
+   connection of its own for the stream
+"""
+class MergeJoin(object):
+    def __init__(self, annotator):
+        self.annotator = annotator
+        self.active = True
+        self.conn = None
+        self.cursor = None
+        self.stream = None      # (table, chrom) being swept
+        self.swept = set([])
+        self.rows = None
+        self.pending = None
+        self.heap = []
+        self.seq = 0
+        self.last = None
+        self.job = None
+
+    def lookupBatch(self, records):
+        results = []
+        i = 0
+        while (i < len(records)):
+            if (records[i].job != self.job):
+                self.startJob(records[i].job)
+            if not self.active:
+                # the rest of the job's records, by point queries
+                end = i + 1
+                while (end < len(records) and records[end].job == self.job):
+                    end = end + 1
+                results.extend(self.annotator.lookupBatch(records[i:end]))
+                i = end
+                continue
+            results.append(self.lookup(records[i]))
+            i = i + 1
+        return results
+
+    """True when some of records are to be looked up by merge join: it is
+       on, or they start another job
+    """
+    def handles(self, records):
+        return self.active or (len(records) > 0 and 
+            records[-1].job != self.job)
+
+    """Starts the sweep over for the records of another job
+    """
+    def startJob(self, job):
+        self.closeStream()
+        self.swept = set([])
+        self.active = True
+        self.last = None
+        self.job = job
+
+    def lookup(self, fields):
+        annotator = self.annotator
+        target = annotator.target(fields)
+        if (target is None):
+            return None if annotator.fetchone else []
+
+        (table, chrom, pos) = target
+        if annotator.fromSnapshot(table):
+            return annotator.lookup(fields)
+
+        pos = int(pos)
+        if (self.stream != (table, chrom)):
+            if (table, chrom) in self.swept:
+                return self.fallback(fields, f"{table} {chrom} again")
+            self.open(table, chrom)
+        elif (pos < self.last):
+            return self.fallback(fields, f"{chrom}:{pos} after {self.last}")
+        self.last = pos
+
+        rows = self.overlapping(pos)
+        if annotator.fetchone:
+            return rows[0] if len(rows) > 0 else None
+        return rows
+
+    def open(self, table, chrom):
+        self.closeStream()
+        if (self.conn is None):
+            self.conn = u.db_connect()
+
+        annotator = self.annotator
+        columns = '*' if (annotator.columns is None) else \
+            ', '.join(annotator.columns)
+        sql = 'select ' + columns + ' from ' + table
+        params = []
+        if (annotator.chromName is not None):
+            sql = sql + ' where ' + annotator.chromName + '=%s'
+            params.append(chrom)
+
+        self.cursor = be.streamingCursor(self.conn)
+        self.cursor.execute(sql + ' order by ' + annotator.startName, params)
+        names = [d[0] for d in self.cursor.description]
+        self.startInd = names.index(annotator.startName)
+        self.endInd = names.index(annotator.endName)
+
+        self.stream = (table, chrom)
+        self.rows = streamRows(self.cursor)
+        self.pending = next(self.rows, None)
+        self.heap = []
+        self.last = None
+
+    """Rows with start <= pos <= end, in stream order
+    """
+    def overlapping(self, pos):
+        while (self.pending is not None and
+            (self.pending[self.startInd] is None or
+            self.pending[self.startInd] <= pos)):
+            row = self.pending
+            if (row[self.startInd] is not None and
+                row[self.endInd] is not None):
+                heapq.heappush(self.heap, (row[self.endInd], self.seq, row))
+                self.seq = self.seq + 1
+            self.pending = next(self.rows, None)
+
+        while (len(self.heap) > 0 and self.heap[0][0] < pos):
+            heapq.heappop(self.heap)
+        return [row for (end, seq, row) in
+            sorted(self.heap, key=lambda entry: entry[1])]
+
+    def fallback(self, fields, reason):
+        print(f"Input not sorted ({reason}): {self.annotator.label} " + \
+            "falls back to point queries")
+        self.close()
+        self.active = False
+        return self.annotator.lookup(fields)
+
+    def closeStream(self):
+        if (self.cursor is not None):
+            self.cursor.close()
+            self.swept.add(self.stream)
+        self.cursor = None
+        self.stream = None
+        self.rows = None
+        self.pending = None
+        self.heap = []
+
+    def close(self):
+        self.closeStream()
+        if (self.conn is not None):
+            self.conn.close()
+            self.conn = None
+
+### EOF
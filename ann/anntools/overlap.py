@@ -0,0 +1,74 @@
+# overlap.py
+#
+# Vectorized interval overlap with NumPy. Given the variant positions of
+# one chromosome and the intervals of a table sorted by start, finds every
+# (variant, interval) pair with start - offset <= pos <= end + offset using
+# two searchsorted calls instead of one query or bisect per variant.
+#
+##
+
+import numpy as np
+
+
+"""Candidate intervals for each position are those with
+   pos - offset - maxLength <= start <= pos + offset, where maxLength is the
+   longest interval (end - start) of the table; the window is then filtered
+   on end. Returns two int64 arrays (variant index, interval index), sorted
+   by variant and then by start.
+"""
+def findOverlaps(positions, starts, ends, maxLength, offset=0):
+    positions = np.asarray(positions, dtype=np.int64)
+    starts = np.asarray(starts, dtype=np.int64)
+    ends = np.asarray(ends, dtype=np.int64)
+
+    lo = np.searchsorted(starts, positions - offset - maxLength, side='left')
+    hi = np.searchsorted(starts, positions + offset, side='right')
+    counts = hi - lo
+
+    total = int(counts.sum())
+    if (total == 0):
+        empty = np.zeros(0, dtype=np.int64)
+        return (empty, empty)
+
+    variants = np.repeat(np.arange(len(positions), dtype=np.int64), counts)
+    # position of each candidate within its variant's window
+    first = np.cumsum(counts) - counts
+    intervals = lo[variants] + \
+        (np.arange(total, dtype=np.int64) - first[variants])
+
+    keep = positions[variants] <= ends[intervals] + offset
+    return (variants[keep], intervals[keep])
+
+
+"""Groups the pairs returned by findOverlaps per variant, each group in
+   'order' (the rowid of every interval, so hits come back in table order).
+   With fetchone, returns one interval index per variant, or -1 for no hit;
+   otherwise a list of interval index arrays.
+"""
+def groupOverlaps(nvariants, variants, intervals, order=None, fetchone=False):
+    if (order is not None and len(intervals) > 1):
+        sort = np.lexsort((np.asarray(order)[intervals], variants))
+        variants = variants[sort]
+        intervals = intervals[sort]
+
+    bounds = np.searchsorted(variants, np.arange(nvariants + 1))
+    if fetchone:
+        first = np.full(nvariants, -1, dtype=np.int64)
+        found = bounds[1:] > bounds[:-1]
+        first[found] = intervals[bounds[:-1][found]]
+        return first
+
+    return [intervals[bounds[i]:bounds[i + 1]] for i in range(nvariants)]
+
+
+"""Overlaps for a batch of positions: fetchone selects the first hit (or -1)
+   per position, as cursor.fetchone() would, otherwise all hits
+"""
+def overlapBatch(positions, starts, ends, maxLength, offset=0, order=None,
+    fetchone=False):
+    (variants, intervals) = findOverlaps(positions, starts, ends, maxLength,
+        offset)
+    return groupOverlaps(len(positions), variants, intervals, order=order,
+        fetchone=fetchone)
+
+### EOF
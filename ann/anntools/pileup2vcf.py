@@ -13,10 +13,12 @@ __author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
 import os
 import datetime
 import file_utils as fu
+import vcfmap
 
 HETERO = {'M':'AC', 'R':'AG', 'W':'AT', 'S':'CG', 'Y':'CT', 'K':'GT'}
 ACCEPTED_CHR = ["1", "2", "3", "4", "5", "6", "7", "8", "9", "10", "11", "12", "13", 
                 "14", "15", "16", "17", "18", "19", "20","21","22", "X", "Y", "MT"]
+ACCEPTED_CHR_BYTES = frozenset([chr.encode('utf-8') for chr in ACCEPTED_CHR])
 #http://www.broadinstitute.org/gsa/wiki/index.php/Understanding_the_Unified_Genotyper's_VCF_files
 
 def count_alt(depth, bases):
@@ -117,32 +119,41 @@ def filter_pileup(pileup, outfile=None, chr_col=0,
             fh_out.write(varpileup_line2vcf_line(fields[0:9]) + '\n' )
 
 
-"""Removes lines where ALT==REF and chromosomes other than 1 - 22, X, Y and MT
+"""Removes lines where ALT==REF and chromosomes other than 1 - 22, X, Y and MT.
+   Works on the mapped bytes: lines are neither decoded nor split past 
+   the columns compared.
 """
 def filter_vcf(pileup, outfile=None,  chr_col=0, ref_col=3, 
     alt_col=4, sep='\t'):
 
-    fh = open(pileup, "r")
+    mapped = vcfmap.MappedVcf(pileup)
     if (outfile is None):
         outfile = pileup + '.filt'
 
     fu.delete(outfile)
-    fh_out = open(outfile, "w")
+    fh_out = open(outfile, "wb")
 
+    for line in mapped.header().split(b'\n'):
+        line = line.strip()
+        if (len(line) > 0):
+            fh_out.write(line + b'\n')
 
-    for line in fh:
+    bsep = sep.encode('utf-8')
+    last = max(chr_col, ref_col, alt_col, 7)
+    for line in mapped.lines():
         line = line.strip()
-        if line.startswith('#'):
-            fh_out.write(str(line)+'\n')
+        if line.startswith(b'#'):
+            fh_out.write(line + b'\n')
         else:
-            fields = line.split(sep)
-            if (len(fields) >= 8):
-                chr = str(fields[chr_col])
-                ref = str(fields[ref_col])
-                alt = str(fields[alt_col])
-
-                if ((alt != ref) and \
-                    (fu.find_first_index(ACCEPTED_CHR, chr.strip()) > -1)):
-                    fh_out.write(str(line) + '\n')
-
-### EOF
\ No newline at end of file
+            fields = line.split(bsep, last + 1)
+            if (len(fields) >= 8 and len(fields) > last):
+                chr = fields[chr_col]
+                ref = fields[ref_col]
+                alt = fields[alt_col]
+
+                if ((alt != ref) and (chr.strip() in ACCEPTED_CHR_BYTES)):
+                    fh_out.write(line + b'\n')
+    fh_out.close()
+    mapped.close()
+
+### EOF
@@ -1,6 +1,9 @@
 import sys
 import time
 import driver
+import tabix
+import transfer
+import dedup
 import copy
 import os
 import boto3
@@ -29,10 +32,40 @@ annotations_table_name = config.get('DYNAMODB', 'annotations_table', fallback=''
 
 # S3 configurations
 results_bucket = config.get('S3', 'results_bucket', fallback='')
+multipart_chunk_mb = config.getint('S3', 'multipart_chunk_mb', fallback=16)
+max_concurrency = config.getint('S3', 'max_concurrency', fallback=10)
+stream_transfers = config.getboolean('S3', 'stream_transfers', 
+    fallback=False)
+transfer_config = transfer.transferConfig(multipart_chunk_mb, 
+    max_concurrency)
 
 # User configurations
 username = config.get('USER', 'username', fallback='')
 
+# AnnTools configurations
+pipeline_mode = config.get('ANNTOOLS', 'pipeline_mode', fallback='staged')
+batch_size = config.getint('ANNTOOLS', 'batch_size', fallback=500)
+snapshot_dir = config.get('ANNTOOLS', 'snapshot_dir', fallback='')
+workers = config.getint('ANNTOOLS', 'workers', fallback=1)
+connections = config.getint('ANNTOOLS', 'connections', fallback=1)
+query_depth = config.getint('ANNTOOLS', 'query_depth', fallback=1)
+cache_path = config.get('ANNTOOLS', 'cache_path', fallback='')
+cache_max_mb = config.getint('ANNTOOLS', 'cache_max_mb', fallback=1024)
+reference_version = config.get('ANNTOOLS', 'reference_version', fallback='')
+reference_backend = config.get('ANNTOOLS', 'reference_backend', 
+    fallback='mysql')
+reference_path = config.get('ANNTOOLS', 'reference_path', fallback='')
+overlap_join = config.get('ANNTOOLS', 'overlap_join', fallback='point')
+compress_intermediates = config.getboolean('ANNTOOLS', 
+    'compress_intermediates', fallback=False)
+compress_output = config.getboolean('ANNTOOLS', 'compress_output', 
+    fallback=False)
+index_output = config.getboolean('ANNTOOLS', 'index_output', fallback=True)
+
+# Dedup configurations
+dedup_jobs = config.getboolean('DEDUP', 'dedup_jobs', fallback=False)
+metrics_namespace = config.get('DEDUP', 'metrics_namespace', fallback='')
+
 """A rudimentary timer for coarse-grained profiling
 """
 
@@ -40,6 +73,13 @@ username = config.get('USER', 'username', fallback='')
 dynamo = boto3.resource('dynamodb')
 table = dynamo.Table(annotations_table_name) 
 
+# S3 client for the uploads, created once per process
+session = boto3.Session()
+s3_client = session.client('s3', region_name=region_name,config=Config(signature_version=signature_version))  
+
+# dedup hits and misses are counted in CloudWatch when a namespace is set
+cloudwatch = boto3.client('cloudwatch') if metrics_namespace else None
+
 class Timer(object):
   def __init__(self, verbose=True):
     self.verbose = verbose
@@ -95,45 +135,209 @@ def notify_user(job_id,user_email):
 
 
 
+"""Annotates input_file_name with the [ANNTOOLS] options; stream as for
+   driver.run()
+"""
+def annotate(input_file_name, stream=None):
+    with Timer():
+        driver.run(input_file_name, 'vcf', mode=pipeline_mode, 
+            batch_size=batch_size, snapshot_dir=snapshot_dir, 
+            workers=workers, connections=connections, depth=query_depth,
+            cache_path=cache_path, cache_max_mb=cache_max_mb, 
+            reference_version=reference_version, 
+            backend=reference_backend, reference_path=reference_path,
+            overlap_join=overlap_join, 
+            compress_intermediates=compress_intermediates,
+            compress_output=compress_output, stream=stream)
+
+
+"""Dedup key of a job's input (see dedup.py), or None when dedup is off or
+   the reference version is not known
+"""
+def dedup_key(input_file_name):
+    if not dedup_jobs:
+        return None
+    version = driver.referenceVersion(reference_version, snapshot_dir)
+    if not version:
+        print("No reference_version or snapshot_dir: dedup disabled")
+        return None
+    return dedup.jobKey(input_file_name, version, 
+        {'compress_output': compress_output, 'overlap_join': overlap_join})
+
+
+def delete_job_files(job_folder):
+    for root, dirs, files in os.walk(job_folder, topdown=False):
+        for name in files:
+          os.remove(os.path.join(root, name))
+    for name in dirs:
+        os.rmdir(os.path.join(root, name))
+    os.rmdir(job_folder)
+
+
+"""Local files and result keys of the job whose input is input_file_name
+"""
+def job_files(input_file_name):
+    original_uuid = os.path.dirname(input_file_name).split("/")[-1]
+    annotated_file = driver.annotatedName(input_file_name, 
+        compress_output)
+    log_file = driver.countLogName(input_file_name)
+    s3_key_result_file = f"{username}/{username}/{original_uuid}~{os.path.basename(annotated_file)}"
+    s3_key_log_file = f"{username}/{username}/{original_uuid}~{os.path.basename(log_file)}"
+    return {'job_id': original_uuid, 
+        'job_folder': os.path.dirname(input_file_name),
+        'input': input_file_name, 'result_file': annotated_file, 
+        'log_file': log_file, 
+        's3_keys': {'result': s3_key_result_file, 'log': s3_key_log_file,
+            'index': s3_key_result_file + '.tbi'}}
+
+
+"""Completes the job with a copy of the results recorded under its dedup
+   key, if there are any; True when it did
+"""
+def reuse_results(job, key, user_email):
+    if (key is None):
+      return False
+    results = dedup.findResults(s3_client, results_bucket, username, key)
+    if (results is None):
+      return False
+    s3_keys = job['s3_keys']
+    if not dedup.copyResults(s3_client, results_bucket, results, s3_keys,
+        transfer_config):
+      # archived and deleted since: annotate again (a miss)
+      print(f"Dedup record {key} points to deleted results, removing it")
+      dedup.forgetResults(s3_client, results_bucket, username, key)
+      return False
+    update_dynamodb(job['job_id'], results_bucket, s3_keys['result'], 
+        s3_keys['log'])
+    notify_user(job_id=job['job_id'],user_email=user_email)
+    dedup.countJob(key, True, cloudwatch, metrics_namespace)
+    delete_job_files(job['job_folder'])
+    return True
+
+
+"""Uploads the results of an annotated job (unless streamed), marks it 
+   completed, notifies the user, records its results under its dedup key 
+   and deletes its local files
+"""
+def finish_job(job, user_email, key=None, streamed=False):
+    annotated_file = job['result_file']
+    log_file = job['log_file']
+    s3_keys = job['s3_keys']
+
+    # map to local files, upload to s3 result bucket (unless streamed)
+    uploaded = {}
+    if os.path.exists(annotated_file):
+      if not streamed:
+        transfer.upload(s3_client, annotated_file, results_bucket, 
+            s3_keys['result'], transfer_config)
+      uploaded['result'] = s3_keys['result']
+      # tabix index next to a compressed result, for ranged region reads
+      if (compress_output and index_output):
+        # a result that cannot be indexed is still a result
+        try:
+          index_file = tabix.writeIndex(annotated_file)
+        except Exception as e:
+          print(f"An error occurred while indexing {annotated_file}: " + \
+              f"{str(e)}")
+          index_file = None
+        if (index_file is not None):
+          transfer.upload(s3_client, index_file, results_bucket, 
+              s3_keys['index'], transfer_config)
+          uploaded['index'] = s3_keys['index']
+    if os.path.exists(log_file):
+      #add uuid
+      transfer.upload(s3_client, log_file, results_bucket, s3_keys['log'],
+          transfer_config)
+      uploaded['log'] = s3_keys['log']
+
+
+    update_dynamodb(job['job_id'], results_bucket, s3_keys['result'], s3_keys['log'])
+    notify_user(job_id=job['job_id'],user_email=user_email)
+    # later jobs with the same input copy these results
+    if (key is not None and 'result' in uploaded):
+      dedup.recordResults(s3_client, results_bucket, username, key, uploaded)
+      dedup.countJob(key, False, cloudwatch, metrics_namespace)
+    # delete all local job files
+    delete_job_files(job['job_folder'])
+
+
+"""Annotates a job's input, uploads the results, marks the job completed,
+   notifies the user and deletes the job's local files. With 
+   s3_inputs_bucket, the input is fetched from S3 first, or streamed 
+   through the pipeline (stream_transfers). With dedup_jobs, a job whose
+   input was already annotated gets a copy of the earlier results instead.
+"""
+def run_job(input_file_name, s3_key_input_file, user_email, 
+    s3_inputs_bucket=None):
+    job = job_files(input_file_name)
+
+    # only the fused pipeline with one worker reads its input once, in order
+    stream = None
+    if (s3_inputs_bucket is not None):
+      if (stream_transfers and pipeline_mode == 'fused' and workers <= 1):
+        stream = (transfer.StreamingDownload(s3_client, s3_inputs_bucket, 
+            s3_key_input_file, input_file_name, transfer_config),
+          transfer.openResult(s3_client, results_bucket, 
+            job['s3_keys']['result'], job['result_file'], transfer_config, 
+            compress_output))
+      else:
+        transfer.download(s3_client, s3_inputs_bucket, s3_key_input_file, 
+            input_file_name, transfer_config)
+
+    # a streamed input is not local until it has been annotated
+    key = dedup_key(input_file_name) if (stream is None) else None
+    if reuse_results(job, key, user_email):
+      return
+
+    annotate(input_file_name, stream)
+    finish_job(job, user_email, key, streamed=(stream is not None))
+
+
+"""Runs several small jobs, each a (input_file_name, s3_key_input_file,
+   user_email) with its input already local, as one combined annotation 
+   pass (driver.runJobs()); each job is then completed as run_job() 
+   completes it, with its own results, status update and notification
+"""
+def run_batch(batch):
+    jobs = []
+    for (input_file_name, s3_key_input_file, user_email) in batch:
+      job = job_files(input_file_name)
+      key = dedup_key(input_file_name)
+      if not reuse_results(job, key, user_email):
+        jobs.append((job, user_email, key))
+    if (len(jobs) == 0):
+      return
+
+    with Timer():
+      driver.runJobs([job['input'] for (job, user_email, key) in jobs], 
+          'vcf', batch_size=batch_size, snapshot_dir=snapshot_dir, 
+          connections=connections, cache_path=cache_path, 
+          cache_max_mb=cache_max_mb, reference_version=reference_version, 
+          backend=reference_backend, reference_path=reference_path,
+          overlap_join=overlap_join, compress_output=compress_output)
+    # a job that cannot be completed does not keep the others from it
+    failed = []
+    for (job, user_email, key) in jobs:
+      try:
+        finish_job(job, user_email, key)
+      except Exception as e:
+        print(f"An error occurred while completing job {job['job_id']}: " + \
+            f"{str(e)}")
+        failed.append(job['job_id'])
+    if (len(failed) > 0):
+      raise RuntimeError(f"Jobs not completed: {', '.join(failed)}")
+
+
 if __name__ == '__main__':
     
 
-    if len(sys.argv) > 1:
-        with Timer():
-            driver.run(sys.argv[1], 'vcf')
-        session = boto3.Session()
-        s3_client = session.client('s3', region_name=region_name,config=Config(signature_version=signature_version))  
-        input_file_name = copy.deepcopy(sys.argv[1])
-
-        s3_key_input_file= copy.deepcopy(sys.argv[3])
-        user_email=copy.deepcopy(sys.argv[4])
-        user_id = s3_key_input_file.split('/')[0]
-
-        original_uuid = os.path.dirname(input_file_name).split("/")[-1]
-        results_bucket = results_bucket
-        job_folder = os.path.dirname(input_file_name)
-
-  
-        # map to local files, upload to s3 result bucket
-        annotated_file = input_file_name.replace('.vcf', '.annot.vcf')
-        if os.path.exists(annotated_file):
-          s3_key_result_file = f"{username}/{username}/{original_uuid}~{os.path.basename(annotated_file)}"
-          s3_client.upload_file(annotated_file, results_bucket, s3_key_result_file)
-        log_file = input_file_name.replace('.vcf', '.vcf.count.log')
-        if os.path.exists(log_file):
-          #add uuid
-          s3_key_log_file = f"{username}/{username}/{original_uuid}~{os.path.basename(log_file)}"
-          s3_client.upload_file(log_file, results_bucket, s3_key_log_file)
-
-
-        update_dynamodb(original_uuid, results_bucket, s3_key_result_file, s3_key_log_file)
-        notify_user(job_id=original_uuid,user_email=user_email)
-        # delete all local job files
-        for root, dirs, files in os.walk(job_folder, topdown=False):
-            for name in files:
-              os.remove(os.path.join(root, name))
-        for name in dirs:
-            os.rmdir(os.path.join(root, name))
-        os.rmdir(job_folder)
+    if (len(sys.argv) > 2 and sys.argv[1] == 'batch'):
+        # small jobs annotated together: a JSON list of run_job() arguments
+        run_batch(json.loads(sys.argv[2]))
+    elif len(sys.argv) > 1:
+        # the inputs bucket is given when the input is still in S3
+        run_job(copy.deepcopy(sys.argv[1]), copy.deepcopy(sys.argv[3]), 
+            copy.deepcopy(sys.argv[4]), 
+            sys.argv[5] if len(sys.argv) > 5 else None)
     else:
         print("A valid .vcf file must be provided as input to this program.")
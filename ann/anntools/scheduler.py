@@ -0,0 +1,77 @@
+# scheduler.py
+#
+# Runs the annotators of the fused pipeline as a dependency graph. For each
+# batch of records, the stages whose dependencies have been applied look
+# up the batch concurrently, each on a database connection taken from a
+# shared set; once the whole level has been looked up, the results are
+# applied one stage at a time in pipeline order, so INFO is written exactly
+# as annotate.annotateRecords() writes it.
+#
+##
+
+import queue
+from concurrent.futures import ThreadPoolExecutor
+
+
+"""stages is a list of (name, annotator, dependencies) in pipeline order; a
+   stage may only depend on stages before it. cursors are the database
+   cursors to share between concurrent lookups, one per connection.
+"""
+class StageGraph(object):
+    def __init__(self, stages, cursors):
+        self.names = [name for (name, annotator, deps) in stages]
+        self.annotators = [annotator for (name, annotator, deps) in stages]
+        self.deps = [deps for (name, annotator, deps) in stages]
+        self.levels = self.schedule()
+
+        self.cursors = queue.Queue()
+        for cursor in cursors:
+            self.cursors.put(cursor)
+        self.pool = ThreadPoolExecutor(max_workers=len(cursors))
+
+    """Groups the stages into levels that can be looked up together. A
+       stage's level is past those of its dependencies and never before
+       the previous stage's, so applying level by level keeps stage order.
+    """
+    def schedule(self):
+        stageLevel = []
+        for i in range(0, len(self.names)):
+            level = stageLevel[-1] if i > 0 else 0
+            for dep in self.deps[i]:
+                if dep not in self.names[:i]:
+                    raise ValueError(f"Stage {self.names[i]} depends on " + \
+                        f"{dep}, which is not an earlier stage")
+                level = max(level, stageLevel[self.names.index(dep)] + 1)
+            stageLevel.append(level)
+
+        levels = [[] for level in range(0, max(stageLevel + [-1]) + 1)]
+        for i in range(0, len(stageLevel)):
+            levels[stageLevel[i]].append(i)
+        return levels
+
+    def lookup(self, i, records):
+        cursor = self.cursors.get()
+        try:
+            self.annotators[i].cursor = cursor
+            return self.annotators[i].results(records)
+        finally:
+            self.cursors.put(cursor)
+
+    def annotateRecords(self, records):
+        for level in self.levels:
+            futures = [self.pool.submit(self.lookup, i, records)
+                for i in level]
+            # applying edits the records the lookups read (position, locus),
+            # so none is applied until the whole level has been looked up
+            levelResults = [future.result() for future in futures]
+            for k in range(0, len(level)):
+                results = levelResults[k]
+                if (level[k] > 0):
+                    for fields in records:
+                        fields.restrip()
+                self.annotators[level[k]].applyBatch(records, results)
+
+    def close(self):
+        self.pool.shutdown()
+
+### EOF
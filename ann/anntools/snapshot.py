@@ -0,0 +1,711 @@
+# snapshot.py
+#
+# Memory-mapped columnar snapshot of the annotator reference database.
+#
+# Each table is split per chromosome and sorted by position; every column
+# is written to its own file (fixed width values, or offsets plus data for
+# strings) so that readers can mmap them and annotator processes on the
+# same host share one copy in the page cache. A manifest records the
+# snapshot version and the layout of every table.
+#
+# The exact-match tables (dbSNP and chrom_pos_equal_*) are exported the
+# same way, sorted by (chromosome, position), with a hash index over those
+# keys (see hashindex.py) instead of partitions.
+#
+# Tables are read through a streaming cursor and spilled to disk as they
+# arrive; only the sort keys are held in memory (as int64 arrays, sorted
+# with NumPy), so dbSNP can be exported on a host that cannot hold it.
+#
+# Usage: python snapshot.py build <snapshot_dir> [version]
+#
+##
+
+import os
+import sys
+import json
+import mmap
+import pickle
+import shutil
+import bisect
+import decimal
+from array import array
+from datetime import datetime
+
+import numpy as np
+
+import file_utils as fu
+import overlap as ov
+import hashindex as hi
+import backends as be
+import annotate as ann
+import utils as u
+
+"""Tables exported to a snapshot: (chrom column, start column, end column).
+   A chrom column of None keeps the whole table in one partition; the
+   tfbsConsSites tables are already split by chromosome.
+"""
+SNAPSHOT_TABLES = {
+    'refGene': ('chrom', 'txStart', 'txEnd'),
+    'cpgIslandExt': ('chrom', 'chromStart', 'chromEnd'),
+    'cytoBand': ('chrom', 'chromStart', 'chromEnd'),
+    'gadAll': ('chromosome', 'chromStart', 'chromEnd'),
+    'gwasCatalog': ('chrom', 'chromEnd', 'chromEnd'),
+    'targetScanS': ('chrom', 'chromStart', 'chromEnd'),
+    'hugo': ('chrom', 'chromStart', 'chromEnd'),
+    'dgv_Cnv': ('chrom', 'chromStart', 'chromEnd'),
+    'abParts_IG_T_CelReceptors': ('chrom', 'chromStart', 'chromEnd'),
+    'mcCarroll_Cnv': ('chrom', 'chromStart', 'chromEnd'),
+    'conrad_Cnv': ('chrom', 'chromStart', 'chromEnd'),
+    'genomicSuperDups': ('chrom', 'chromStart', 'chromEnd')}
+
+for chrIndex in ann.TfbsConsSitesAnnotator.allowed_chrom:
+    SNAPSHOT_TABLES['tfbsConsSites' + chrIndex] = \
+        (None, 'chromStart', 'chromEnd')
+
+"""Tables exported with a hash index: (chrom column, position column)
+"""
+INDEX_TABLES = {
+    'dbSNP': ('CHR', 'POS'),
+    'chrom_pos_equal_base': ('CHR', 'start'),
+    'chrom_pos_equal_nobase': ('CHR', 'start')}
+
+ALL_CHROMS = '*'
+MANIFEST = 'manifest.json'
+CURRENT = 'CURRENT'
+
+"""Column kinds: i = int64, f = float64, and variable length values stored
+   as offsets + data: s = str, b = bytes, d = Decimal. Anything else (dates
+   for instance) is stored as its str(), which is all the annotators use.
+"""
+FIXED_WIDTH = {'i': 'q', 'f': 'd'}
+
+"""Rows fetched from the database, and values written to a column file,
+   at a time
+"""
+READ_CHUNK = 10000
+WRITE_CHUNK = 65536
+
+
+"""Kinds (see FIXED_WIDTH) of the values, added to the set kinds
+"""
+def addKinds(kinds, values):
+    for v in values:
+        if v is None:
+            continue
+        elif isinstance(v, bool) or isinstance(v, int):
+            kinds.add('i')
+        elif isinstance(v, float):
+            kinds.add('f')
+        elif isinstance(v, decimal.Decimal):
+            kinds.add('d')
+        elif isinstance(v, (bytes, bytearray)):
+            kinds.add('b')
+        else:
+            kinds.add('s')
+    return kinds
+
+
+"""Column kind of a column whose values have the kinds in the set kinds
+"""
+def kindOf(kinds):
+    if (len(kinds) == 1):
+        return list(kinds)[0]
+    elif (len(kinds) == 0):
+        return 'i'
+    return 's'
+
+
+def columnKind(values):
+    return kindOf(addKinds(set([]), values))
+
+
+"""Writes one column a chunk of values at a time, in the layout Column
+   reads; the .nul file is only kept when some value is None
+"""
+class ColumnWriter(object):
+    def __init__(self, path, kind):
+        self.path = path
+        self.kind = kind
+        self.values = []
+        self.nulls = open(path + '.nul', 'wb')
+        self.hasNulls = False
+        if kind in FIXED_WIDTH:
+            self.fh = open(path + '.col', 'wb')
+        else:
+            self.fh = open(path + '.dat', 'wb')
+            self.offsets = open(path + '.off', 'wb')
+            self.offset = 0
+            array('q', [0]).tofile(self.offsets)
+
+    def add(self, value):
+        self.values.append(value)
+        if (len(self.values) >= WRITE_CHUNK):
+            self.flush()
+
+    def flush(self):
+        values = self.values
+        self.values = []
+        nulls = array('B', [1 if v is None else 0 for v in values])
+        self.hasNulls = self.hasNulls or (1 in nulls)
+        nulls.tofile(self.nulls)
+
+        if self.kind in FIXED_WIDTH:
+            array(FIXED_WIDTH[self.kind], 
+                [0 if v is None else v for v in values]).tofile(self.fh)
+            return
+
+        offsets = array('q')
+        for v in values:
+            if (v is None):
+                data = b''
+            elif (self.kind == 'b'):
+                data = bytes(v)
+            else:
+                data = str(v).encode('utf-8')
+            self.fh.write(data)
+            self.offset = self.offset + len(data)
+            offsets.append(self.offset)
+        offsets.tofile(self.offsets)
+
+    def close(self):
+        self.flush()
+        self.fh.close()
+        if self.kind not in FIXED_WIDTH:
+            self.offsets.close()
+        self.nulls.close()
+        if not self.hasNulls:
+            os.remove(self.path + '.nul')
+
+
+def writeColumn(path, kind, values):
+    writer = ColumnWriter(path, kind)
+    for v in values:
+        writer.add(v)
+    writer.close()
+
+
+"""Rows of a table as they are read, kept on disk (pickled, with their 
+   offsets) so that they can be written out in another order without 
+   holding the table in memory
+"""
+class RowSpill(object):
+    def __init__(self, path):
+        self.path = path
+        self.fh = open(path + '.dat', 'wb')
+        self.offsetsFh = open(path + '.off', 'wb')
+        self.offset = 0
+        self.pending = array('q', [0])
+        self.data = None
+
+    def add(self, row):
+        data = pickle.dumps(tuple(row), pickle.HIGHEST_PROTOCOL)
+        self.fh.write(data)
+        self.offset = self.offset + len(data)
+        self.pending.append(self.offset)
+        if (len(self.pending) >= WRITE_CHUNK):
+            self.pending.tofile(self.offsetsFh)
+            self.pending = array('q')
+
+    """Stops writing and maps the rows for row()
+    """
+    def seal(self):
+        self.pending.tofile(self.offsetsFh)
+        self.fh.close()
+        self.offsetsFh.close()
+        self.data = mapFile(self.path + '.dat')
+        self.offsets = np.fromfile(self.path + '.off', dtype=np.int64)
+
+    def row(self, rowid):
+        return pickle.loads(self.data[self.offsets[rowid]:
+            self.offsets[rowid + 1]])
+
+    def remove(self):
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
+        self.data = None
+        os.remove(self.path + '.dat')
+        os.remove(self.path + '.off')
+
+
+"""Reads table through a streaming cursor, fetchmany() at a time: calls
+   describe(column names), then spills every row to tabledir and calls 
+   keep(row, rowid) on it. Returns the column names, the column kinds 
+   (from every value, as columnKind() gives them), the number of rows 
+   and the RowSpill.
+"""
+def streamTable(conn, table, tabledir, keep, describe):
+    fu.mkdirp(tabledir)
+    spill = RowSpill(os.path.join(tabledir, '_rows'))
+    cursor = be.streamingCursor(conn)
+    cursor.execute('select * from ' + table + ';')
+    names = [str(d[0]) for d in cursor.description]
+    kinds = [set([]) for name in names]
+    describe(names)
+
+    rowid = 0
+    while True:
+        rows = cursor.fetchmany(READ_CHUNK)
+        if (len(rows) == 0):
+            break
+        for i in range(len(names)):
+            addKinds(kinds[i], [row[i] for row in rows])
+        for row in rows:
+            spill.add(row)
+            keep(row, rowid)
+            rowid = rowid + 1
+    cursor.close()
+    spill.seal()
+    return (names, [kindOf(k) for k in kinds], rowid, spill)
+
+
+"""Writes the spilled rows rowids, in that order, one file set per column
+"""
+def writeRows(spill, rowids, kinds, outdir):
+    writers = [ColumnWriter(os.path.join(outdir, str(i)), kinds[i])
+        for i in range(len(kinds))]
+    for rowid in rowids:
+        row = spill.row(rowid)
+        for i in range(len(kinds)):
+            writers[i].add(row[i])
+    for writer in writers:
+        writer.close()
+
+
+"""Exports one table, returns its manifest entry. Rows are streamed to 
+   disk as they are read; only their (partition, start, end, rowid) are 
+   kept in memory, and sorted with NumPy.
+"""
+def exportTable(conn, table, spec, tabledir):
+    (chromCol, startCol, endCol) = spec
+
+    # rows that can never satisfy "start <= pos AND pos <= end" are dropped;
+    # the export order is kept as _rowid so hits come back in that order
+    chroms = {}
+    codes = array('q')
+    starts = array('q')
+    ends = array('q')
+    rowids = array('q')
+    inds = {}
+
+    def keep(row, rowid):
+        chrom = ALL_CHROMS if inds['chrom'] is None else row[inds['chrom']]
+        if (chrom is None or row[inds['start']] is None or 
+            row[inds['end']] is None):
+            return
+        codes.append(chroms.setdefault(str(chrom), len(chroms)))
+        starts.append(int(row[inds['start']]))
+        ends.append(int(row[inds['end']]))
+        rowids.append(rowid)
+
+    def description(names):
+        inds['start'] = names.index(startCol)
+        inds['end'] = names.index(endCol)
+        inds['chrom'] = None if chromCol is None else names.index(chromCol)
+
+    (names, kinds, count, spill) = streamTable(conn, table, tabledir, keep,
+        description)
+
+    meta = {'columns': [[names[i], kinds[i]] for i in range(len(names))],
+        'chrom': chromCol, 'start': startCol, 'end': endCol,
+        'rows': count, 'partitions': {}}
+
+    # partitions in chromosome name order, rows by (start, rowid) in each
+    chromNames = sorted(chroms)
+    ranks = np.zeros(len(chroms), dtype=np.int64)
+    for rank in range(len(chromNames)):
+        ranks[chroms[chromNames[rank]]] = rank
+    parts = ranks[np.array(codes, dtype=np.int64)]
+    starts = np.array(starts, dtype=np.int64)
+    ends = np.array(ends, dtype=np.int64)
+    rowids = np.array(rowids, dtype=np.int64)
+    order = np.lexsort((rowids, starts, parts))
+    bounds = np.searchsorted(parts[order], np.arange(len(chromNames) + 1))
+
+    for pnum in range(len(chromNames)):
+        rows = order[bounds[pnum]:bounds[pnum + 1]]
+        pdir = os.path.join(tabledir, 'p' + str(pnum))
+        fu.mkdirp(pdir)
+
+        writeRows(spill, rowids[rows], kinds, pdir)
+        writeColumn(os.path.join(pdir, '_rowid'), 'i', rowids[rows].tolist())
+
+        maxLength = int(np.max(ends[rows] - starts[rows]))
+        meta['partitions'][chromNames[pnum]] = {'dir': 'p' + str(pnum),
+            'rows': len(rows), 'maxLength': max(maxLength, 0)}
+
+    spill.remove()
+    if (len(chromNames) == 0):
+        os.rmdir(tabledir)
+    return meta
+
+
+"""Exports one exact-match table and its hash index, returns its manifest
+   entry. Chromosome names are upper-cased before coding, as MySQL 
+   compares them case-insensitively. Rows are streamed to disk as they 
+   are read; only their (key, rowid) are kept in memory.
+"""
+def exportIndex(conn, table, spec, tabledir):
+    (chromCol, posCol) = spec
+
+    chroms = {}
+    keys = array('q')
+    rowids = array('q')
+    inds = {}
+
+    def keep(row, rowid):
+        if (row[inds['chrom']] is None or row[inds['pos']] is None):
+            return
+        code = chroms.setdefault(str(row[inds['chrom']]).upper(), 
+            len(chroms))
+        keys.append(hi.packKey(code, int(row[inds['pos']])))
+        rowids.append(rowid)
+
+    def description(names):
+        inds['chrom'] = names.index(chromCol)
+        inds['pos'] = names.index(posCol)
+
+    (names, kinds, count, spill) = streamTable(conn, table, tabledir, keep,
+        description)
+
+    # a stable sort keeps the export order of rows sharing a key
+    keys = np.array(keys, dtype=np.int64)
+    rowids = np.array(rowids, dtype=np.int64)
+    order = np.argsort(keys, kind='stable')
+    keys = keys[order]
+    writeRows(spill, rowids[order], kinds, tabledir)
+    spill.remove()
+
+    (unique, firsts, counts) = np.unique(keys, return_index=True, 
+        return_counts=True)
+    index = hi.buildTable(unique, firsts, counts)
+    index.keys.tofile(os.path.join(tabledir, '_key.col'))
+    index.firsts.tofile(os.path.join(tabledir, '_first.col'))
+    index.counts.tofile(os.path.join(tabledir, '_count.col'))
+
+    return {'columns': [[names[i], kinds[i]] for i in range(len(names))],
+        'chrom': chromCol, 'pos': posCol, 'rows': len(keys), 
+        'chroms': chroms, 'bits': index.bits}
+
+
+"""Exports the reference tables into snapshot_dir/<version> and makes it
+   the current version once complete
+"""
+def buildSnapshot(conn, snapshot_dir, version=None, tables=SNAPSHOT_TABLES,
+    indexes=INDEX_TABLES):
+    if (version is None):
+        version = datetime.utcnow().strftime('%Y%m%d%H%M%S')
+
+    tmpdir = os.path.join(snapshot_dir, version + '.tmp')
+    shutil.rmtree(tmpdir, ignore_errors=True)
+    fu.mkdirp(tmpdir)
+
+    manifest = {'version': version,
+        'created': datetime.utcnow().isoformat(),
+        'byteorder': sys.byteorder,
+        'tables': {},
+        'indexes': {}}
+    for table in sorted(tables):
+        print(f"Exporting {table}")
+        manifest['tables'][table] = exportTable(conn, table, tables[table],
+            os.path.join(tmpdir, table))
+    for table in sorted(indexes):
+        print(f"Indexing {table}")
+        manifest['indexes'][table] = exportIndex(conn, table, indexes[table],
+            os.path.join(tmpdir, table))
+
+    fh = open(os.path.join(tmpdir, MANIFEST), 'w')
+    json.dump(manifest, fh, indent=1, sort_keys=True)
+    fh.close()
+
+    os.rename(tmpdir, os.path.join(snapshot_dir, version))
+    fh = open(os.path.join(snapshot_dir, CURRENT + '.tmp'), 'w')
+    fh.write(version + '\n')
+    fh.close()
+    os.rename(os.path.join(snapshot_dir, CURRENT + '.tmp'),
+        os.path.join(snapshot_dir, CURRENT))
+    return os.path.join(snapshot_dir, version)
+
+
+def mapFile(path):
+    fh = open(path, 'rb')
+    if (os.fstat(fh.fileno()).st_size == 0):
+        fh.close()
+        return b''
+    mm = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+    fh.close()
+    return mm
+
+
+"""One column of one partition, read through mmap
+"""
+class Column(object):
+    def __init__(self, path, kind):
+        self.kind = kind
+        self.nulls = None
+        if fu.isExist(path + '.nul'):
+            self.nulls = mapFile(path + '.nul')
+
+        if kind in FIXED_WIDTH:
+            self.values = memoryview(mapFile(path + '.col')).cast(
+                FIXED_WIDTH[kind])
+        else:
+            self.offsets = memoryview(mapFile(path + '.off')).cast('q')
+            self.data = mapFile(path + '.dat')
+
+    def __len__(self):
+        if self.kind in FIXED_WIDTH:
+            return len(self.values)
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        if (self.nulls is not None and self.nulls[i]):
+            return None
+        if self.kind in FIXED_WIDTH:
+            return self.values[i]
+
+        data = self.data[self.offsets[i]:self.offsets[i + 1]]
+        if (self.kind == 'b'):
+            return bytes(data)
+        elif (self.kind == 'd'):
+            return decimal.Decimal(data.decode('utf-8'))
+        return data.decode('utf-8')
+
+
+"""Rows of one chromosome, sorted by start
+"""
+class Partition(object):
+    def __init__(self, path, meta, table):
+        self.path = path
+        self.rows = meta['rows']
+        self.maxLength = meta['maxLength']
+        self.table = table
+        self.columns = {}
+        self.starts = self.column(table.startInd).values
+        self.ends = self.column(table.endInd).values
+        self.rowids = self.column('_rowid').values
+
+    def column(self, i):
+        if i not in self.columns:
+            kind = 'i' if i == '_rowid' else self.table.kinds[i]
+            self.columns[i] = Column(os.path.join(self.path, str(i)), kind)
+        return self.columns[i]
+
+    def row(self, i, columns=None):
+        if (columns is None):
+            columns = range(len(self.table.names))
+        return tuple([self.column(c)[i] for c in columns])
+
+    """Indices of rows with start - offset <= pos <= end + offset, in the
+       table's original (export) order
+    """
+    def overlapping(self, pos, offset=0):
+        return self.overlappingRange(pos - offset, pos + offset)
+
+    """Rows whose interval overlaps [start, end], in table order
+    """
+    def overlappingRange(self, start, end):
+        lo = bisect.bisect_left(self.starts, start - self.maxLength)
+        hi = bisect.bisect_right(self.starts, end)
+        hits = []
+        for i in range(lo, hi):
+            if (start <= self.ends[i]):
+                hits.append(i)
+        if (len(hits) > 1):
+            hits.sort(key=lambda i: self.rowids[i])
+        return hits
+
+    """overlapping() for many positions at once; see overlap.overlapBatch
+    """
+    def overlappingBatch(self, positions, offset=0, fetchone=False):
+        return ov.overlapBatch(positions,
+            np.frombuffer(self.starts, dtype=np.int64),
+            np.frombuffer(self.ends, dtype=np.int64), self.maxLength,
+            offset=offset, order=np.frombuffer(self.rowids, dtype=np.int64),
+            fetchone=fetchone)
+
+
+class SnapshotTable(object):
+    def __init__(self, path, meta):
+        self.path = path
+        self.meta = meta
+        self.names = [c[0] for c in meta['columns']]
+        self.kinds = [c[1] for c in meta['columns']]
+        self.startInd = self.names.index(meta['start'])
+        self.endInd = self.names.index(meta['end'])
+        self.partitions = {}
+
+    def partition(self, chrom):
+        if (self.meta['chrom'] is None):
+            chrom = ALL_CHROMS
+        if chrom not in self.partitions:
+            pmeta = self.meta['partitions'].get(str(chrom))
+            if (pmeta is None):
+                self.partitions[chrom] = None
+            else:
+                self.partitions[chrom] = Partition(
+                    os.path.join(self.path, pmeta['dir']), pmeta, self)
+        return self.partitions[chrom]
+
+
+"""Exact-match table: rows sorted by key and the hash index over them
+"""
+class IndexTable(object):
+    def __init__(self, path, meta):
+        self.path = path
+        self.meta = meta
+        self.names = [c[0] for c in meta['columns']]
+        self.kinds = [c[1] for c in meta['columns']]
+        self.columns = {}
+        self.index = hi.HashTable(self.column('_key').values, 
+            self.column('_first').values, self.column('_count').values, 
+            meta['bits'])
+
+    def column(self, i):
+        if i not in self.columns:
+            kind = 'i' if str(i).startswith('_') else self.kinds[i]
+            self.columns[i] = Column(os.path.join(self.path, str(i)), kind)
+        return self.columns[i]
+
+    def row(self, i, columns=None):
+        if (columns is None):
+            columns = range(len(self.names))
+        return tuple([self.column(c)[i] for c in columns])
+
+    """Packed key, or None when no row can match
+    """
+    def key(self, chrom, pos):
+        code = self.meta['chroms'].get(str(chrom).upper())
+        if (code is None or pos < 0 or pos > hi.POS_MASK):
+            return None
+        return hi.packKey(code, pos)
+
+    def rows(self, first, count, columns=None):
+        return [self.row(i, columns) for i in range(first, first + count)]
+
+
+"""Read-only view of a snapshot built by buildSnapshot(). The path may be
+   a version directory or the snapshot directory, in which case the
+   version named in CURRENT is opened.
+"""
+class Snapshot(object):
+    def __init__(self, path):
+        if fu.isExist(os.path.join(path, CURRENT)):
+            fh = open(os.path.join(path, CURRENT))
+            path = os.path.join(path, fh.read().strip())
+            fh.close()
+
+        fh = open(os.path.join(path, MANIFEST))
+        self.manifest = json.load(fh)
+        fh.close()
+
+        if (self.manifest['byteorder'] != sys.byteorder):
+            raise ValueError(f"Snapshot {path} was built on a " + \
+                f"{self.manifest['byteorder']} endian host")
+
+        self.path = path
+        self.version = self.manifest['version']
+        self.tables = {}
+        self.indexes = {}
+
+    def hasTable(self, table):
+        return table in self.manifest['tables']
+
+    def table(self, table):
+        if table not in self.tables:
+            self.tables[table] = SnapshotTable(os.path.join(self.path, table),
+                self.manifest['tables'][table])
+        return self.tables[table]
+
+    """Same rows as 'select <columns> from table where chrom = ... AND
+       (start - offset) <= pos AND pos <= (end + offset)'
+    """
+    def overlapping(self, table, chrom, pos, offset=0, columns=None):
+        t = self.table(table)
+        part = t.partition(chrom)
+        if (part is None):
+            return []
+
+        if (columns is not None):
+            columns = [t.names.index(c) for c in columns]
+        return [part.row(i, columns) for i in part.overlapping(pos, offset)]
+
+    """Rows of table overlapping [start, end] on chrom, in table order
+    """
+    def overlappingRange(self, table, chrom, start, end, columns=None):
+        t = self.table(table)
+        part = t.partition(chrom)
+        if (part is None):
+            return []
+
+        if (columns is not None):
+            columns = [t.names.index(c) for c in columns]
+        return [part.row(i, columns) for i in part.overlappingRange(start, 
+            end)]
+
+    def hasIndex(self, table):
+        return table in self.manifest.get('indexes', {})
+
+    def index(self, table):
+        if table not in self.indexes:
+            self.indexes[table] = IndexTable(os.path.join(self.path, table),
+                self.manifest['indexes'][table])
+        return self.indexes[table]
+
+    """Same rows, in the same order, as 'select <columns> from table where
+       chrom = ... AND pos = ...' on an indexed table
+    """
+    def exact(self, table, chrom, pos, columns=None):
+        t = self.index(table)
+        key = t.key(chrom, pos)
+        if (key is None):
+            return []
+
+        if (columns is not None):
+            columns = [t.names.index(c) for c in columns]
+        (first, count) = t.index.find(key)
+        return t.rows(first, count, columns)
+
+    """exact() for a list of (chrom, pos) pairs, probed in one batch
+    """
+    def exactBatch(self, table, keys, columns=None):
+        t = self.index(table)
+        packed = [t.key(chrom, pos) for (chrom, pos) in keys]
+        known = [i for i in range(len(packed)) if packed[i] is not None]
+        (firsts, counts) = t.index.findBatch([packed[i] for i in known])
+
+        if (columns is not None):
+            columns = [t.names.index(c) for c in columns]
+        results = [[] for key in keys]
+        for k in range(len(known)):
+            results[known[k]] = t.rows(int(firsts[k]), int(counts[k]), 
+                columns)
+        return results
+
+    """overlapping() for a list of positions on one chromosome: returns one
+       list of rows per position, or with fetchone the first row or None
+    """
+    def overlappingBatch(self, table, chrom, positions, offset=0, 
+        columns=None, fetchone=False):
+        t = self.table(table)
+        part = t.partition(chrom)
+        if (part is None):
+            return [None if fetchone else [] for pos in positions]
+
+        if (columns is not None):
+            columns = [t.names.index(c) for c in columns]
+        hits = part.overlappingBatch(positions, offset, fetchone)
+        if fetchone:
+            return [None if i < 0 else part.row(int(i), columns) for i in hits]
+        return [[part.row(int(i), columns) for i in rows] for rows in hits]
+
+
+if __name__ == '__main__':
+    if (len(sys.argv) > 2 and sys.argv[1] == 'build'):
+        version = sys.argv[3] if len(sys.argv) > 3 else None
+        conn = u.db_connect()
+        print(f"Snapshot written to {buildSnapshot(conn, sys.argv[2], version)}")
+        conn.close()
+    else:
+        print("Usage: python snapshot.py build <snapshot_dir> [version]")
+
+### EOF
@@ -0,0 +1,365 @@
+# tabix.py
+#
+# Tabix (.tbi) index of a BGZF-compressed, position-sorted VCF, and a
+# reader that fetches only the blocks a region query needs.
+#
+# The index is the one tabix writes (htslib's TBI format, compressed with
+# BGZF): for every chromosome, the bins of the 16kb-to-512Mb binning
+# scheme that hold records, each with the (virtual offset) chunks of the
+# file where they are, plus a linear index of the first record in every
+# 16kb window. A virtual offset is the compressed offset of a block
+# shifted left 16 bits, plus an offset into the decompressed block.
+#
+# TabixReader answers chrom:start-end queries from any source that can
+# read a byte range: a local file, or an S3 object through ranged GETs,
+# so a region of a result in S3 costs a few small requests instead of
+# downloading the whole file.
+#
+# Usage: python tabix.py index <file.vcf.gz>
+#        python tabix.py query <file.vcf.gz | s3://bucket/key>
+#            chrom:start-end
+#
+##
+
+import sys
+import zlib
+import struct
+
+import bgzf
+
+MAGIC = b'TBI\x01'
+FORMAT_VCF = 2
+MIN_SHIFT = 14
+DEPTH = 5
+MAX_POSITION = 1 << (MIN_SHIFT + 3 * DEPTH)
+
+"""Bytes read past the start of the last block of a chunk; a BGZF block
+   is never longer
+"""
+MAX_BLOCK = 1 << 16
+
+
+"""Bin of the interval [beg, end), 0-based
+"""
+def reg2bin(beg, end):
+    end = end - 1
+    shift = MIN_SHIFT
+    offset = ((1 << (3 * DEPTH)) - 1) // 7
+    for level in range(DEPTH, 0, -1):
+        if (beg >> shift == end >> shift):
+            return offset + (beg >> shift)
+        shift = shift + 3
+        offset = offset - (1 << (3 * (level - 1)))
+    return 0
+
+
+"""Bins that can hold an interval overlapping [beg, end), 0-based
+"""
+def reg2bins(beg, end):
+    end = end - 1
+    bins = [0]
+    shift = MIN_SHIFT + 3 * DEPTH
+    offset = 0
+    for level in range(1, DEPTH + 1):
+        shift = shift - 3
+        offset = offset + (1 << (3 * (level - 1)))
+        bins.extend(range(offset + (beg >> shift),
+            offset + (end >> shift) + 1))
+    return bins
+
+
+def blockSize(header):
+    return struct.unpack('<H', header[16:18])[0] + 1
+
+
+"""(compressed offset, offset of the next block, decompressed data) of
+   every whole block in BGZF bytes that start at compressed offset base
+"""
+def blocks(data, base=0):
+    offset = 0
+    while (offset + 18 <= len(data)):
+        size = blockSize(data[offset:offset + 18])
+        if (offset + size > len(data)):
+            return
+        yield (base + offset, base + offset + size,
+            zlib.decompress(data[offset + 18:offset + size - 8], -15))
+        offset = offset + size
+
+
+def blocksOfFile(path):
+    fh = open(path, 'rb')
+    offset = 0
+    while True:
+        header = fh.read(18)
+        if (len(header) < 18):
+            break
+        rest = fh.read(blockSize(header) - 18)
+        size = len(header) + len(rest)
+        yield (offset, offset + size, zlib.decompress(rest[:-8], -15))
+        offset = offset + size
+    fh.close()
+
+
+"""(line, virtual offset of its start, virtual offset past its end) of
+   every whole line in BGZF blocks; a line ending its block ends at the
+   start of the next one
+"""
+def lines(blockList):
+    pending = []
+    start = None
+    for (coffset, next, data) in blockList:
+        pos = 0
+        while (pos < len(data)):
+            if (start is None):
+                start = (coffset << 16) | pos
+            newline = data.find(b'\n', pos)
+            if (newline < 0):
+                pending.append(data[pos:])
+                break
+            pending.append(data[pos:newline])
+            pos = newline + 1
+            end = (coffset << 16) | pos if (pos < len(data)) else next << 16
+            yield (b''.join(pending), start, end)
+            pending = []
+            start = None
+
+
+"""(chrom, beg, end) of a VCF record line, 0-based half-open
+"""
+def recordRange(line):
+    fields = line.split(b'\t', 5)
+    pos = int(fields[1].strip())
+    ref = fields[3].strip()
+    return (fields[0].decode('utf-8'), pos - 1, pos - 1 + max(len(ref), 1))
+
+
+"""Index of the BGZF VCF at path; None when the records are not sorted
+   by position within each chromosome, or lie past what a .tbi can index
+"""
+def buildIndex(path):
+    names = []
+    refs = {}
+    current = None
+    last = None
+
+    for (line, start, end) in lines(blocksOfFile(path)):
+        if (len(line) == 0 or line.startswith(b'#')):
+            continue
+        (chrom, beg, stop) = recordRange(line)
+        if (chrom != current):
+            if chrom in refs:
+                return None
+            names.append(chrom)
+            refs[chrom] = ({}, {})
+            current = chrom
+            last = None
+        if ((last is not None and beg < last) or beg < 0 or
+            stop > MAX_POSITION):
+            return None
+        last = beg
+        addRecord(refs[chrom], beg, stop, start, end)
+    return (names, refs)
+
+
+"""Adds the record at virtual offsets [start, end) to (bins, linear)
+"""
+def addRecord(ref, beg, stop, start, end):
+    (bins, linear) = ref
+    chunks = bins.setdefault(reg2bin(beg, stop), [])
+    if (len(chunks) > 0 and chunks[-1][1] == start):
+        chunks[-1][1] = end
+    else:
+        chunks.append([start, end])
+    for window in range(beg >> MIN_SHIFT, ((stop - 1) >> MIN_SHIFT) + 1):
+        if window not in linear:
+            linear[window] = start
+
+
+def serializeIndex(names, refs):
+    nameBytes = b''.join([name.encode('utf-8') + b'\0' for name in names])
+    out = [MAGIC, struct.pack('<8i', len(names), FORMAT_VCF, 1, 2, 0,
+        ord('#'), 0, len(nameBytes)), nameBytes]
+    for name in names:
+        (bins, linear) = refs[name]
+        out.append(struct.pack('<i', len(bins)))
+        for bin in sorted(bins):
+            out.append(struct.pack('<Ii', bin, len(bins[bin])))
+            for (start, end) in bins[bin]:
+                out.append(struct.pack('<QQ', start, end))
+
+        windows = max(linear) + 1 if (len(linear) > 0) else 0
+        offsets = []
+        previous = 0
+        for window in range(0, windows):
+            previous = linear.get(window, previous)
+            offsets.append(previous)
+        out.append(struct.pack('<i', windows))
+        out.append(struct.pack(f"<{windows}Q", *offsets))
+    return b''.join(out)
+
+
+"""Writes path + '.tbi' for the BGZF VCF at path; returns its name, or
+   None when the file cannot be indexed (see buildIndex)
+"""
+def writeIndex(path):
+    index = buildIndex(path)
+    if (index is None):
+        return None
+    data = serializeIndex(*index)
+    fh = open(path + '.tbi', 'wb')
+    for start in range(0, len(data), bgzf.BLOCK_SIZE):
+        fh.write(bgzf.compressBlock(data[start:start + bgzf.BLOCK_SIZE]))
+    fh.write(bgzf.EOF_BLOCK)
+    fh.close()
+    return path + '.tbi'
+
+
+"""{chrom: (bins {bin: [(start, end)]}, linear offsets)} of .tbi bytes
+"""
+def parseIndex(data):
+    data = b''.join([block for (offset, next, block) in blocks(data)])
+    if (data[:4] != MAGIC):
+        raise ValueError("Not a tabix index")
+    header = struct.unpack('<8i', data[4:36])
+    names = data[36:36 + header[7]].split(b'\0')[:header[0]]
+    pos = 36 + header[7]
+
+    refs = {}
+    for name in names:
+        (nBins,) = struct.unpack('<i', data[pos:pos + 4])
+        pos = pos + 4
+        bins = {}
+        for i in range(0, nBins):
+            (bin, nChunks) = struct.unpack('<Ii', data[pos:pos + 8])
+            pos = pos + 8
+            chunks = struct.unpack(f"<{2 * nChunks}Q",
+                data[pos:pos + 16 * nChunks])
+            pos = pos + 16 * nChunks
+            bins[bin] = [(chunks[k], chunks[k + 1])
+                for k in range(0, len(chunks), 2)]
+        (nIntv,) = struct.unpack('<i', data[pos:pos + 4])
+        pos = pos + 4
+        linear = struct.unpack(f"<{nIntv}Q", data[pos:pos + 8 * nIntv])
+        pos = pos + 8 * nIntv
+        refs[name.decode('utf-8')] = (bins, linear)
+    return refs
+
+
+class FileSource(object):
+    def __init__(self, path):
+        self.path = path
+
+    def read(self, start, end):
+        fh = open(self.path, 'rb')
+        fh.seek(start)
+        data = fh.read(end - start)
+        fh.close()
+        return data
+
+    def readAll(self, suffix=''):
+        fh = open(self.path + suffix, 'rb')
+        data = fh.read()
+        fh.close()
+        return data
+
+
+"""An S3 object read by ranged GETs
+"""
+class S3Source(object):
+    def __init__(self, s3, bucket, key):
+        self.s3 = s3
+        self.bucket = bucket
+        self.key = key
+        self.requests = 0
+
+    def read(self, start, end):
+        self.requests = self.requests + 1
+        response = self.s3.get_object(Bucket=self.bucket, Key=self.key,
+            Range=f"bytes={start}-{end - 1}")
+        return response['Body'].read()
+
+    def readAll(self, suffix=''):
+        self.requests = self.requests + 1
+        response = self.s3.get_object(Bucket=self.bucket,
+            Key=self.key + suffix)
+        return response['Body'].read()
+
+
+"""Region queries on a BGZF VCF and its .tbi, both read from source
+"""
+class TabixReader(object):
+    def __init__(self, source):
+        self.source = source
+        self.refs = parseIndex(source.readAll('.tbi'))
+
+    """Chunks (virtual offset ranges) that can hold records overlapping
+       [beg, end), merged and in file order
+    """
+    def chunks(self, chrom, beg, end):
+        if chrom not in self.refs:
+            return []
+        (bins, linear) = self.refs[chrom]
+        window = beg >> MIN_SHIFT
+        minOffset = linear[min(window, len(linear) - 1)] \
+            if (len(linear) > 0) else 0
+
+        chunks = sorted([chunk for bin in reg2bins(beg, end)
+            for chunk in bins.get(bin, []) if chunk[1] > minOffset])
+        merged = []
+        for (start, stop) in chunks:
+            if (len(merged) > 0 and start <= merged[-1][1]):
+                merged[-1][1] = max(merged[-1][1], stop)
+            else:
+                merged.append([start, stop])
+        return merged
+
+    """Lines (str, without the newline) of the records overlapping
+       chrom:start-end, 1-based and inclusive, in file order
+    """
+    def query(self, chrom, start, end):
+        (beg, stop) = (start - 1, end)
+        results = []
+        for (first, last) in self.chunks(chrom, beg, stop):
+            (cfirst, clast) = (first >> 16, last >> 16)
+            if (last & 0xffff):
+                clast = clast + MAX_BLOCK
+            data = self.source.read(cfirst, clast)
+            for (line, lstart, lend) in lines(blocks(data, cfirst)):
+                if (lstart >= last):
+                    break
+                if (lstart < first or len(line) == 0 or
+                    line.startswith(b'#')):
+                    continue
+                (rchrom, rbeg, rstop) = recordRange(line)
+                if (rchrom == chrom and rbeg < stop and beg < rstop):
+                    results.append(line.decode('utf-8'))
+        return results
+
+
+def parseRegion(region):
+    (chrom, span) = region.rsplit(':', 1)
+    (start, end) = span.replace(',', '').split('-')
+    return (chrom, int(start), int(end))
+
+
+def openSource(location):
+    if location.startswith('s3://'):
+        import boto3
+        (bucket, key) = location[len('s3://'):].split('/', 1)
+        return S3Source(boto3.client('s3'), bucket, key)
+    return FileSource(location)
+
+
+if __name__ == '__main__':
+    if (len(sys.argv) > 2 and sys.argv[1] == 'index'):
+        print(writeIndex(sys.argv[2]) or "Not sorted by position: no index")
+    elif (len(sys.argv) > 3 and sys.argv[1] == 'query'):
+        reader = TabixReader(openSource(sys.argv[2]))
+        for line in reader.query(*parseRegion(sys.argv[3])):
+            print(line)
+    else:
+        print("Usage: python tabix.py index <file.vcf.gz>")
+        print("       python tabix.py query " + \
+            "<file.vcf.gz | s3://bucket/key> chrom:start-end")
+
+### EOF
@@ -0,0 +1,43 @@
+# conftest.py
+#
+# The AnnTools modules import each other by name, as run.py and the
+# workers run them, from the anntools directory. The synthetic reference
+# (see synthetic.py), and its snapshot, are built once for the whole
+# session.
+#
+##
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, 
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import synthetic
+import backends as be
+import snapshot as snap
+
+
+"""Directory of the synthetic reference, ref.db, and its inputs, in0.vcf
+   and in1.vcf (sorted); tests copy what they change
+"""
+@pytest.fixture(scope='session')
+def reference(tmp_path_factory):
+    base = tmp_path_factory.mktemp('reference')
+    synthetic.buildAll(base)
+    return base
+
+
+"""Snapshot (see snapshot.py) of the synthetic reference, version 'test'
+"""
+@pytest.fixture(scope='session')
+def snapshot(reference, tmp_path_factory):
+    path = tmp_path_factory.mktemp('snapshot')
+    conn = be.openBackend('sqlite', str(reference / 'ref.db')).connect()
+    snap.buildSnapshot(conn, str(path), 'test')
+    conn.close()
+    return path
+
+### EOF
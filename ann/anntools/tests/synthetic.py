@@ -0,0 +1,258 @@
+# synthetic.py
+#
+# A small synthetic reference, in SQLite, with every table the pipeline
+# queries, and VCF inputs to annotate against it. The rows and records are
+# drawn from a seeded random.Random, so every run builds the same files.
+#
+##
+
+import os
+import sys
+import json
+import random
+import shutil
+import sqlite3
+import subprocess
+
+ANNTOOLS = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ANNTOOLS not in sys.path:
+    sys.path.insert(0, ANNTOOLS)
+
+import driver
+
+"""Expected outputs of small.vcf, as the pipeline wrote them when they
+   were made (python synthetic.py expected)
+"""
+EXPECTED = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+
+CHROMS = ['1', '2', 'X']
+LENGTH = 3000
+BASES = 'ACGT'
+
+REGION_COLUMNS = ['chr', 'start', 'end', 'haplotypeReference',
+    'haplotypeAlternate', 'name', 'name2', 'transcriptStrand',
+    'positionType', 'frame', 'mrnaCoord', 'codonCoord', 'spliceDist',
+    'referenceCodon', 'referenceAA', 'variantCodon', 'variantAA',
+    'changesAA', 'functionalClass', 'codingCoordStr', 'proteinCoordStr',
+    'inCodingRegion', 'spliceInfo', 'uorfChange']
+
+"""Interval tables of the overlap stages: (table, columns after the
+   interval, rows, longest interval); the values of the columns are
+   filled in by row number
+"""
+OVERLAP_TABLES = [
+    ('cpgIslandExt', ['name'], 200, 100),
+    ('gwasCatalog', ['name', 'pubMedID', 'author', 'pubDate', 'journal',
+        'title', 'trait'], 300, 1),
+    ('targetScanS', ['name', 'score', 'strand'], 200, 20),
+    ('hugo', ['name', 'symbol', 'description'], 150, 300),
+    ('dgv_Cnv', ['name'], 100, 300),
+    ('abParts_IG_T_CelReceptors', ['name'], 100, 300),
+    ('mcCarroll_Cnv', ['name'], 100, 300),
+    ('conrad_Cnv', ['name'], 100, 300),
+    ('genomicSuperDups', ['name', 'score', 'strand', 'otherChrom',
+        'otherStart', 'otherEnd'], 150, 300)]
+
+
+def interval(rand, longest):
+    start = rand.randint(1, LENGTH)
+    return (start, start + rand.randint(0, longest))
+
+
+def insert(db, table, rows):
+    marks = ','.join(['?'] * len(rows[0]))
+    db.executemany(f"insert into {table} values ({marks})", rows)
+
+
+"""Value of column name in row i of an overlap table
+"""
+def overlapValue(rand, table, name, i, start, end):
+    if (name == 'trait'):
+        return rand.choice(['Height', 'BMI ', 'Type 2 diabetes'])
+    if (name == 'symbol'):
+        return f"SYM{rand.randint(1, 40)}"
+    if (name in ('score', 'otherStart', 'otherEnd')):
+        return {'score': 50, 'otherStart': start + 5, 'otherEnd': end + 5}[
+            name]
+    if (name == 'otherChrom'):
+        return 'chr' + rand.choice(CHROMS)
+    return f"{table}{i};{name}"
+
+
+"""Writes a small reference with every table the pipeline queries, its
+   rows drawn from rand over CHROMS and positions up to LENGTH
+"""
+def buildReference(path, rand):
+    db = sqlite3.connect(path)
+
+    db.execute("create table dbSNP (uid integer, CHR text, POS integer, " + \
+        "ID text, REF text, ALT text, QUAL text, GMAF text, INFO text)")
+    insert(db, 'dbSNP', [(i, rand.choice(CHROMS), rand.randint(1, LENGTH),
+        f"rs{i}", rand.choice(BASES), rand.choice(BASES), '.',
+        rand.choice(['.', f"0.0{rand.randint(1, 9)}"]),
+        rand.choice(['SNV', 'SNV', 'MNV'])) for i in range(0, 2500)])
+
+    columns = ['uid integer'] + [('CHR text' if name == 'chr' else
+        name + (' integer' if name in ('start', 'end') else ' text'))
+        for name in REGION_COLUMNS]
+    for table in ['chrom_pos_equal_base', 'chrom_pos_equal_nobase',
+        'chrom_pos_unequal']:
+        db.execute(f"create table {table} ({','.join(columns)})")
+        rows = []
+        for i in range(0, 600):
+            (start, end) = interval(rand, 30)
+            if (table != 'chrom_pos_unequal'):
+                end = start
+            rows.append([i, rand.choice(CHROMS), start, end,
+                rand.choice(BASES), rand.choice(BASES),
+                f"NM_{rand.randint(1, 50)}", f"G{rand.randint(1, 20)}",
+                rand.choice('+-'), rand.choice(['CDS', 'intron', 'utr5',
+                'utr3', 'non_coding_exon'])] + \
+                [rand.choice(['0', '', f"x{rand.randint(1, 9)}"])
+                for k in range(0, 15)])
+        insert(db, table, rows)
+
+    db.execute("create table refGene (bin integer, name text, " + \
+        "chrom text, strand text, txStart integer, txEnd integer, " + \
+        "cdsStart integer, cdsEnd integer, exonCount integer, " + \
+        "exonStarts blob, exonEnds blob, score integer, name2 text, " + \
+        "cdsStartStat text, cdsEndStat text, exonFrames text)")
+    rows = []
+    for i in range(0, 150):
+        (start, end) = interval(rand, 400)
+        bounds = [start, end]
+        if (end - start > 10):
+            bounds = sorted(rand.sample(range(start, end + 1),
+                2 * rand.randint(1, 4)))
+        exons = len(bounds) // 2
+        if (rand.random() < 0.3):
+            (cdsStart, cdsEnd) = (end, end)
+        else:
+            cdsStart = rand.randint(start, end)
+            cdsEnd = rand.randint(cdsStart, end)
+        rows.append((0, f"NM_{i}", 'chr' + rand.choice(CHROMS),
+            rand.choice('+-'), start, end, cdsStart, cdsEnd, exons,
+            ''.join([f"{b}," for b in bounds[0::2]]).encode(),
+            ''.join([f"{b}," for b in bounds[1::2]]).encode(), 0,
+            f"GENE{i}", 'cmpl', 'cmpl', ''))
+    insert(db, 'refGene', rows)
+
+    db.execute("create table cytoBand (chrom text, chromStart integer, " + \
+        "chromEnd integer, name text, gieStain text)")
+    insert(db, 'cytoBand', [('chr' + chrom, start, start + 520,
+        f"p{start // 500}", 'gneg') for chrom in CHROMS
+        for start in range(0, LENGTH + 1, 500)])
+
+    db.execute("create table gadAll (chromosome text, " + \
+        "chromStart integer, chromEnd integer, geneSymbol text, " + \
+        "disease text)")
+    insert(db, 'gadAll', [(rand.choice(CHROMS),) + interval(rand, 300) +
+        (f"GAD{rand.randint(1, 30)}", 'd') for i in range(0, 200)])
+
+    for (table, names, count, longest) in OVERLAP_TABLES:
+        db.execute(f"create table {table} (bin integer, chrom text, " + \
+            "chromStart integer, chromEnd integer, " + \
+            ', '.join([f"{name} text" for name in names]) + ")")
+        rows = []
+        for i in range(0, count):
+            (start, end) = interval(rand, longest)
+            rows.append([0, 'chr' + rand.choice(CHROMS), start, end] +
+                [overlapValue(rand, table, name, i, start, end)
+                for name in names])
+        insert(db, table, rows)
+
+    for chrom in [str(c) for c in range(1, 23)] + ['X', 'Y']:
+        db.execute(f"create table tfbsConsSites{chrom} (bin integer, " + \
+            "chrom text, chromStart integer, chromEnd integer, " + \
+            "name text, score integer)")
+        if chrom in CHROMS:
+            insert(db, f"tfbsConsSites{chrom}", [(0, 'chr' + chrom) +
+                interval(rand, 30) + (f"V$TF{rand.randint(1, 20)}", 900)
+                for i in range(0, 150)])
+    db.commit()
+    db.close()
+
+
+"""Writes a VCF of count records; sorted by position within each
+   chromosome when ordered, for the merge join
+"""
+def writeInput(path, rand, count, ordered):
+    records = [(rand.choice(CHROMS + ['chr1', '7']), rand.randint(1, LENGTH))
+        for i in range(0, count)]
+    if ordered:
+        records.sort()
+    fh = open(path, 'w')
+    fh.write("##fileformat=VCFv4.0\n##source=test\n" + \
+        "#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\tS1\n")
+    for (chrom, pos) in records:
+        fh.write('\t'.join([chrom, str(pos), rand.choice(['.', 'rs1']),
+            rand.choice(BASES), rand.choice(BASES), '50', 'PASS',
+            rand.choice(['.', 'DP=10', 'AF=0.5;']), 'GT', '0/1']) + '\n')
+    fh.close()
+
+
+"""Builds the reference (ref.db) and the inputs, in0.vcf unordered,
+   in1.vcf sorted and small.vcf, in the directory base
+"""
+def buildAll(base):
+    rand = random.Random(7)
+    buildReference(str(base / 'ref.db'), rand)
+    for ordered in (False, True):
+        writeInput(str(base / f"in{int(ordered)}.vcf"), rand, 1500, ordered)
+    writeInput(str(base / 'small.vcf'), random.Random(11), 100, False)
+
+
+"""Annotates a copy of small.vcf in workdir with driver.run(**options), in
+   a process of its own: the order of the bigRefGene rows in INFO (and so
+   the counters of the later stages) follows set iteration, which depends
+   on the hash seed, so it is fixed. Returns the bytes of the .annot.vcf
+   and .count.log.
+"""
+def annotateSmall(base, workdir, **options):
+    os.makedirs(workdir)
+    infile = os.path.join(workdir, 'small.vcf')
+    shutil.copy(os.path.join(base, 'small.vcf'), infile)
+    options.update(backend='sqlite', 
+        reference_path=os.path.join(base, 'ref.db'))
+    code = f"import sys; sys.path.insert(0, {ANNTOOLS!r}); " + \
+        f"import driver; driver.run({infile!r}, 'vcf', **{options!r})"
+    subprocess.run([sys.executable, '-c', code], check=True, 
+        stdout=subprocess.DEVNULL, 
+        env=dict(os.environ, PYTHONHASHSEED='0'))
+    return [open(name, 'rb').read() for name in 
+        (driver.annotatedName(infile), driver.countLogName(infile))]
+
+
+"""Contents of every file of the snapshot version at path, by relative
+   name, with the manifest parsed and its creation time left out
+"""
+def snapshotFiles(path):
+    files = {}
+    for (root, dirs, names) in os.walk(path):
+        for name in names:
+            fh = open(os.path.join(root, name), 'rb')
+            files[os.path.relpath(os.path.join(root, name), path)] = \
+                fh.read()
+            fh.close()
+    manifest = json.loads(files.pop('manifest.json'))
+    del manifest['created']
+    files['manifest.json'] = manifest
+    return files
+
+
+if __name__ == '__main__':
+    if (len(sys.argv) > 1 and sys.argv[1] == 'expected'):
+        import pathlib
+        import tempfile
+        base = pathlib.Path(tempfile.mkdtemp())
+        buildAll(base)
+        outputs = annotateSmall(str(base), str(base / 'staged'))
+        os.makedirs(EXPECTED, exist_ok=True)
+        for (name, data) in zip(['small.annot.vcf', 'small.vcf.count.log'],
+            outputs):
+            open(os.path.join(EXPECTED, name), 'wb').write(data)
+        shutil.rmtree(str(base))
+    else:
+        print("Usage: python synthetic.py expected")
+
+### EOF
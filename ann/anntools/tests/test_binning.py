@@ -0,0 +1,138 @@
+# test_binning.py
+#
+# binning.migrate on a copy of the synthetic reference, with rows added
+# far apart on each chromosome so that they fall in different bins at
+# every level: the bins it stores must be the ones binFromRange computes,
+# and a query with the bin predicate must return exactly the rows the
+# plain range query returns.
+#
+##
+
+import random
+import shutil
+import sqlite3
+
+import pytest
+
+import backends as be
+import binning as bn
+import benchmark
+
+"""Past the first 128kb bin, up to the 512Mb bin of the standard scheme
+"""
+SPAN = 200000000
+
+
+"""Copies of rows of table moved to random places up to SPAN, some on
+   the edges of bins; some are made long enough to straddle bins of the
+   upper levels
+"""
+def spreadRows(cursor, table, rand, count):
+    (chrom, start, end) = bn.BIN_TABLES[table]
+    cursor.execute('select * from ' + table)
+    names = [d[0] for d in cursor.description]
+    rows = cursor.fetchall()
+    (startIndex, endIndex) = (names.index(start), names.index(end))
+    moved = []
+    for i in range(0, count if (len(rows) > 0) else 0):
+        row = list(rand.choice(rows))
+        length = rand.choice([0, 1, 300, 200000, 3000000])
+        row[startIndex] = rand.randint(0, SPAN)
+        # or starting, or ending, on the edge of a 128kb bin
+        edge = rand.randint(1, SPAN >> bn.FIRST_SHIFT) << bn.FIRST_SHIFT
+        row[startIndex] = rand.choice([row[startIndex], edge,
+            max(edge - length, 0)])
+        row[endIndex] = row[startIndex] + length
+        moved.append(row)
+    marks = ','.join(['%s'] * len(names))
+    cursor.executemany('insert into ' + table + ' values (' + marks + ')',
+        moved)
+    return [(row[names.index(chrom)] if chrom else None, row[startIndex],
+        row[endIndex]) for row in moved]
+
+
+@pytest.fixture
+def migrated(reference, tmp_path, monkeypatch):
+    # which tables have a bin column is remembered per process
+    monkeypatch.setattr(bn, 'BINNED', {})
+    path = str(tmp_path / 'ref.db')
+    shutil.copy(str(reference / 'ref.db'), path)
+    conn = be.SqliteConnection(sqlite3.connect(path))
+    rand = random.Random(3)
+    cursor = conn.cursor()
+    placed = {}
+    for table in sorted(bn.BIN_TABLES):
+        cursor.execute("select count(*) from sqlite_master where " + \
+            "type='table' and name=%s", [table])
+        if (cursor.fetchone()[0] > 0):
+            placed[table] = spreadRows(cursor, table, rand, 300)
+    # tfbsConsSites of the chromosomes the reference has no rows on
+    placed = dict([(table, rows) for (table, rows) in placed.items()
+        if len(rows) > 0])
+    conn.commit()
+    # the synthetic reference has bin columns, all 0: recompute them
+    assert set(bn.migrate(conn, recompute=True)) >= set(placed)
+    yield (conn, path, placed)
+    conn.close()
+
+
+def test_bins_are_computed(migrated):
+    (conn, path, placed) = migrated
+    cursor = conn.cursor()
+    for table in placed:
+        (chrom, start, end) = bn.BIN_TABLES[table]
+        cursor.execute(f"select {start}, {end}, bin from {table}")
+        rows = cursor.fetchall()
+        assert all([bin == bn.binFromRange(int(rowStart), int(rowEnd))
+            for (rowStart, rowEnd, bin) in rows]), table
+        assert len(set([bin for (rowStart, rowEnd, bin) in rows])) > 50
+
+
+def test_binned_queries_match_range(migrated):
+    (conn, path, placed) = migrated
+    cursor = conn.cursor()
+    rand = random.Random(5)
+    found = 0
+    for table in sorted(placed):
+        (chromName, startName, endName) = bn.BIN_TABLES[table]
+        for (chrom, start, end) in placed[table][:100]:
+            # on a row's ends, just past them, and over a window
+            before = max(start - 1, 0)
+            for (first, last) in [(start, start), (end, end),
+                (end + 1, end + 1), (before, before),
+                (max(start - rand.randint(0, 500000), 0), end + 1000)]:
+                (where, params) = ('', [])
+                if (chromName is not None):
+                    (where, params) = (chromName + '=%s AND ', [chrom])
+                rows = {}
+                for label in ['range', 'bin']:
+                    (binned, bins) = bn.binPredicate(cursor, table, first,
+                        last) if (label == 'bin') else ('', [])
+                    assert (label == 'range' or len(bins) > 0)
+                    cursor.execute('select * from ' + table + ' where ' +
+                        where + binned + startName + ' <= %s AND %s <= ' +
+                        endName, params + bins + [last, first])
+                    rows[label] = sorted(cursor.fetchall())
+                assert rows['bin'] == rows['range'], (table, first, last)
+                found = found + len(rows['range'])
+    assert found > 1000
+
+
+def test_benchmark_bins(migrated, tmp_path, capsys, monkeypatch):
+    (conn, path, placed) = migrated
+    monkeypatch.setattr(benchmark.u, 'pool', benchmark.u.pool)
+    benchmark.u.use_backend(be.openBackend('sqlite', path))
+    vcf = str(tmp_path / 'bins.vcf')
+    fh = open(vcf, 'w')
+    fh.write("#CHROM\tPOS\tID\tREF\tALT\n")
+    for (chrom, start, end) in placed['cpgIslandExt'][:50]:
+        fh.write(f"{chrom}\t{start + 1}\t.\tA\tG\n")
+    fh.close()
+    benchmark.benchBins(vcf)
+    lines = capsys.readouterr().out.splitlines()
+    measured = [line for line in lines if ' 0 queries' not in line]
+    assert set([line.split(':')[0] for line in measured]) >= \
+        set([table for table in placed if bn.BIN_TABLES[table][0]])
+    assert all([line.endswith('identical True') for line in measured])
+
+### EOF
@@ -0,0 +1,167 @@
+# test_dedup.py
+#
+# Job keys of the synthetic inputs, and the dedup records and result
+# copies against an in-memory S3 that raises the ClientErrors boto3
+# raises. A record found is a hit; a missing record or result object,
+# whether S3 answers 404 or 403, is a miss, and run.py deletes a record
+# whose results are gone and annotates the job again.
+#
+##
+
+import gzip
+import importlib
+import io
+import os
+import shutil
+
+import pytest
+from botocore.exceptions import ClientError
+
+import dedup
+
+
+def clientError(code):
+    return ClientError({'Error': {'Code': code}}, 'op')
+
+
+"""Objects of one bucket in a dict; a missing key raises missingCode, as
+   S3 answers NoSuchKey, or AccessDenied without s3:ListBucket
+"""
+class FakeS3(object):
+    def __init__(self, missingCode='NoSuchKey'):
+        self.objects = {}
+        self.missingCode = missingCode
+
+    def get_object(self, Bucket, Key):
+        if Key not in self.objects:
+            raise clientError(self.missingCode)
+        return {'Body': io.BytesIO(self.objects[Key])}
+
+    def put_object(self, Bucket, Key, Body, ContentType=None):
+        if not isinstance(Body, bytes):
+            Body = Body.encode('utf-8')
+        self.objects[Key] = Body
+
+    def copy(self, source, bucket, key, Config=None):
+        if source['Key'] not in self.objects:
+            raise clientError('404' if self.missingCode == 'NoSuchKey'
+                else self.missingCode)
+        self.objects[key] = self.objects[source['Key']]
+
+    def delete_object(self, Bucket, Key):
+        self.objects.pop(Key, None)
+
+
+class FakeCloudWatch(object):
+    def __init__(self):
+        self.metrics = []
+
+    def put_metric_data(self, Namespace, MetricData):
+        self.metrics.extend([m['MetricName'] for m in MetricData])
+
+
+RESULTS = {'result': 'user/user/a~in.annot.vcf',
+    'log': 'user/user/a~in.vcf.count.log', 'index': ''}
+TARGETS = {'result': 'user/user/b~in.annot.vcf',
+    'log': 'user/user/b~in.vcf.count.log',
+    'index': 'user/user/b~in.annot.vcf.tbi'}
+
+
+def test_job_key(reference, tmp_path):
+    plain = str(reference / 'in0.vcf')
+    packed = str(tmp_path / 'in0.vcf.gz')
+    fh = open(packed, 'wb')
+    fh.write(gzip.compress(open(plain, 'rb').read()))
+    fh.close()
+    options = {'compress_output': False, 'overlap_join': 'point'}
+    key = dedup.jobKey(plain, 'v1', options)
+    # the same text, compressed or not, is the same job
+    assert dedup.jobKey(packed, 'v1', options) == key
+    assert dedup.jobKey(str(reference / 'in1.vcf'), 'v1', options) != key
+    assert dedup.jobKey(plain, 'v2', options) != key
+    assert dedup.jobKey(plain, 'v1', dict(options,
+        overlap_join='merge')) != key
+
+
+def test_hit_and_miss(reference, capsys):
+    s3 = FakeS3()
+    cloudwatch = FakeCloudWatch()
+    key = dedup.jobKey(str(reference / 'in0.vcf'), 'v1', {})
+    assert dedup.findResults(s3, 'bucket', 'user', key) is None
+    dedup.countJob(key, False, cloudwatch, 'ns')
+    dedup.recordResults(s3, 'bucket', 'user', key, RESULTS)
+    assert dedup.findResults(s3, 'bucket', 'user', key) == RESULTS
+    dedup.countJob(key, True, cloudwatch, 'ns')
+    assert cloudwatch.metrics == ['DedupMisses', 'DedupHits']
+    assert capsys.readouterr().out.splitlines() == [f"Dedup miss for {key}",
+        f"Dedup hit for {key}"]
+
+    s3.objects[RESULTS['result']] = b'annotated'
+    s3.objects[RESULTS['log']] = b'counts'
+    assert dedup.copyResults(s3, 'bucket', RESULTS, TARGETS, None)
+    assert s3.objects[TARGETS['result']] == b'annotated'
+    assert s3.objects[TARGETS['log']] == b'counts'
+    # no index was recorded: none is copied
+    assert TARGETS['index'] not in s3.objects
+
+    dedup.forgetResults(s3, 'bucket', 'user', key)
+    assert dedup.findResults(s3, 'bucket', 'user', key) is None
+
+
+@pytest.mark.parametrize('code', ['404', 'NoSuchKey', '403',
+    'AccessDenied'])
+def test_missing_is_a_miss(code):
+    s3 = FakeS3(code)
+    assert dedup.findResults(s3, 'bucket', 'user', 'key') is None
+    # a result object deleted since it was recorded
+    assert not dedup.copyResults(s3, 'bucket', RESULTS, TARGETS, None)
+
+
+def test_other_errors_raise():
+    s3 = FakeS3('SlowDown')
+    with pytest.raises(ClientError):
+        dedup.findResults(s3, 'bucket', 'user', 'key')
+    with pytest.raises(ClientError):
+        dedup.copyResults(s3, 'bucket', RESULTS, TARGETS, None)
+
+
+@pytest.fixture
+def run(monkeypatch):
+    # run.py creates its AWS clients when it is imported
+    monkeypatch.setenv('AWS_DEFAULT_REGION', 'us-east-1')
+    module = importlib.import_module('run')
+    completed = []
+    monkeypatch.setattr(module, 's3_client', FakeS3('AccessDenied'))
+    monkeypatch.setattr(module, 'results_bucket', 'bucket')
+    monkeypatch.setattr(module, 'username', 'user')
+    monkeypatch.setattr(module, 'cloudwatch', None)
+    monkeypatch.setattr(module, 'update_dynamodb',
+        lambda job_id, *args: completed.append(job_id))
+    monkeypatch.setattr(module, 'notify_user', lambda **kwargs: None)
+    return (module, completed)
+
+
+def test_reuse_results(reference, tmp_path, run):
+    (run, completed) = run
+    s3 = run.s3_client
+    infile = str(tmp_path / 'b' / 'in.vcf')
+    os.makedirs(os.path.dirname(infile))
+    shutil.copy(str(reference / 'in0.vcf'), infile)
+    job = run.job_files(infile)
+    key = dedup.jobKey(infile, 'v1', {})
+    assert not run.reuse_results(job, key, 'user@example.com')
+
+    # results archived, and deleted, since they were recorded
+    dedup.recordResults(s3, 'bucket', 'user', key, RESULTS)
+    assert not run.reuse_results(job, key, 'user@example.com')
+    assert dedup.findResults(s3, 'bucket', 'user', key) is None
+    assert completed == [] and os.path.exists(infile)
+
+    dedup.recordResults(s3, 'bucket', 'user', key, RESULTS)
+    s3.objects[RESULTS['result']] = b'annotated'
+    s3.objects[RESULTS['log']] = b'counts'
+    assert run.reuse_results(job, key, 'user@example.com')
+    assert s3.objects[job['s3_keys']['result']] == b'annotated'
+    assert completed == ['b'] and not os.path.exists(job['job_folder'])
+
+### EOF
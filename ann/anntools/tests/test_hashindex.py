@@ -0,0 +1,91 @@
+# test_hashindex.py
+#
+# The hash index must find every key it was built with, and nothing else,
+# one key or a batch at a time. The snapshot's exact-match tables must
+# return the rows the synthetic reference returns for a (chromosome,
+# position), in the same order, and their export must not depend on how
+# many rows it reads or writes at a time.
+#
+##
+
+import os
+import random
+
+import backends as be
+import hashindex as hi
+import snapshot as snap
+import synthetic
+
+
+def test_table_finds_keys():
+    rand = random.Random(19)
+    # positions close together, so that home slots collide
+    entries = {}
+    for i in range(0, 5000):
+        key = hi.packKey(rand.randint(0, 30), rand.choice([
+            rand.randint(0, 3000), rand.randint(0, hi.POS_MASK)]))
+        entries[key] = (rand.randint(0, 1 << 40), rand.randint(1, 9))
+    keys = sorted(entries)
+    table = hi.buildTable(keys, [entries[key][0] for key in keys],
+        [entries[key][1] for key in keys])
+    assert len(table.keys) >= 2 * len(keys)
+    absent = [hi.packKey(rand.randint(0, 40), rand.randint(0, 5000))
+        for i in range(0, 2000)]
+    absent = [key for key in absent if key not in entries]
+    probes = keys + absent
+    rand.shuffle(probes)
+    expected = [entries.get(key, (0, 0)) for key in probes]
+    assert [table.find(key) for key in probes] == expected
+    (firsts, counts) = table.findBatch(probes)
+    assert list(zip(firsts.tolist(), counts.tolist())) == expected
+    empty = hi.buildTable([], [], [])
+    assert empty.find(hi.packKey(0, 1)) == (0, 0)
+
+
+def test_exact_matches_reference(reference, snapshot):
+    reader = snap.Snapshot(str(snapshot))
+    conn = be.openBackend('sqlite', str(reference / 'ref.db')).connect()
+    cursor = conn.cursor()
+    rand = random.Random(23)
+    for table in sorted(snap.INDEX_TABLES):
+        (chromCol, posCol) = snap.INDEX_TABLES[table]
+        cursor.execute(f"select {chromCol}, {posCol} from {table}")
+        keys = [tuple(row) for row in rand.sample(cursor.fetchall(), 200)]
+        # positions without rows, a chromosome without rows, and no
+        # position at all
+        keys = keys + [(rand.choice(synthetic.CHROMS),
+            rand.randint(0, synthetic.LENGTH + 100)) for i in range(0, 200)]
+        keys = keys + [('7', 100), ('1', -1), ('1', hi.POS_MASK + 1)]
+        rows = []
+        for (chrom, pos) in keys:
+            cursor.execute(f"select * from {table} where {chromCol}=%s " + \
+                f"AND {posCol}=%s", [chrom, pos])
+            rows.append([tuple(row) for row in cursor.fetchall()])
+            assert reader.exact(table, chrom, pos) == rows[-1], \
+                (table, chrom, pos)
+        assert reader.exactBatch(table, keys) == rows
+        # dbSNP has positions with more than one row
+        assert max([len(found) for found in rows]) > 1
+    conn.close()
+
+
+def test_chunked_index_export_is_identical(reference, snapshot, tmp_path,
+    monkeypatch):
+    # rows read, and values written, a few at a time
+    monkeypatch.setattr(snap, 'READ_CHUNK', 7)
+    monkeypatch.setattr(snap, 'WRITE_CHUNK', 5)
+    conn = be.openBackend('sqlite', str(reference / 'ref.db')).connect()
+    path = snap.buildSnapshot(conn, str(tmp_path), 'test', tables={})
+    conn.close()
+    chunked = synthetic.snapshotFiles(path)
+    whole = synthetic.snapshotFiles(str(snapshot / 'test'))
+    manifest = whole.pop('manifest.json')
+    manifest['tables'] = {}
+    whole = dict([(name, data) for (name, data) in whole.items()
+        if name.split(os.sep)[0] in snap.INDEX_TABLES])
+    whole['manifest.json'] = manifest
+    assert set([name.split(os.sep)[0] for name in whole]) == \
+        set(snap.INDEX_TABLES) | set(['manifest.json'])
+    assert chunked == whole
+
+### EOF
@@ -0,0 +1,58 @@
+# test_mergejoin.py
+#
+# A batch of jobs annotated in one fused pass with the merge join must
+# write, for every job, what that job gets when it runs alone: the sweep
+# starts over at each job's first record, so a sorted job that follows
+# another one is still merge joined, and an unsorted one falls back to
+# point queries on its own.
+#
+##
+
+import os
+import shutil
+
+import driver
+
+
+"""Writes the header and every step-th record of the input src to path
+"""
+def writeSubset(src, path, step):
+    lines = open(src).readlines()
+    header = [line for line in lines if line.startswith('#')]
+    records = [line for line in lines if not line.startswith('#')]
+    fh = open(path, 'w')
+    fh.writelines(header + records[::step])
+    fh.close()
+
+
+def test_jobs_match_single_runs(reference, tmp_path):
+    options = {'batch_size': 100, 'backend': 'sqlite',
+        'reference_path': str(reference / 'ref.db'), 'connections': 2,
+        'overlap_join': 'merge'}
+    # sorted, unsorted, then sorted jobs that start over from the first
+    # chromosome
+    sources = ['in1.vcf', 'in0.vcf', 'in1.vcf', None, 'in1.vcf']
+    jobs = []
+    for i in range(0, len(sources)):
+        jobdir = tmp_path / 'batch' / str(i)
+        os.makedirs(str(jobdir))
+        infile = str(jobdir / 'in.vcf')
+        if (sources[i] is None):
+            writeSubset(str(reference / 'in1.vcf'), infile, 3)
+        else:
+            shutil.copy(str(reference / sources[i]), infile)
+        jobs.append(infile)
+    driver.runJobs(jobs, 'vcf', **options)
+
+    for infile in jobs:
+        alone = infile.replace('batch', 'alone')
+        os.makedirs(os.path.dirname(alone))
+        shutil.copy(infile, alone)
+        driver.run(alone, 'vcf', mode='fused', **options)
+        for (batched, single) in [(driver.annotatedName(infile),
+            driver.annotatedName(alone)), (driver.countLogName(infile),
+            driver.countLogName(alone))]:
+            assert open(batched, 'rb').read() == open(single, 'rb').read(), \
+                batched
+
+### EOF
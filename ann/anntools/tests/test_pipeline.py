@@ -0,0 +1,120 @@
+# test_pipeline.py
+#
+# The fused pipeline must write exactly what the staged one writes. Both
+# annotate the same synthetic VCF against a small SQLite reference (see
+# synthetic.py), with several connections, the lookup cache and the merge
+# join, and their .annot.vcf and .count.log files are compared byte for
+# byte.
+#
+##
+
+import os
+import shutil
+import threading
+
+import pytest
+
+import driver
+import synthetic
+
+"""Annotates a copy of the input in workdir; returns the bytes of its
+   .annot.vcf and .count.log
+"""
+def annotate(reference, workdir, ordered, **options):
+    os.makedirs(workdir)
+    infile = os.path.join(workdir, 'in.vcf')
+    shutil.copy(str(reference / f"in{int(ordered)}.vcf"), infile)
+    driver.run(infile, 'vcf', backend='sqlite',
+        reference_path=str(reference / 'ref.db'), batch_size=100, **options)
+    return [open(name, 'rb').read() for name in
+        (driver.annotatedName(infile, False), driver.countLogName(infile))]
+
+
+def withoutCacheLines(counts):
+    return [line for line in counts.splitlines()
+        if not line.startswith(b'Cache ')]
+
+
+@pytest.mark.parametrize('ordered, options', [
+    (False, {}),
+    (False, {'connections': 3}),
+    (False, {'connections': 3, 'cache': True}),
+    (True, {'overlap_join': 'merge'}),
+    (True, {'connections': 3, 'overlap_join': 'merge', 'cache': True}),
+    # out of order, the merge join falls back to point queries
+    (False, {'connections': 2, 'overlap_join': 'merge'}),
+    (False, {'workers': 3})])
+def test_fused_matches_staged(reference, tmp_path, ordered, options):
+    options = dict(options)
+    modes = ['staged', 'fused']
+    if options.pop('cache', False):
+        # the warm run is answered from what the fused run cached
+        options['reference_version'] = 'test'
+        modes.append('fused-warm')
+    outputs = {}
+    for name in modes:
+        mode = name.split('-')[0]
+        if ('reference_version' in options):
+            options['cache_path'] = str(tmp_path / f"{mode}.cache.db")
+        outputs[name] = annotate(reference, str(tmp_path / name), ordered,
+            mode=mode, **options)
+    (annotated, counts) = outputs['staged']
+    assert len(annotated.splitlines()) > 1500
+    assert outputs['fused'] == [annotated, counts]
+    if ('fused-warm' in outputs):
+        # only the cache's own hit rates change once it is warm
+        assert outputs['fused-warm'][0] == annotated
+        assert withoutCacheLines(outputs['fused-warm'][1]) == \
+            withoutCacheLines(counts)
+        assert withoutCacheLines(counts) != counts
+
+def test_failed_chunk_leaves_no_files(reference, tmp_path):
+    workdir = str(tmp_path / 'work')
+    os.makedirs(workdir)
+    infile = os.path.join(workdir, 'in.vcf')
+    shutil.copy(str(reference / 'in0.vcf'), infile)
+    # every chunk fails to open the snapshot
+    with pytest.raises(Exception):
+        driver.run(infile, 'vcf', mode='fused', workers=3, batch_size=100,
+            backend='sqlite', reference_path=str(reference / 'ref.db'),
+            snapshot_dir=str(tmp_path / 'missing'))
+    assert os.listdir(workdir) == ['in.vcf']
+
+def test_failed_batch_closes_annotators(reference, tmp_path, monkeypatch):
+    def fail(*args, **kwargs):
+        raise RuntimeError('batch failed')
+    monkeypatch.setattr(driver.ann, 'runJobPipeline', fail)
+    infile = str(tmp_path / 'in.vcf')
+    shutil.copy(str(reference / 'in0.vcf'), infile)
+    threads = threading.active_count()
+    with pytest.raises(RuntimeError):
+        driver.runJobs([infile], 'vcf', connections=3, backend='sqlite',
+            reference_path=str(reference / 'ref.db'))
+    # the scheduler's threads are gone, its connections back in the pool
+    assert threading.active_count() == threads
+    assert len(driver.u.pool.idle) >= 3
+
+"""Both pipelines must also write what the per-stage functions wrote
+   before the fused pipeline existed, kept in tests/data, so that a change
+   to the lookups and applies they share cannot pass unnoticed (the merge
+   join orders overlapping rows by start, so it is only compared above)
+"""
+@pytest.mark.parametrize('options', [
+    {'mode': 'staged'},
+    {'mode': 'fused'},
+    {'mode': 'fused', 'connections': 3, 'cache_path': 'cache.db',
+        'reference_version': 'test'}])
+def test_expected_outputs(reference, tmp_path, options):
+    options = dict(options)
+    if ('cache_path' in options):
+        options['cache_path'] = str(tmp_path / options['cache_path'])
+    outputs = synthetic.annotateSmall(str(reference), str(tmp_path / 'work'),
+        **options)
+    if ('cache_path' in options):
+        outputs[1] = b'\n'.join(withoutCacheLines(outputs[1])) + b'\n'
+    expected = [open(os.path.join(synthetic.EXPECTED, name), 'rb').read()
+        for name in ('small.annot.vcf', 'small.vcf.count.log')]
+    assert outputs == expected
+
+
+### EOF
@@ -0,0 +1,124 @@
+# test_snapshot.py
+#
+# The snapshot of the synthetic reference must answer what the reference
+# answers: the rows overlapping a position or a range, in table order,
+# for every exported table. The export must not depend on how many rows
+# it reads or writes at a time, and the pipeline annotating from the
+# snapshot must write the expected outputs.
+#
+##
+
+import os
+import random
+
+import pytest
+
+import backends as be
+import snapshot as snap
+import synthetic
+
+
+"""Rows of table on chrom (any chromosome when the spec has none) whose
+   interval overlaps [first, last], as the reference returns them
+"""
+def selectOverlapping(cursor, table, chrom, first, last):
+    (chromCol, startCol, endCol) = snap.SNAPSHOT_TABLES[table]
+    (where, params) = ('', [])
+    if (chromCol is not None):
+        (where, params) = (chromCol + '=%s AND ', [chrom])
+    cursor.execute('select * from ' + table + ' where ' + where + startCol +
+        ' <= %s AND %s <= ' + endCol, params + [last, first])
+    return [tuple(row) for row in cursor.fetchall()]
+
+
+"""(table, chromosome names) of the exported tables that have rows, and
+   a chromosome the reference has no rows on
+"""
+def tableChroms(cursor):
+    tables = []
+    for table in sorted(snap.SNAPSHOT_TABLES):
+        chromCol = snap.SNAPSHOT_TABLES[table][0]
+        cursor.execute('select distinct ' + (chromCol or "'*'") +
+            ' from ' + table)
+        chroms = sorted([str(row[0]) for row in cursor.fetchall()])
+        if (len(chroms) > 0):
+            tables.append((table, chroms + ['chr7']))
+    return tables
+
+
+@pytest.fixture
+def cursor(reference):
+    conn = be.openBackend('sqlite', str(reference / 'ref.db')).connect()
+    yield conn.cursor()
+    conn.close()
+
+
+def test_overlapping_matches_reference(snapshot, cursor):
+    reader = snap.Snapshot(str(snapshot))
+    assert reader.version == 'test'
+    rand = random.Random(13)
+    found = 0
+    for (table, chroms) in tableChroms(cursor):
+        for i in range(0, 100):
+            chrom = rand.choice(chroms)
+            pos = rand.randint(0, synthetic.LENGTH + 400)
+            offset = rand.choice([0, 0, 50])
+            rows = selectOverlapping(cursor, table, chrom, pos - offset,
+                pos + offset)
+            assert reader.overlapping(table, chrom, pos, offset) == rows, \
+                (table, chrom, pos, offset)
+            (start, end) = (pos, pos + rand.randint(0, 500))
+            assert reader.overlappingRange(table, chrom, start, end) == \
+                selectOverlapping(cursor, table, chrom, start, end), \
+                (table, chrom, start, end)
+            found = found + len(rows)
+    assert found > 1000
+
+
+def test_overlapping_batch(snapshot, cursor):
+    reader = snap.Snapshot(str(snapshot))
+    rand = random.Random(17)
+    for (table, chroms) in tableChroms(cursor):
+        for chrom in chroms:
+            positions = sorted([rand.randint(0, synthetic.LENGTH + 400)
+                for i in range(0, 50)])
+            single = [reader.overlapping(table, chrom, pos, 10)
+                for pos in positions]
+            assert reader.overlappingBatch(table, chrom, positions, 10) == \
+                single, (table, chrom)
+            assert reader.overlappingBatch(table, chrom, positions, 10,
+                fetchone=True) == [rows[0] if rows else None
+                for rows in single], (table, chrom)
+
+
+def test_chunked_export_is_identical(reference, snapshot, tmp_path,
+    monkeypatch):
+    # rows read, and values written, a few at a time
+    monkeypatch.setattr(snap, 'READ_CHUNK', 7)
+    monkeypatch.setattr(snap, 'WRITE_CHUNK', 5)
+    conn = be.openBackend('sqlite', str(reference / 'ref.db')).connect()
+    path = snap.buildSnapshot(conn, str(tmp_path), 'test', indexes={})
+    conn.close()
+    chunked = synthetic.snapshotFiles(path)
+    whole = synthetic.snapshotFiles(str(snapshot / 'test'))
+    manifest = whole.pop('manifest.json')
+    manifest['indexes'] = {}
+    whole = dict([(name, data) for (name, data) in whole.items()
+        if name.split(os.sep)[0] not in snap.INDEX_TABLES])
+    whole['manifest.json'] = manifest
+    assert len(whole) > 100
+    assert chunked == whole
+
+
+@pytest.mark.parametrize('options', [
+    {'mode': 'staged'},
+    {'mode': 'fused'},
+    {'mode': 'fused', 'connections': 3}])
+def test_snapshot_outputs(reference, snapshot, tmp_path, options):
+    outputs = synthetic.annotateSmall(str(reference), str(tmp_path / 'work'),
+        snapshot_dir=str(snapshot), **options)
+    expected = [open(os.path.join(synthetic.EXPECTED, name), 'rb').read()
+        for name in ('small.annot.vcf', 'small.vcf.count.log')]
+    assert outputs == expected
+
+### EOF
@@ -0,0 +1,95 @@
+# test_tabix.py
+#
+# Round trip of bgzf.py and tabix.py: a sorted synthetic VCF is written as
+# BGZF, indexed, and queried for random regions; every query must return
+# exactly the records a scan of the whole file finds, in file order.
+#
+##
+
+import gzip
+import random
+
+import bgzf
+import tabix
+
+CHROMS = [('chr1', 200000000), ('chr2', 3000000), ('chrX', 600000)]
+
+HEADER = "##fileformat=VCFv4.1\n" + \
+    "#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n"
+
+
+"""Sorted records (chrom, pos, ref, line) over CHROMS; positions repeat,
+   and long REFs span several 16kb windows of the linear index
+"""
+def syntheticRecords(rand, count):
+    records = []
+    for (chrom, length) in CHROMS:
+        pos = 1
+        gap = 2 * length * len(CHROMS) // count
+        for i in range(0, count // len(CHROMS)):
+            pos = pos + rand.choice([0, 1, 7, 150, rand.randint(1, gap)])
+            if (pos >= length):
+                break
+            ref = rand.choice(['A', 'C', 'GT', 'TTA'])
+            if (rand.random() < 0.02):
+                ref = 'T' * rand.randint(2, 40000)
+            info = 'X=' + 'y' * rand.randint(0, 200)
+            line = '\t'.join([chrom, str(pos), '.', ref, 'G', '.', 'PASS', 
+                info])
+            records.append((chrom, pos, ref, line))
+    return records
+
+
+def writeVcf(path, records):
+    fh = bgzf.BgzfWriter(path)
+    fh.write(HEADER)
+    for (chrom, pos, ref, line) in records:
+        fh.write(line + '\n')
+    fh.close()
+
+
+"""Lines of the records overlapping chrom:start-end (1-based, inclusive)
+"""
+def scan(records, chrom, start, end):
+    return [line for (rchrom, pos, ref, line) in records
+        if rchrom == chrom and pos <= end and start <= pos + len(ref) - 1]
+
+
+def test_queries_match_scan(tmp_path):
+    rand = random.Random(7)
+    records = syntheticRecords(rand, 30000)
+    path = str(tmp_path / 'sorted.vcf.gz')
+    writeVcf(path, records)
+
+    # the result is still a gzip file, with the whole text in it
+    text = gzip.decompress(open(path, 'rb').read()).decode('utf-8')
+    assert text == HEADER + ''.join([r[3] + '\n' for r in records])
+
+    assert tabix.writeIndex(path) == path + '.tbi'
+    reader = tabix.TabixReader(tabix.FileSource(path))
+    for i in range(0, 400):
+        (chrom, length) = rand.choice(CHROMS + [('chrZ', 1000)])
+        start = rand.randint(1, length)
+        end = start + rand.choice([0, 1, 100, 20000, 1000000, 50000000])
+        assert reader.query(chrom, start, end) == \
+            scan(records, chrom, start, end), (chrom, start, end)
+
+    # whole chromosomes
+    for (chrom, length) in CHROMS:
+        assert reader.query(chrom, 1, length) == \
+            scan(records, chrom, 1, length)
+
+
+def test_unsorted_is_not_indexed(tmp_path):
+    rand = random.Random(11)
+    records = syntheticRecords(rand, 300)
+    path = str(tmp_path / 'unsorted.vcf.gz')
+    first = [record for record in records if record[0] == 'chr1']
+    writeVcf(path, first[::-1] + records[len(first):])
+    assert tabix.writeIndex(path) is None
+
+    # a chromosome split in two
+    writeVcf(path, records[-1:] + records[:-1])
+    assert tabix.writeIndex(path) is None
+
+### EOF
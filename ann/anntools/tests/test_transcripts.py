@@ -0,0 +1,61 @@
+# test_transcripts.py
+#
+# The transcript models of annotate.py outlive a run in a process that
+# runs job after job (a warm worker): they must never answer a run from
+# the CpG islands of another reference, and there must never be more than
+# MAX_TRANSCRIPT_MODELS of them.
+#
+##
+
+import os
+import shutil
+import sqlite3
+
+import annotate as ann
+import driver
+
+
+def annotate(reference, path, workdir):
+    os.makedirs(workdir)
+    infile = os.path.join(workdir, 'in.vcf')
+    shutil.copy(str(reference / 'in0.vcf'), infile)
+    driver.run(infile, 'vcf', backend='sqlite', reference_path=path)
+    return [open(name, 'rb').read() for name in
+        (driver.annotatedName(infile, False), driver.countLogName(infile))]
+
+
+def test_models_follow_the_reference(reference, tmp_path):
+    # the same reference without its CpG islands
+    path = str(tmp_path / 'nocpg.db')
+    shutil.copy(str(reference / 'ref.db'), path)
+    db = sqlite3.connect(path)
+    db.execute("delete from cpgIslandExt")
+    db.commit()
+    db.close()
+
+    ann.clearTranscriptModels()
+    alone = annotate(reference, path, str(tmp_path / 'alone'))
+    withIslands = annotate(reference, str(reference / 'ref.db'),
+        str(tmp_path / 'islands'))
+    assert withIslands != alone
+    assert len(ann.TRANSCRIPT_MODELS) > 0
+    assert annotate(reference, path, str(tmp_path / 'after')) == alone
+
+
+def test_models_are_bounded(monkeypatch):
+    monkeypatch.setattr(ann, 'MAX_TRANSCRIPT_MODELS', 3)
+    ann.clearTranscriptModels()
+    rows = [(0, f"NM_{i}", 'chr1', '+', 10 * i, 10 * i + 5, 10 * i,
+        10 * i + 5, 1, f"{10 * i},".encode(), f"{10 * i + 5},".encode())
+        for i in range(0, 5)]
+    models = [ann.transcriptModel(row) for row in rows[:3]]
+    # the first is used again, so the second is the one dropped
+    assert ann.transcriptModel(rows[0]) is models[0]
+    ann.transcriptModel(rows[3])
+    assert list(ann.TRANSCRIPT_MODELS) == [rows[2], rows[0], rows[3]]
+    ann.transcriptModel(rows[4])
+    assert len(ann.TRANSCRIPT_MODELS) == 3
+    assert ann.transcriptModel(rows[1]) is not models[1]
+    ann.clearTranscriptModels()
+
+### EOF
@@ -0,0 +1,224 @@
+# transfer.py
+#
+# S3 transfers of job inputs and results.
+#
+# transferConfig() is the boto3 TransferConfig every download and upload
+# of a job uses: parts of multipart_chunk_mb, max_concurrency of them in
+# flight at once (boto3's defaults are 8MB parts, 10 at a time).
+#
+# For the fused pipeline, which reads its input once from start to end
+# and writes its result the same way, the transfers can also overlap with
+# annotation:
+#   StreamingDownload fetches the input object as ranged GETs, several in
+#   flight, and gives its lines in order as soon as their part arrives
+#   (gzip and BGZF objects are decompressed on the way); every part is
+#   also written to the local input file.
+#   MultipartUpload is the file the result is written to: each part is
+#   uploaded, in the background, as soon as it is full, and the data is
+#   also written to the local result file; close() uploads the last part
+#   and completes the upload.
+#
+##
+
+import zlib
+import codecs
+from concurrent.futures import ThreadPoolExecutor
+
+from boto3.s3.transfer import TransferConfig
+
+import bgzf
+import vcfmap
+
+MB = 1024 * 1024
+
+"""Smallest part S3 takes, except for the last one
+"""
+MIN_PART_SIZE = 5 * MB
+
+
+def transferConfig(multipart_chunk_mb=16, max_concurrency=10):
+    return TransferConfig(multipart_threshold=multipart_chunk_mb * MB,
+        multipart_chunksize=multipart_chunk_mb * MB,
+        max_concurrency=max_concurrency, use_threads=True)
+
+
+def download(s3, bucket, key, path, config):
+    s3.download_file(bucket, key, path, Config=config)
+
+
+def upload(s3, path, bucket, key, config):
+    s3.upload_file(path, bucket, key, Config=config)
+
+
+"""Decompresses the members of a gzip stream (BGZF included) one piece
+   at a time
+"""
+class GzipStream(object):
+    def __init__(self):
+        self.inflate = zlib.decompressobj(31)
+
+    def decompress(self, data):
+        out = []
+        while (len(data) > 0):
+            out.append(self.inflate.decompress(data))
+            if not self.inflate.eof:
+                break
+            data = self.inflate.unused_data
+            self.inflate = zlib.decompressobj(31)
+        return b''.join(out)
+
+
+"""Lines (str, without their line ends) of an S3 object as it downloads;
+   see the top of the file
+"""
+class StreamingDownload(object):
+    def __init__(self, s3, bucket, key, path, config):
+        self.s3 = s3
+        self.bucket = bucket
+        self.key = key
+        self.path = path
+        self.partSize = config.multipart_chunksize
+        self.concurrency = max(config.max_concurrency, 1)
+
+    def fetch(self, start, end):
+        response = self.s3.get_object(Bucket=self.bucket, Key=self.key,
+            Range=f"bytes={start}-{end - 1}")
+        return response['Body'].read()
+
+    """Parts of the object in order, up to concurrency of them in flight
+    """
+    def parts(self):
+        size = self.s3.head_object(Bucket=self.bucket,
+            Key=self.key)['ContentLength']
+        ranges = [(start, min(start + self.partSize, size))
+            for start in range(0, size, self.partSize)]
+        pool = ThreadPoolExecutor(max_workers=self.concurrency)
+        try:
+            pending = [pool.submit(self.fetch, *r)
+                for r in ranges[:self.concurrency]]
+            for i in range(0, len(ranges)):
+                part = pending[i].result()
+                pending[i] = None
+                if (i + self.concurrency < len(ranges)):
+                    pending.append(pool.submit(self.fetch,
+                        *ranges[i + self.concurrency]))
+                yield part
+        finally:
+            pool.shutdown(wait=True, cancel_futures=True)
+
+    def __iter__(self):
+        fh = open(self.path, 'wb')
+        gzip = None
+        decoder = codecs.getincrementaldecoder('utf-8')()
+        rest = ''
+        for part in self.parts():
+            fh.write(part)
+            if (gzip is None):
+                gzip = GzipStream() if part.startswith(bgzf.GZIP_MAGIC) \
+                    else False
+            if gzip:
+                part = gzip.decompress(part)
+            text = rest + decoder.decode(part)
+            # a '\r' at the end of a part may be the start of a '\r\n'
+            held = '\r' if text.endswith('\r') else ''
+            (lines, rest) = vcfmap.splitText(text[:len(text) - len(held)])
+            rest = rest + held
+            yield from lines
+        fh.close()
+        (lines, rest) = vcfmap.splitText(rest + decoder.decode(b'', True))
+        yield from lines
+        if (len(rest) > 0):
+            yield rest
+
+
+"""Binary file that uploads what is written to it as a multipart upload,
+   while writing it to path; see the top of the file
+"""
+class MultipartUpload(object):
+    def __init__(self, s3, bucket, key, path, config):
+        self.s3 = s3
+        self.bucket = bucket
+        self.key = key
+        self.fh = open(path, 'wb')
+        self.partSize = max(config.multipart_chunksize, MIN_PART_SIZE)
+        self.concurrency = max(config.max_concurrency, 1)
+        self.buffer = []
+        self.size = 0
+        self.uploadId = None
+        self.parts = []
+        self.pool = None
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        self.fh.write(data)
+        self.buffer.append(data)
+        self.size = self.size + len(data)
+        if (self.size >= self.partSize):
+            self.flushPart()
+
+    def uploadPart(self, number, data):
+        response = self.s3.upload_part(Bucket=self.bucket, Key=self.key,
+            UploadId=self.uploadId, PartNumber=number, Body=data)
+        return {'PartNumber': number, 'ETag': response['ETag']}
+
+    """Starts the upload of the data written since the last part; waits
+       while concurrency parts are already in flight, so that no more
+       than that are held in memory
+    """
+    def flushPart(self):
+        data = b''.join(self.buffer)
+        self.buffer = []
+        self.size = 0
+        if (self.uploadId is None):
+            self.uploadId = self.s3.create_multipart_upload(
+                Bucket=self.bucket, Key=self.key)['UploadId']
+            self.pool = ThreadPoolExecutor(max_workers=self.concurrency)
+        if (len(self.parts) >= self.concurrency):
+            try:
+                self.parts[-self.concurrency].result()
+            except Exception:
+                self.abort()
+                raise
+        self.parts.append(self.pool.submit(self.uploadPart,
+            len(self.parts) + 1, data))
+
+    def close(self):
+        self.fh.close()
+        if (self.uploadId is None):
+            # smaller than a part: one PUT
+            self.s3.put_object(Bucket=self.bucket, Key=self.key,
+                Body=b''.join(self.buffer))
+            return
+        try:
+            if (self.size > 0):
+                self.flushPart()
+            parts = [part.result() for part in self.parts]
+            self.s3.complete_multipart_upload(Bucket=self.bucket,
+                Key=self.key, UploadId=self.uploadId,
+                MultipartUpload={'Parts': parts})
+        except Exception:
+            self.abort()
+            raise
+        self.pool.shutdown(wait=True)
+
+    def abort(self):
+        self.fh.close()
+        if (self.uploadId is None):
+            return
+        self.pool.shutdown(wait=True, cancel_futures=True)
+        self.s3.abort_multipart_upload(Bucket=self.bucket, Key=self.key,
+            UploadId=self.uploadId)
+        self.uploadId = None
+
+
+"""Writer of a result that is uploaded to bucket/key as it is written
+   and kept at path; BGZF when compress
+"""
+def openResult(s3, bucket, key, path, config, compress=False):
+    upload = MultipartUpload(s3, bucket, key, path, config)
+    if compress:
+        return bgzf.BgzfWriter(path, fh=upload)
+    return upload
+
+### EOF
@@ -13,24 +13,54 @@ __author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
 
 import os
 import json
+import time
+import threading
 import pymysql
 import boto3
 from botocore.exceptions import ClientError
 
-"""Get connection to reference database
+"""Seconds the RDS secret is reused before Secrets Manager is asked again
 """
-def db_connect():
-    AWS_REGION_NAME = os.environ['AWS_REGION_NAME'] if \
-        ('AWS_REGION_NAME' in  os.environ) else "us-east-1"
+SECRET_TTL = 300
+
+"""Idle connections kept by the pool
+"""
+POOL_SIZE = 16
+
+rds_secret_cache = {'secret': None, 'expires': 0}
+rds_secret_lock = threading.Lock()
+
+
+"""RDS connection parameters from AWS Secrets Manager, cached for ttl seconds
+"""
+def get_rds_secret(ttl=SECRET_TTL):
+    with rds_secret_lock:
+        if (rds_secret_cache['secret'] is not None and 
+            time.time() < rds_secret_cache['expires']):
+            return rds_secret_cache['secret']
+
+        AWS_REGION_NAME = os.environ['AWS_REGION_NAME'] if \
+            ('AWS_REGION_NAME' in  os.environ) else "us-east-1"
+
+        # Get RDS secret from AWS Secrets Manager
+        asm = boto3.client('secretsmanager', region_name=AWS_REGION_NAME)
+        try:
+            asm_response = asm.get_secret_value(
+                SecretId='rds/anntools_database')
+            rds_secret = json.loads(asm_response['SecretString'])
+        except ClientError as e:
+            print(f"Unable to retrieve RDS credentials from AWS Secrets Manager: {e}")
+            raise e
+
+        rds_secret_cache['secret'] = rds_secret
+        rds_secret_cache['expires'] = time.time() + ttl
+        return rds_secret
 
-    # Get RDS secret from AWS Secrets Manager
-    asm = boto3.client('secretsmanager', region_name=AWS_REGION_NAME)
-    try:
-        asm_response = asm.get_secret_value(SecretId='rds/anntools_database')
-        rds_secret = json.loads(asm_response['SecretString'])
-    except ClientError as e:
-        print(f"Unable to retrieve RDS credentials from AWS Secrets Manager: {e}")
-        raise e
+
+"""New (unpooled) connection to the reference database
+"""
+def new_connection():
+    rds_secret = get_rds_secret()
 
     # Extract database connection parameters
     rds_host = rds_secret['host']
@@ -48,6 +78,146 @@ def db_connect():
         db=database_name)
 
 
+"""Connection handed out by ConnectionPool; close() gives it back to the 
+   pool, everything else goes to the underlying connection
+"""
+class PooledConnection(object):
+    def __init__(self, pool, conn):
+        self.pool = pool
+        self.conn = conn
+
+    def close(self):
+        if (self.conn is not None):
+            self.pool.release(self.conn)
+            self.conn = None
+
+    def __getattr__(self, name):
+        return getattr(self.conn, name)
+
+
+"""Pool of reference database connections shared by every stage of a 
+   process. Idle connections are pinged on checkout and replaced when the
+   ping fails; a forked child starts with an empty pool rather than share
+   its parent's sockets.
+"""
+class ConnectionPool(object):
+    def __init__(self, connect=new_connection, size=POOL_SIZE, 
+        backend='mysql'):
+        self.connect = connect
+        self.size = size
+        self.backend = backend
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.pid = os.getpid()
+        self.idle = []
+        self.counts = {'hits': 0, 'misses': 0, 'stale': 0, 'checkouts': 0,
+            'checkout_seconds': 0.0, 'max_checkout_seconds': 0.0}
+
+    def take(self):
+        with self.lock:
+            if (self.pid != os.getpid()):
+                self.reset()
+            if (len(self.idle) > 0):
+                return self.idle.pop()
+            return None
+
+    def checkout(self):
+        start = time.time()
+        conn = self.take()
+        hit = True
+        while (conn is not None):
+            try:
+                conn.ping(reconnect=False)
+                break
+            except Exception:
+                self.count('stale')
+                discard(conn)
+                conn = self.take()
+
+        if (conn is None):
+            hit = False
+            conn = self.connect()
+
+        secs = time.time() - start
+        with self.lock:
+            self.counts['hits' if hit else 'misses'] += 1
+            self.counts['checkouts'] += 1
+            self.counts['checkout_seconds'] += secs
+            self.counts['max_checkout_seconds'] = max(secs, 
+                self.counts['max_checkout_seconds'])
+        return PooledConnection(self, conn)
+
+    """Ends the connection's read transaction, so the next user sees 
+       current data, and keeps it unless the pool is full
+    """
+    def release(self, conn):
+        if (self.pid != os.getpid()):
+            # the parent's connection: dropping it must not close its socket
+            return
+        try:
+            conn.rollback()
+        except Exception:
+            self.count('stale')
+            discard(conn)
+            return
+
+        with self.lock:
+            if (len(self.idle) < self.size):
+                self.idle.append(conn)
+                return
+        discard(conn)
+
+    def count(self, key):
+        with self.lock:
+            self.counts[key] += 1
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counts)
+            stats['idle'] = len(self.idle)
+        checkouts = max(stats['checkouts'], 1)
+        stats['mean_checkout_seconds'] = stats['checkout_seconds'] / checkouts
+        return stats
+
+    def summary(self):
+        stats = self.stats()
+        return f"{stats['hits']} hits, {stats['misses']} misses, " + \
+            f"{stats['stale']} stale, mean checkout " + \
+            f"{stats['mean_checkout_seconds'] * 1000:.1f} ms, max " + \
+            f"{stats['max_checkout_seconds'] * 1000:.1f} ms"
+
+
+def discard(conn):
+    try:
+        conn.close()
+    except Exception:
+        pass
+
+
+pool = ConnectionPool()
+
+"""Get connection to reference database, from the shared pool; closing it
+   returns it to the pool
+"""
+def db_connect():
+    return pool.checkout()
+
+
+"""Connects the shared pool to another reference database backend (see
+   backends.py); connections already handed out are not affected. The
+   pool is kept when it already serves the same backend, so a process
+   that runs job after job keeps its connections.
+"""
+def use_backend(backend, size=POOL_SIZE):
+    global pool
+    if (pool.backend == backend.describe() and pool.size == size):
+        return
+    pool = ConnectionPool(connect=backend.connect, size=size, 
+        backend=backend.describe())
+
+
 """Column inices for pileup and VCF
 """
 def getFormatSpecificIndices(format='vcf'):
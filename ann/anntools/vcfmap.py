@@ -0,0 +1,120 @@
+# vcfmap.py
+#
+# Memory-mapped reading of plain-text VCF files.
+#
+# MappedVcf maps the file instead of reading it through a text-mode file
+# object. The leading "##" meta-information block is found by offset, and
+# the lines after it can be read as bytes (lines()), so a filter that
+# only compares a few columns (pileup2vcf.filter_vcf) never decodes a
+# line, or as str (textLines()), decoded a chunk at a time rather than
+# line by line, for the stages, which need every column as text.
+#
+# textLines() splits lines where a text-mode file object does, so it
+# gives the lines "for line in fh" does. lines() splits on newlines only;
+# a CRLF file gives lines ending in '\r', which callers strip.
+#
+##
+
+import os
+import mmap
+
+import bgzf
+
+"""Bytes decoded at a time by textLines(); larger chunks fall out of the
+   CPU cache and read more slowly
+"""
+CHUNK_SIZE = 1 << 16
+
+
+"""Lines of decoded text split as universal newlines split them; the
+   text after the last line end is returned as the remainder
+"""
+def splitText(text):
+    if '\r' in text:
+        text = text.replace('\r\n', '\n').replace('\r', '\n')
+    lines = text.split('\n')
+    return (lines[:-1], lines[-1])
+
+
+class MappedVcf(object):
+    def __init__(self, path):
+        self.fh = open(path, 'rb')
+        if (os.fstat(self.fh.fileno()).st_size > 0):
+            self.data = mmap.mmap(self.fh.fileno(), 0,
+                access=mmap.ACCESS_READ)
+        else:
+            self.data = None
+        self.start = self.headerEnd()
+
+    """Offset of the first line after the "##" lines at the top
+    """
+    def headerEnd(self):
+        pos = 0
+        if (self.data is None):
+            return pos
+        while (self.data[pos:pos + 2] == b'##'):
+            newline = self.data.find(b'\n', pos)
+            if (newline < 0):
+                return len(self.data)
+            pos = newline + 1
+        return pos
+
+    """The "##" lines at the top as bytes, with their line ends
+    """
+    def header(self):
+        if (self.data is None):
+            return b''
+        return self.data[:self.start]
+
+    """Lines after the "##" lines as bytes, with their line ends
+    """
+    def lines(self):
+        if (self.data is None):
+            return iter([])
+        self.data.seek(self.start)
+        return iter(self.data.readline, b'')
+
+    """Every line as str, without its line end
+    """
+    def textLines(self):
+        if (self.data is None):
+            return
+        size = len(self.data)
+        pos = 0
+        rest = ''
+        while (pos < size):
+            end = size
+            if (pos + CHUNK_SIZE < size):
+                # chunks end after a newline, so no line is cut in two
+                newline = self.data.rfind(b'\n', pos, pos + CHUNK_SIZE)
+                if (newline < 0):
+                    newline = self.data.find(b'\n', pos + CHUNK_SIZE)
+                if (newline >= 0):
+                    end = newline + 1
+            (lines, rest) = splitText(self.data[pos:end].decode('utf-8'))
+            yield from lines
+            pos = end
+        if (len(rest) > 0):
+            yield rest
+
+    def close(self):
+        if (self.data is not None):
+            self.data.close()
+        self.fh.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+"""MappedVcf of a plain-text VCF, None for gzip (BGZF included) and
+   empty files, which are read through bgzf.openText()
+"""
+def openMapped(path):
+    if (os.path.getsize(path) == 0 or bgzf.isGzip(path)):
+        return None
+    return MappedVcf(path)
+
+### EOF
@@ -0,0 +1,356 @@
+# vcftable.py
+#
+# Parsed VCF records shared by all annotation stages.
+#
+# Each batch of lines is split once into a ParsedVcf of VcfRecords, which
+# the stages annotate and the writer serializes. A record holds its
+# columns, an append-only INFO, and the stripped CHROM, POS, REF and ALT
+# every stage looks it up by, so no stage strips them again; the batch
+# holds the chromosome codes and positions as numpy arrays. Chromosome
+# names, REF and ALT are interned, as they repeat heavily; a column that
+# needed no stripping is replaced in the record by its interned copy. The
+# "chr" prefix fixes are computed once per chromosome name.
+#
+# INFO is a list of fragments the stages append to (InfoField), joined
+# only when a stage reads it or the record is written; the "." and ";"
+# cases of the old string concatenation are handled there. The columns
+# stay the text that was read, so records are written out exactly as
+# before.
+#
+# The lines of several jobs can be read as one stream (readJobBatches()),
+# each line tagged with the number of its job, so a batch may hold the
+# records of more than one job and each job's lines are written back to
+# its own output.
+#
+##
+
+import sys
+import functools
+
+import numpy as np
+
+"""Stripped chromosome names by code, and codes by name
+"""
+CHROMS = []
+CHROM_CODES = {}
+
+"""Columns of CHROM, POS, REF and ALT in a VCF record
+"""
+VCF_COLUMNS = [0, 1, 3, 4]
+
+"""Column of INFO in a record (in both the VCF and pileup layouts)
+"""
+INFO = 7
+
+"""Positions past this are left to position() to parse
+"""
+MAX_POSITION = (1 << 62)
+
+
+def chromCode(name):
+    code = CHROM_CODES.get(name)
+    if (code is None):
+        code = len(CHROMS)
+        CHROMS.append(sys.intern(name))
+        CHROM_CODES[name] = code
+    return code
+
+
+"""Chromosome name with the "chr" prefix the UCSC tables use
+"""
+@functools.lru_cache(maxsize=None)
+def ucscChrom(chr):
+    if not chr.startswith("chr"):
+        chr = "chr" + chr
+    return chr
+
+
+"""Chromosome name without "chr", as dbSNP and gadAll store it
+"""
+@functools.lru_cache(maxsize=None)
+def bareChrom(chr):
+    if chr.startswith("chr"):
+        chr = chr.replace('chr', '')
+    return chr
+
+
+"""Stripped, interned value of fields[i]; when stripping changes nothing,
+   the field itself is replaced by the interned copy
+"""
+def internColumn(fields, i):
+    value = sys.intern(fields[i].strip())
+    if (fields[i] == value):
+        fields[i] = value
+    return value
+
+
+"""INFO of a record as the fragments appended to it, in order; the text 
+   is their concatenation
+"""
+class InfoField(object):
+    __slots__ = ('parts', 'tabs')
+
+    MISSING = '.'
+
+    def __init__(self, text):
+        self.parts = [text]
+        self.tabs = '\t' in text
+
+    def value(self):
+        if (len(self.parts) > 1):
+            self.parts = [''.join(self.parts)]
+        return self.parts[0]
+
+    def set(self, text):
+        self.parts = [text]
+        self.tabs = '\t' in text
+
+    """Last character of the text, '' when it is empty
+    """
+    def last(self):
+        for part in reversed(self.parts):
+            if (len(part) > 0):
+                return part[-1]
+        return ''
+
+    """Adds fragment after a ';'
+    """
+    def append(self, fragment):
+        self.parts.append(';')
+        self.parts.append(fragment)
+        self.tabs = self.tabs or '\t' in fragment
+
+    """Adds fragment after a ';', unless the text already ends with one
+    """
+    def add(self, fragment):
+        if (self.last() != ';'):
+            self.parts.append(';')
+        self.parts.append(fragment)
+        self.tabs = self.tabs or '\t' in fragment
+
+    """Replaces a missing (".") INFO with first, or appends fragment
+    """
+    def setOrAppend(self, first, fragment):
+        if (self.value() == self.MISSING):
+            self.set(first)
+        else:
+            self.append(fragment)
+
+    """Drops a leading ".;" left by appending to a missing INFO
+    """
+    def dropMissing(self):
+        if self.parts[0].startswith(self.MISSING):
+            text = self.value()
+            if text.startswith(self.MISSING + ';'):
+                self.set(text[len(self.MISSING) + 1:])
+
+    def prefix(self, text):
+        self.parts[0] = text + self.parts[0]
+
+
+"""One VCF record: its columns, INFO (column INFO, when the record has
+   one) as an InfoField, its stripped (CHROM, POS, REF, ALT) when it was
+   parsed with a ParsedVcf, and its row there. Indexing reads and
+   replaces columns as on the field list.
+"""
+class VcfRecord(object):
+    __slots__ = ('fields', 'info', 'locus', 'parsed', 'row', 'job')
+
+    def __init__(self, fields, locus=None, parsed=None, row=None, job=None):
+        self.fields = fields
+        self.info = InfoField(fields[INFO]) if len(fields) > INFO else None
+        self.locus = locus
+        self.parsed = parsed
+        self.row = row
+        self.job = job
+
+    def __len__(self):
+        return len(self.fields)
+
+    def isInfo(self, i):
+        return self.info is not None and (i == INFO or 
+            i == INFO - len(self.fields))
+
+    def __getitem__(self, i):
+        if self.isInfo(i):
+            return self.info.value()
+        return self.fields[i]
+
+    def __setitem__(self, i, value):
+        if self.isInfo(i):
+            self.info.set(value)
+        else:
+            self.fields[i] = value
+
+    """Columns as text, INFO joined
+    """
+    def columns(self):
+        if (self.info is None):
+            return self.fields
+        columns = list(self.fields)
+        columns[INFO] = self.info.value()
+        return columns
+
+    def text(self, sep='\t'):
+        return sep.join(self.columns())
+
+    """Replaces the columns with those of line; the parsed locus is 
+       dropped, since the columns may have moved
+    """
+    def setText(self, line, sep='\t'):
+        self.fields = line.split(sep)
+        self.info = InfoField(self.fields[INFO]) \
+            if len(self.fields) > INFO else None
+        self.locus = None
+        self.parsed = None
+        self.row = None
+
+    """Strips the line ends the way each stage does when it reads the
+       previous stage's temp file
+    """
+    def restrip(self):
+        first = self.fields[0]
+        last = self.info.last() if self.isInfo(-1) else self.fields[-1][-1:]
+        if (len(first) == 0 or first[0].isspace() or 
+            len(last) == 0 or last.isspace()):
+            self.setText(self.text().strip())
+
+    """Puts a space in front of every column but the first, as joining 
+       the columns with a tab and a space and splitting on tabs again does
+    """
+    def padColumns(self):
+        if ((self.info is not None and self.info.tabs) or 
+            True in ['\t' in f for f in self.fields]):
+            self.setText('\t '.join(self.columns()))
+            return
+        for i in range(1, len(self.fields)):
+            self.fields[i] = ' ' + self.fields[i]
+        if (self.info is not None):
+            self.info.prefix(' ')
+
+    """POS as an int; raises ValueError as int() does when it is not one
+    """
+    def position(self):
+        if (self.parsed is None):
+            return int(self.fields[1].strip())
+        pos = int(self.parsed.pos[self.row])
+        if (pos < 0):
+            return int(self.locus[1])
+        return pos
+
+
+"""A batch of VCF lines, parsed once. lines holds the header lines (str)
+   and the records (VcfRecord) in input order; records only the latter.
+   Records too short to have an ALT column are not given a locus. Lines
+   read with their job's number keep it in jobs, in the order of lines.
+"""
+class ParsedVcf(object):
+    def __init__(self):
+        self.lines = []
+        self.records = []
+        self.chroms = []
+        self.pos = []
+        self.jobs = []
+
+    def addHeader(self, line, job=None):
+        self.lines.append(line)
+        if (job is not None):
+            self.jobs.append(job)
+
+    def addRecord(self, line, sep='\t', job=None):
+        if (job is not None):
+            self.jobs.append(job)
+        fields = line.split(sep)
+        if (len(fields) <= VCF_COLUMNS[3]):
+            record = VcfRecord(fields, job=job)
+            self.lines.append(record)
+            self.records.append(record)
+            return
+
+        code = chromCode(fields[0].strip())
+        chr = CHROMS[code]
+        posText = fields[1].strip()
+        ref = internColumn(fields, 3)
+        alt = internColumn(fields, 4)
+        if (fields[0] == chr):
+            fields[0] = chr
+        try:
+            pos = int(posText)
+        except ValueError:
+            pos = -1
+        if (pos > MAX_POSITION):
+            pos = -1
+
+        record = VcfRecord(fields, (chr, posText, ref, alt), self, 
+            len(self.pos), job)
+        self.chroms.append(code)
+        self.pos.append(pos)
+        self.lines.append(record)
+        self.records.append(record)
+
+    """Turns the position columns into arrays once the batch is read
+    """
+    def close(self):
+        self.chroms = np.array(self.chroms, dtype=np.int32)
+        self.pos = np.array(self.pos, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.records)
+
+    def write(self, fh_out):
+        for line in self.lines:
+            if isinstance(line, str):
+                fh_out.write(line + '\n')
+            else:
+                fh_out.write(line.text() + '\n')
+
+    """Writes every line to the output of its job, fhs[job]
+    """
+    def writeJobs(self, fhs):
+        for (line, job) in zip(self.lines, self.jobs):
+            if isinstance(line, str):
+                fhs[job].write(line + '\n')
+            else:
+                fhs[job].write(line.text() + '\n')
+
+
+"""ParsedVcf batches of at most batch_size records from an open VCF (or
+   its lines); lines for which isHeader() is true are kept as they are
+"""
+def readBatches(fh, isHeader, sep='\t', batch_size=500):
+    parsed = ParsedVcf()
+    for line in fh:
+        line = line.strip()
+        if isHeader(line):
+            parsed.addHeader(line)
+        else:
+            parsed.addRecord(line, sep)
+            if (len(parsed.records) >= batch_size):
+                parsed.close()
+                yield parsed
+                parsed = ParsedVcf()
+    parsed.close()
+    yield parsed
+
+
+"""ParsedVcf batches, as readBatches() makes them, of the lines of several
+   jobs read one job after the other (jobLines holds an open VCF, or its
+   lines, for each job); every line is tagged with the number of its job
+"""
+def readJobBatches(jobLines, isHeader, sep='\t', batch_size=500):
+    parsed = ParsedVcf()
+    for (job, fh) in enumerate(jobLines):
+        for line in fh:
+            line = line.strip()
+            if isHeader(line):
+                parsed.addHeader(line, job)
+            else:
+                parsed.addRecord(line, sep, job)
+                if (len(parsed.records) >= batch_size):
+                    parsed.close()
+                    yield parsed
+                    parsed = ParsedVcf()
+    parsed.close()
+    yield parsed
+
+### EOF
@@ -0,0 +1,201 @@
+# workers.py
+#
+# Warm annotation workers for annotator.py.
+#
+# Running "python anntools/run.py" per job pays for the interpreter, the
+# boto3 import, the configuration, the S3, SNS and DynamoDB clients and
+# the reference database connections every time. A WarmWorkers pool
+# starts its processes once; each imports run.py (and with it AnnTools)
+# a single time, keeps its clients, and keeps its pooled database
+# connections from one job to the next. Jobs are handed to an idle
+# worker over its pipe, and the job's output goes to its log file.
+#
+# submit() returns a WarmJob, which has the poll() and returncode of the
+# subprocess.Popen it replaces. A worker that dies is replaced by a new
+# one; its job fails with the worker's exit code.
+#
+# Usage: python workers.py bench [jobs]
+#   compares the startup cost of a job: a new run.py process vs a round
+#   trip to a warm worker
+#
+##
+
+import os
+import sys
+import atexit
+import time
+import traceback
+import subprocess
+import contextlib
+import multiprocessing
+
+"""Task that only asks a worker to answer
+"""
+PING = 'ping'
+
+"""Directory of run.py
+"""
+ANNTOOLS = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    'anntools')
+
+
+"""Main loop of a worker: imports run.py once, then runs the jobs it is
+   sent until it is sent None. A job (function of run.py, args, log path)
+   is answered with its exit status; PING with 0, which tells that the 
+   worker is ready.
+"""
+def serve(conn):
+    sys.path.insert(0, ANNTOOLS)
+    import run
+
+    while True:
+        try:
+            task = conn.recv()
+        except EOFError:
+            return
+        if (task is None):
+            return
+        if (task == PING):
+            conn.send(0)
+            continue
+
+        (function, args, log_path) = task
+        status = 0
+        with open(log_path, 'a') as log, contextlib.redirect_stdout(log), \
+            contextlib.redirect_stderr(log):
+            try:
+                getattr(run, function)(*args)
+            except BaseException:
+                traceback.print_exc()
+                status = 1
+        conn.send(status)
+
+
+class Worker(object):
+    def __init__(self, context):
+        (self.conn, child) = context.Pipe()
+        # not a daemon: the fused pipeline's workers are its children
+        self.process = context.Process(target=serve, args=(child,))
+        self.process.start()
+        child.close()
+        self.busy = False
+
+    def submit(self, task):
+        self.busy = True
+        self.conn.send(task)
+
+    """Exit status of the task sent, None while it runs
+    """
+    def status(self):
+        try:
+            if self.conn.poll():
+                self.busy = False
+                return self.conn.recv()
+        except (EOFError, OSError):
+            pass
+        if self.process.is_alive():
+            return None
+        self.busy = False
+        self.process.join()
+        return self.process.exitcode or 1
+
+    def alive(self):
+        return self.process.is_alive()
+
+    """Lets the worker exit once its job (if any) is done; workers hold 
+       each other's pipes, so closing the pipe would not do
+    """
+    def stop(self):
+        try:
+            self.conn.send(None)
+        except (EOFError, OSError):
+            pass
+        self.process.join()
+        self.conn.close()
+
+
+"""A job running on a warm worker, polled like a subprocess.Popen
+"""
+class WarmJob(object):
+    def __init__(self, worker):
+        self.worker = worker
+        self.returncode = None
+
+    def poll(self):
+        if (self.returncode is None):
+            self.returncode = self.worker.status()
+        return self.returncode
+
+
+class WarmWorkers(object):
+    def __init__(self, size):
+        # forked, so that the workers start without importing annotator.py
+        self.context = multiprocessing.get_context('fork')
+        self.workers = [Worker(self.context) for i in range(0, size)]
+        # the workers are not daemons: they must be told to exit (after
+        # the jobs they are running) when annotator.py does
+        atexit.register(self.stop)
+
+    """Runs run.run_job(*args), or another function of run.py, on an idle
+       worker, with its output appended to log_path
+    """
+    def submit(self, args, log_path, function='run_job'):
+        for (i, worker) in enumerate(self.workers):
+            if not worker.busy:
+                if not worker.alive():
+                    worker = self.workers[i] = Worker(self.context)
+                worker.submit((function, args, log_path))
+                return WarmJob(worker)
+        raise RuntimeError("No idle worker")
+
+    """Waits until every worker has imported run.py
+    """
+    def ready(self):
+        for worker in self.workers:
+            worker.submit(PING)
+        for worker in self.workers:
+            while (worker.status() is None):
+                time.sleep(0.01)
+
+    def stop(self):
+        for worker in self.workers:
+            worker.stop()
+        self.workers = []
+
+
+"""Seconds from starting a job to the point where run.py can run it, for
+   a new "python anntools/run.py" and for a warm worker
+"""
+def benchStartup(jobs=10):
+    start = time.time()
+    for i in range(0, jobs):
+        # run.py without arguments imports everything, creates its clients
+        # and exits
+        subprocess.run([sys.executable, os.path.join(ANNTOOLS, 'run.py')],
+            stdout=subprocess.DEVNULL, check=True)
+    spawned = (time.time() - start) / jobs
+
+    start = time.time()
+    workers = WarmWorkers(1)
+    workers.ready()
+    first = time.time() - start
+    start = time.time()
+    for i in range(0, jobs):
+        workers.workers[0].submit(PING)
+        while (workers.workers[0].status() is None):
+            pass
+    warm = (time.time() - start) / jobs
+    workers.stop()
+
+    print(f"process per job: {spawned * 1000:.1f} ms per job")
+    print(f"warm worker: {first * 1000:.1f} ms once, then " + \
+        f"{warm * 1000:.3f} ms per job")
+
+
+if __name__ == '__main__':
+    if (len(sys.argv) > 1 and sys.argv[1] == 'bench'):
+        benchStartup(int(sys.argv[2]) if len(sys.argv) > 2 else 10)
+    else:
+        print("Usage: python workers.py bench [jobs]")
+
+### EOF